@@ -0,0 +1,100 @@
+# Copyright (c) 2020 SUSE LLC
+#
+# This file is part of azuremetadata.
+#
+# azuremetadata is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# azuremetadata is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with azuremetadata.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Synthetic metadata documents for benchmarks."""
+
+import copy
+import json
+import os
+
+FIXTURES = os.path.join(os.path.dirname(__file__), '..', 'fixtures')
+
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES, name)) as fh:
+        return json.load(fh)
+
+
+def generate_document(nics=64, data_disks=64, tags=1000):
+    """Return a metadata document scaled up from the 2019-08-15 fixture."""
+    document = load_fixture('metadata-v2019-08-15.json')
+    compute = document['compute']
+
+    interface = document['network']['interface'][0]
+    document['network']['interface'] = []
+    for nic in range(nics):
+        item = copy.deepcopy(interface)
+        item['macAddress'] = '000D3A{:06X}'.format(nic)
+        item['ipv4']['ipAddress'][0]['privateIpAddress'] = \
+            '172.16.{}.{}'.format(nic // 250, nic % 250 + 4)
+        document['network']['interface'].append(item)
+
+    os_disk = compute['storageProfile']['osDisk']
+    compute['storageProfile']['dataDisks'] = []
+    for lun in range(data_disks):
+        disk = copy.deepcopy(os_disk)
+        disk['lun'] = str(lun)
+        disk['name'] = 'data-disk-{}'.format(lun)
+        compute['storageProfile']['dataDisks'].append(disk)
+
+    compute['tagsList'] = [
+        {'name': 'tag{}'.format(tag), 'value': 'value <{}> & more'.format(tag)}
+        for tag in range(tags)
+    ]
+    compute['tags'] = ';'.join(
+        '{name}:{value}'.format(**tag) for tag in compute['tagsList']
+    )
+    document['attestedData'] = load_fixture('attested-data-v2019-08-15.json')
+
+    return document
+
+
+def generate_lsblk(disks=64, partitions=4):
+    """Return lsblk --json output with the root file system last.
+
+    Every disk has partitions, the root file system is on the last
+    partition of the last disk, so that the whole tree is searched.
+    """
+    blockdevices = []
+    for disk in range(disks):
+        name = 'sd' + _disk_suffix(disk)
+        children = []
+        for partition in range(1, partitions + 1):
+            children.append({
+                'name': '{}{}'.format(name, partition),
+                'maj:min': '{}:{}'.format(8 + disk // 16, partition),
+                'rm': False, 'size': '1G', 'ro': False, 'type': 'part',
+                'mountpoints': ['/data/{}/{}'.format(disk, partition)],
+            })
+        blockdevices.append({
+            'name': name, 'maj:min': '{}:0'.format(8 + disk // 16),
+            'rm': False, 'size': '64G', 'ro': False, 'type': 'disk',
+            'mountpoints': [None], 'children': children,
+        })
+
+    blockdevices[-1]['children'][-1]['mountpoints'] = ['/']
+    return json.dumps({'blockdevices': blockdevices}).encode('utf-8')
+
+
+def _disk_suffix(index):
+    """Return the letters of the index-th sd disk, a to z, aa, ab..."""
+    suffix = ''
+    index += 1
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        suffix = chr(ord('a') + remainder) + suffix
+    return suffix
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2020 SUSE LLC
+#
+# This file is part of azuremetadata.
+#
+# azuremetadata is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# azuremetadata is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with azuremetadata.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Measure rendering time and write calls for a large document.
+
+Output is written to an unbuffered /dev/null, so every write() of the
+renderer is a write syscall, as it is for an unbuffered --output target.
+"""
+
+import json
+import os
+import time
+
+from azuremetadata.azuremetadatautils import AzureMetadataUtils
+from documents import generate_document
+
+
+class CountingWriter:
+    """Unbuffered text file counting its write syscalls."""
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.writes = 0
+        self.bytes = 0
+
+    def write(self, text):
+        data = text.encode('utf-8')
+        self.writes += 1
+        self.bytes += len(data)
+        return os.write(self.fd, data)
+
+    def flush(self):
+        pass
+
+
+def measure(render, repeat=5):
+    fd = os.open(os.devnull, os.O_WRONLY)
+    try:
+        best = None
+        for _ in range(repeat):
+            writer = CountingWriter(fd)
+            start = time.perf_counter()
+            render(writer)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+    finally:
+        os.close(fd)
+
+    return {'seconds': best, 'writes': writer.writes, 'bytes': writer.bytes}
+
+
+def main():
+    util = AzureMetadataUtils(generate_document())
+    modes = {
+        'values': lambda fh: util.print_pretty(file=fh),
+        'help': lambda fh: util._pretty_print(
+            util.PRINT_MODE_HELP, util.data, file=fh
+        ),
+        'xml': lambda fh: util.print_pretty(print_xml=True, file=fh),
+        'json': lambda fh: util.print_pretty(print_json=True, file=fh),
+    }
+    print(json.dumps(
+        {mode: measure(render) for mode, render in modes.items()}, indent=4
+    ))
+
+
+if __name__ == '__main__':
+    main()
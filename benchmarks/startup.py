@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2020 SUSE LLC
+#
+# This file is part of azuremetadata.
+#
+# azuremetadata is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# azuremetadata is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with azuremetadata.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Measure the wall time of command-line tool invocations.
+
+The cache is read from a temporary runtime directory filled with the
+fixtures, thus no metadata server or agent is needed. root always uses
+the system cache directory, run this as a regular user.
+
+The startup time of the interpreter alone is reported as 'python'.
+"""
+
+import contextlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from documents import load_fixture
+
+from azuremetadata.azuremetadatacache import ResponseCache
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = os.path.join(ROOT, 'azuremetadata')
+
+INVOCATIONS = {
+    'help': ['--help'],
+    'help-schema': ['--api', '2019-08-15', '--help'],
+    'cached-query': ['--compute', '--vmId'],
+    'cached-query-json': [
+        '--network', '--interface', '0', '--macAddress', '--json'
+    ],
+}
+
+
+def measure(command, env, repeat=20):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(
+            command, env=env,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True
+        )
+        times.append(time.perf_counter() - start)
+
+    times.sort()
+    return {'median': times[len(times) // 2], 'min': times[0]}
+
+
+@contextlib.contextmanager
+def cli_environment():
+    """Yield the environment and the command to run the tool with.
+
+    The cache of the tool is a temporary runtime directory filled with
+    the fixtures, no agent is asked.
+    """
+    runtime_dir = tempfile.mkdtemp()
+    try:
+        cache = ResponseCache(os.path.join(runtime_dir, 'azuremetadata'))
+        cache.set('instance', '2017-04-02',
+                  load_fixture('metadata-v2017-04-02.json'))
+
+        env = dict(os.environ)
+        env['XDG_RUNTIME_DIR'] = runtime_dir
+        env['PYTHONPATH'] = os.pathsep.join(
+            [os.path.join(ROOT, 'lib'), env.get('PYTHONPATH', '')]
+        )
+
+        # don't ask an agent that may be running
+        socket_path = os.path.join(runtime_dir, 'azuremetadata.sock')
+
+        yield env, [sys.executable, SCRIPT, '--socket', socket_path]
+    finally:
+        shutil.rmtree(runtime_dir)
+
+
+def main():
+    if os.geteuid() == 0:
+        sys.exit('Run as a regular user, root does not use XDG_RUNTIME_DIR')
+
+    with cli_environment() as (env, command):
+        results = {'python': measure([sys.executable, '-c', 'pass'], env)}
+        for name, args in INVOCATIONS.items():
+            results[name] = measure(command + args, env)
+        print(json.dumps(results, indent=4))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,374 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2020 SUSE LLC
+#
+# This file is part of azuremetadata.
+#
+# azuremetadata is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# azuremetadata is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with azuremetadata.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmark the fetch, parse, query and render paths.
+
+Every case is timed with timeit: the number of calls per sample is
+chosen so that a sample takes at least 0.2 seconds, the median and the
+minimum time per call of the samples are reported as JSON.
+
+    suite.py [-o RESULTS] [-k PATTERN]   run the benchmarks
+    suite.py --compare BASELINE          run and compare to a baseline
+    suite.py --compare BASELINE RESULTS  compare saved results
+
+A comparison is printed as JSON as well. It lists the median of every
+case in both runs and their ratio, cases slower than the threshold are
+regressions and make the exit status 1.
+
+The fetch cases need the stub server, stub_server.py, which is started
+on its port 8888; the requests to 169.254.169.254 are sent there. The
+command-line cases run the tool from a temporary cache like startup.py
+and are skipped for root. Skipped groups are listed with the reason.
+"""
+
+import argparse
+import contextlib
+import datetime
+import fnmatch
+import io
+import json
+import os
+import platform
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import timeit
+from unittest import mock
+
+from documents import FIXTURES, generate_document, generate_lsblk
+from documents import load_fixture
+from startup import INVOCATIONS, ROOT, cli_environment
+
+from azuremetadata import azuremetadata
+from azuremetadata.azuremetadatautils import AzureMetadataUtils
+
+STUB_PORT = 8888
+
+# median slowdown reported as a regression
+DEFAULT_THRESHOLD = 0.1
+
+QUERIES = {
+    'leaf': ['--compute', '--vmId'],
+    'list-item': ['--network', '--interface', '0', '--macAddress'],
+    'deep': [
+        '--network', '--interface', '0', '--ipv4', '--ipAddress', '0',
+        '--privateIpAddress'
+    ],
+    'attested': ['--attestedData', '--signature'],
+}
+
+RENDER_MODES = {
+    'values': {},
+    'json': {'print_json': True},
+    'xml': {'print_xml': True},
+    'shell': {'print_shell': True},
+}
+
+
+class Skip(Exception):
+    """A group of cases cannot run here."""
+
+
+class StubPool(azuremetadata.ConnectionPool):
+    """ConnectionPool sending the requests to the stub server."""
+
+    def _acquire(self, host, port, reuse=True):
+        conn, reused = super()._acquire(host, port, reuse)
+        # idle connections stay filed under the metadata server
+        conn.host, conn.port = '127.0.0.1', STUB_PORT
+        return conn, reused
+
+
+@contextlib.contextmanager
+def stub_server():
+    """Run stub_server.py for the duration of the block."""
+    try:
+        socket.create_connection(('127.0.0.1', STUB_PORT), 1).close()
+    except OSError:
+        pass
+    else:
+        raise Skip('port {} is in use'.format(STUB_PORT))
+
+    proc = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, 'stub_server.py')], cwd=ROOT,
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+    )
+    try:
+        deadline = time.monotonic() + 10
+        while True:
+            if proc.poll() is not None:
+                error = proc.stderr.read().decode('utf-8', 'replace')
+                raise Skip('stub server failed: {}'.format(
+                    (error.strip().splitlines() or ['exit status {}'.format(
+                        proc.returncode
+                    )])[-1]
+                ))
+            try:
+                socket.create_connection(('127.0.0.1', STUB_PORT), 1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise Skip('stub server did not start')
+                time.sleep(0.05)
+        yield
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def fetch_cases():
+    with stub_server():
+        metadata = azuremetadata.AzureMetadata('2019-08-15', pool=StubPool())
+        yield 'fetch/get_all', metadata.get_all
+        yield 'fetch/get_instance_data', metadata.get_instance_data
+
+        def new_connection():
+            pool = StubPool()
+            azuremetadata.AzureMetadata('2019-08-15', pool=pool).get_all()
+            pool.close()
+
+        yield 'fetch/get_all-new-connection', new_connection
+
+
+def block_device_cases():
+    outputs = {
+        name[len('lsblk-'):-len('.json')] if name != 'lsblk.json'
+        else 'default': os.path.join(FIXTURES, name)
+        for name in sorted(os.listdir(FIXTURES))
+        if name.startswith('lsblk') and name.endswith('.json')
+    }
+    for name, path in outputs.items():
+        with open(path, 'rb') as fh:
+            outputs[name] = fh.read()
+    outputs['generated-64-disks'] = generate_lsblk()
+
+    # lsblk is used if sysfs does not lead to the disk
+    with mock.patch.object(
+            azuremetadata.AzureMetadata, '_find_block_device_sysfs',
+            return_value=None
+    ):
+        for name, output in outputs.items():
+            with mock.patch.object(
+                    azuremetadata.AzureMetadata, '_get_lsblk_output',
+                    return_value=(output, b'')
+            ):
+                yield (
+                    'block-device/lsblk-' + name,
+                    azuremetadata.AzureMetadata._find_block_device
+                )
+
+
+def utils_cases():
+    fixture = load_fixture('metadata-v2019-08-15.json')
+    fixture['attestedData'] = load_fixture('attested-data-v2019-08-15.json')
+    documents = {
+        'fixture': fixture,
+        'generated': generate_document(),
+        'generated-4k-tags': generate_document(tags=4000),
+    }
+
+    for name, document in documents.items():
+        yield 'utils/{}/construct'.format(name), \
+            lambda document=document: AzureMetadataUtils(document)
+
+        util = AzureMetadataUtils(document)
+        for query_name, arguments in QUERIES.items():
+            query = util.parse_query(arguments)
+            yield 'utils/{}/parse-query-{}'.format(name, query_name), \
+                lambda util=util, arguments=arguments: \
+                util.parse_query(arguments)
+            yield 'utils/{}/query-{}'.format(name, query_name), \
+                lambda util=util, query=query: util.query(list(query))
+
+        for mode, kwargs in RENDER_MODES.items():
+            yield 'utils/{}/render-{}'.format(name, mode), \
+                lambda util=util, kwargs=kwargs: \
+                util.print_pretty(file=io.StringIO(), **kwargs)
+        yield 'utils/{}/render-help'.format(name), \
+            lambda util=util: util._pretty_print(
+                util.PRINT_MODE_HELP, util.data, file=io.StringIO()
+            )
+
+
+def cli_cases():
+    if os.geteuid() == 0:
+        raise Skip('root does not use XDG_RUNTIME_DIR')
+
+    with cli_environment() as (env, command):
+        for name, args in INVOCATIONS.items():
+            yield 'cli/' + name, lambda args=args: subprocess.run(
+                command + args, env=env, stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL, check=True
+            )
+
+
+GROUPS = {
+    'fetch': fetch_cases,
+    'block-device': block_device_cases,
+    'utils': utils_cases,
+    'cli': cli_cases,
+}
+
+
+def measure(func, repeat):
+    """Return the median and minimum seconds per call of func."""
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    samples = [total / number for total in timer.repeat(repeat, number)]
+    return {
+        'median': statistics.median(samples),
+        'min': min(samples),
+        'number': number,
+        'repeat': repeat,
+    }
+
+
+def run(pattern, repeat):
+    results = {}
+    skipped = {}
+    for group, cases in GROUPS.items():
+        try:
+            for name, func in cases():
+                if pattern and not fnmatch.fnmatch(name, pattern):
+                    continue
+                print(name, file=sys.stderr)
+                results[name] = measure(func, repeat)
+        except Skip as e:
+            skipped[group] = str(e)
+
+    return {
+        'environment': environment(),
+        'results': results,
+        'skipped': skipped,
+    }
+
+
+def environment():
+    """Return what the results depend on besides the code."""
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=ROOT, stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL, check=True
+        ).stdout.decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        'date': datetime.datetime.utcnow().isoformat() + 'Z',
+        'commit': commit,
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+    }
+
+
+def compare(baseline, current, threshold):
+    """Return the comparison of two runs and the names of regressions."""
+    cases = {}
+    regressions = []
+    names = list(baseline['results'])
+    names += [name for name in current['results'] if name not in names]
+    for name in names:
+        old = baseline['results'].get(name)
+        new = current['results'].get(name)
+        if not old or not new:
+            cases[name] = {
+                'status': 'new' if new else 'missing',
+                'baseline': old and old['median'],
+                'current': new and new['median'],
+            }
+            continue
+
+        ratio = new['median'] / old['median'] if old['median'] else None
+        if ratio is None:
+            status = 'ok'
+        elif ratio > 1 + threshold:
+            status = 'regression'
+            regressions.append(name)
+        elif ratio < 1 / (1 + threshold):
+            status = 'improvement'
+        else:
+            status = 'ok'
+        cases[name] = {
+            'status': status,
+            'baseline': old['median'],
+            'current': new['median'],
+            'ratio': ratio,
+        }
+
+    return {
+        'threshold': threshold,
+        'baseline': baseline.get('environment'),
+        'current': current.get('environment'),
+        'cases': cases,
+        'regressions': regressions,
+    }, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument('-o', '--output', metavar='PATH',
+                        help="Write the results of the run to PATH, not "
+                             "stdout")
+    parser.add_argument('-k', '--filter', metavar='PATTERN',
+                        help="Run the cases matching the shell PATTERN only, "
+                             "e.g. 'utils/*/render-*'")
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help="Number of samples per case (default: 5)")
+    parser.add_argument('--compare', nargs='+',
+                        metavar=('BASELINE', 'RESULTS'),
+                        help="Compare to the results in BASELINE, those of "
+                             "this run or the ones in RESULTS")
+    parser.add_argument('--threshold', type=float,
+                        default=DEFAULT_THRESHOLD,
+                        help="Slowdown of the median counted as a "
+                             "regression (default: {})".format(
+                                 DEFAULT_THRESHOLD))
+    args = parser.parse_args()
+
+    if args.compare and len(args.compare) > 2:
+        parser.error('--compare takes a baseline and optionally results')
+
+    if args.compare and len(args.compare) == 2:
+        with open(args.compare[1]) as fh:
+            results = json.load(fh)
+    else:
+        results = run(args.filter, args.repeat)
+
+    if args.output:
+        with open(args.output, 'w') as fh:
+            fh.write(json.dumps(results, indent=4) + '\n')
+    elif not args.compare:
+        print(json.dumps(results, indent=4))
+
+    if args.compare:
+        with open(args.compare[0]) as fh:
+            baseline = json.load(fh)
+        comparison, regressions = compare(baseline, results, args.threshold)
+        print(json.dumps(comparison, indent=4))
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -15,65 +15,769 @@
 # You should have received a copy of the GNU General Public License
 # along with azuremetadata.  If not, see <http://www.gnu.org/licenses/>.
 
+import copy
+import errno
 import json
-import subprocess
-import uuid
-import urllib.error
-import urllib.request
+import os
+import random
+import re
+import stat
+import threading
 import sys
-from time import sleep
-from urllib.parse import quote
+from time import monotonic, sleep, time
+from urllib.parse import quote, urlsplit
 
+from azuremetadata.azuremetadatakvp import KvpPool
+from azuremetadata.azuremetadatatrace import span
 
-class AzureMetadata:
+# http.client, concurrent.futures, email.utils, subprocess and uuid are
+# imported where they are used, invocations answered from the cache or the
+# agent do not need them and short lived processes should not pay for them
+
+
+class RequestError(Exception):
+    """Raised for a failed request whose errors are not reported."""
+    pass
+
+
+class FetchPlan:
+    """Batch of independent requests executed concurrently.
+
+    Each request is registered under a name with the callable that
+    performs it; run() returns the results keyed by those names in the
+    order the requests were added.
+    """
+
+    def __init__(self):
+        self._requests = []
+
+    def __len__(self):
+        return len(self._requests)
+
+    def add(self, name, func, *args, **kwargs):
+        """Add a request to the plan and return the plan."""
+        self._requests.append((name, func, args, kwargs))
+        return self
+
+    def run(self):
+        """Execute all requests and return their results.
+
+        Exceptions raised by a request are re-raised once all requests
+        have finished.
+        """
+        if len(self._requests) <= 1:
+            return {
+                name: func(*args, **kwargs)
+                for name, func, args, kwargs in self._requests
+            }
+
+        import contextvars
+        from concurrent.futures import ThreadPoolExecutor
+
+        with span('fetch-plan', requests=[
+                name for name, _, _, _ in self._requests
+        ]), ThreadPoolExecutor(max_workers=len(self._requests)) as executor:
+            # the requests run in the context of the caller, e.g. in the
+            # span of the plan
+            futures = [
+                (name, executor.submit(
+                    contextvars.copy_context().run, func, *args, **kwargs
+                ))
+                for name, func, args, kwargs in self._requests
+            ]
+
+        return {name: future.result() for name, future in futures}
+
+
+def _is_stale_connection_error(error):
+    """Return whether error means a kept-alive connection was closed.
+
+    The server closes idle connections whenever it likes, a request on
+    such a connection fails without an answer. Other errors, e.g.
+    timeouts, would fail on a new connection just as well.
+    """
+    # http.client.RemoteDisconnected, the server closed the connection
+    # before sending a byte, is a ConnectionResetError
+    return isinstance(error, (BrokenPipeError, ConnectionResetError))
+
+
+class ConnectionPool:
+    """Pool of keep-alive HTTP connections.
+
+    Connections are kept open after a request and reused by the next
+    request to the same host, concurrent requests get a connection each.
+    """
+
+    def __init__(self, timeout=2):
+        self._timeout = timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def request(self, url, headers=None, timeout=None):
+        """Perform a GET request.
+
+        Return the status, reason, body and headers of the response.
+        OSError and http.client.HTTPException are raised on connection
+        failures. timeout overrides the pool timeout for this request.
+        """
+        import http.client
+
+        parts = urlsplit(url)
+        target = parts.path or '/'
+        if parts.query:
+            target += '?' + parts.query
+
+        conn, reused = self._acquire(parts.hostname, parts.port)
+        try:
+            response = self._send(conn, target, headers, timeout)
+        except (OSError, http.client.HTTPException) as e:
+            conn.close()
+            if not reused or not _is_stale_connection_error(e):
+                raise
+            # the server may have closed the idle connection in the
+            # meantime, try again once with a new one
+            conn, reused = self._acquire(
+                parts.hostname, parts.port, reuse=False
+            )
+            try:
+                response = self._send(conn, target, headers, timeout)
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                raise
+
+        status, reason, body, response_headers, will_close = response
+        if will_close:
+            conn.close()
+        else:
+            self._release(parts.hostname, parts.port, conn)
+
+        return status, reason, body, response_headers
+
+    def close(self):
+        """Close all idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+
+        for connections in idle.values():
+            for conn in connections:
+                conn.close()
+
+    def _acquire(self, host, port, reuse=True):
+        import http.client
+
+        if reuse:
+            with self._lock:
+                connections = self._idle.get((host, port))
+                if connections:
+                    return connections.pop(), True
+
+        return http.client.HTTPConnection(
+            host, port, timeout=self._timeout
+        ), False
+
+    def _release(self, host, port, conn):
+        with self._lock:
+            self._idle.setdefault((host, port), []).append(conn)
+
+    def _send(self, conn, target, headers, timeout):
+        timeout = self._timeout if timeout is None else timeout
+        conn.timeout = timeout
+        if conn.sock:
+            conn.sock.settimeout(timeout)
+
+        conn.request('GET', target, headers=headers or {})
+        response = conn.getresponse()
+        body = response.read()
+        return (
+            response.status, response.reason, body, response.headers,
+            response.will_close
+        )
+
+
+class RetryPolicy:
+    """Retry behaviour of metadata requests.
+
+    Failed requests are retried with exponential backoff and jitter until
+    the number of attempts is used up or the deadline is reached. The
+    deadline is an overall budget in seconds that starts when the policy
+    is created and is shared by all requests using the policy.
+    """
+
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+    # nothing is listening or there is no route, retrying will not help
+    FATAL_ERRNOS = (
+        errno.ECONNREFUSED, errno.EHOSTUNREACH, errno.ENETUNREACH
+    )
+
+    def __init__(
+            self, attempts=5, timeout=2, deadline=None, backoff=0.25,
+            max_backoff=2, jitter=0.5
+    ):
+        self.attempts = attempts
+        self.timeout = timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self._expires = None
+        if deadline is not None:
+            self._expires = monotonic() + deadline
+
+    def remaining(self):
+        """Return the seconds left until the deadline or None."""
+        if self._expires is None:
+            return None
+        return max(0, self._expires - monotonic())
+
+    def attempt_timeout(self):
+        """Return the timeout for the next attempt, 0 if out of time."""
+        remaining = self.remaining()
+        if remaining is None:
+            return self.timeout
+        return min(self.timeout, remaining)
+
+    def max_duration(self):
+        """Return the seconds a request can take at most.
+
+        The time is what all attempts and the longest delays between them
+        take, or less if the deadline is closer.
+        """
+        duration = self.attempts * (self.timeout + self.max_backoff)
+        remaining = self.remaining()
+        if remaining is not None:
+            return min(duration, remaining)
+        return duration
+
+    def is_retryable_status(self, status):
+        return status in self.RETRY_STATUSES
+
+    def is_retryable_error(self, error):
+        return getattr(error, 'errno', None) not in self.FATAL_ERRNOS
+
+    def delay(self, attempt, retry_after=None):
+        """Return the seconds to wait before the next attempt.
+
+        None is returned when no further attempt should be made. A
+        Retry-After of the server is honored up to max_backoff.
+        """
+        if attempt >= self.attempts:
+            return None
+
+        if retry_after is not None:
+            delay = min(self.max_backoff, retry_after)
+        else:
+            delay = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+            delay -= random.uniform(0, delay * self.jitter)
+
+        remaining = self.remaining()
+        if remaining is not None and delay >= remaining:
+            return None
+
+        return delay
+
+    @staticmethod
+    def parse_retry_after(value):
+        """Return the Retry-After header value in seconds or None."""
+        if not isinstance(value, str):
+            return None
+
+        try:
+            return max(0, float(value))
+        except ValueError:
+            pass
+
+        from email.utils import parsedate_to_datetime
+
+        try:
+            date = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+
+        return max(0, date.timestamp() - time())
+
+
+class _Flight:
+    """A fetch other threads are waiting for."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def wait(self):
+        """Return a copy of the result once the fetch has finished."""
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        # callers may modify the documents they get
+        return copy.deepcopy(self.result)
+
+
+class _MetadataBase:
+    """Logic shared by AzureMetadata and AsyncAzureMetadata.
+
+    Nothing in here performs I/O, the subclasses fetch the documents and
+    use these methods to build the requests and interpret the responses.
+    """
+
+    # top-level keys of the instance metadata, all of them are dicts
+    INSTANCE_ROOT_KEYS = ('compute', 'network')
+
+    # metadata server URLs, documents are cached under their endpoint
+    # name
+    _BASE_URL = 'http://169.254.169.254/metadata'
+    _ENDPOINT_PATHS = {
+        'instance': 'instance',
+        'attested': 'attested/document',
+    }
+    _VERSIONS_URL = _BASE_URL + '/versions'
+    # without an API version the server lists the newest versions
+    _UNVERSIONED_URL = _BASE_URL + '/instance'
+    # compute data is not available in ASM with this version
+    _CLASSIC_PROBE_URL = (
+        _BASE_URL + '/instance/compute?api-version=2019-11-01'
+    )
+    _REQUEST_HEADERS = {'Metadata': 'true'}
+
+    _BOOT_ID = '/proc/sys/kernel/random/boot_id'
+
+    DEFAULT_API_VERSION = '2017-04-02'
+
+    def __init__(self, cache=None, retry_policy=None, rate_limiter=None,
+                 kvp_pool=None):
+        self._cache = cache
+        self._retry_policy = retry_policy if retry_policy else RetryPolicy()
+        # every request, retries included, takes a token if there is a
+        # limiter, a RateLimiter from azuremetadataratelimit
+        self._rate_limiter = rate_limiter
+        self._kvp_pool = kvp_pool if kvp_pool else KvpPool()
+        self._api_version = self.DEFAULT_API_VERSION
+
+    @staticmethod
+    def has_attested_data(api_version):
+        """Return True if attested data is available in api_version."""
+        # 2018-10-01 seems to be the earliest version
+        # when attested metadata is available
+        return api_version >= '2018-10-01'
+
+    def get_kvp_data(self):
+        """Return the data the Hyper-V host provides about the VM.
+
+        It is read from the local KVP pools, e.g. VirtualMachineId and
+        HostName, and available if the metadata server is not. Return {}
+        if there are no pools.
+        """
+        with span('read-kvp'):
+            return self._kvp_pool.get_metadata()
+
+    @staticmethod
+    def merge_results(results):
+        """Merge FetchPlan results into a single metadata document."""
+        result = results.get('instance', {})
+        for name, value in results.items():
+            if name != 'instance':
+                result[name] = value
+
+        return result
+
+    def _document_url(self, endpoint, path=()):
+        """Return the cache endpoint and the URL of a document.
+
+        path is a sequence of keys and list indexes below the endpoint.
+        """
+        path = [quote(str(item), safe='') for item in path]
+        return '/'.join([endpoint] + path), '{}/{}?api-version={}'.format(
+            self._BASE_URL, '/'.join([self._ENDPOINT_PATHS[endpoint]] + path),
+            quote(self._api_version)
+        )
+
+    @staticmethod
+    def _request_failed(error, quiet=False):
+        """Report a request that got no response, return the result.
+
+        RequestError is raised instead if quiet is set.
+        """
+        if quiet:
+            raise RequestError(str(error)) from error
+        print("An error occurred when fetching metadata:", file=sys.stderr)
+        print(error, file=sys.stderr)
+        return {}
+
+    @staticmethod
+    def _parse_response(response, no_api=False, quiet=False):
+        """Return the document in a response, {} if there is none.
+
+        If quiet is set, None is returned for client errors, e.g. for a
+        path that does not exist, and RequestError is raised for other
+        errors instead of reporting them.
+        """
+        status, reason, data, _ = response
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+
+        if status >= 400:
+            # remove this case when versions API
+            # endpoint retrieves all the versions
+            if no_api and 'newest-versions' in data:
+                return data
+            if quiet:
+                if status < 500 and \
+                        status not in RetryPolicy.RETRY_STATUSES:
+                    return None
+                raise RequestError("HTTP Error {}: {}".format(status, reason))
+            print("An error occurred when fetching metadata:",
+                  file=sys.stderr)
+            print("HTTP Error {}: {}".format(status, reason),
+                  file=sys.stderr)
+            print(data, file=sys.stderr)
+            return {}
+
+        return json.loads(data)
+
+    def _retry_delay(self, attempt, response):
+        """Return the seconds to wait before retrying or None.
+
+        response is the response of the attempt or the error it failed
+        with. None is returned if the request is not to be retried.
+        """
+        policy = self._retry_policy
+        if isinstance(response, Exception):
+            if not policy.is_retryable_error(response):
+                return None
+            return policy.delay(attempt)
+
+        status, _, _, headers = response
+        if not policy.is_retryable_status(status):
+            return None
+        if status == 429 and self._rate_limiter:
+            # slow down the other requests sharing the limiter too
+            self._rate_limiter.throttled()
+
+        return policy.delay(
+            attempt, policy.parse_retry_after(headers.get('Retry-After'))
+        )
+
+    @classmethod
+    def _get_boot_id(cls):
+        """Return the ID of the current boot or None."""
+        try:
+            with open(cls._BOOT_ID) as fh:
+                return fh.read().strip() or None
+        except OSError:
+            return None
+
+    def _boot_lookup(self, name):
+        """Return the data cached under name in this boot or None.
+
+        The API versions the server offers and the deployment model
+        change with a redeployment at most, which reboots the instance.
+        """
+        boot_id = self._get_boot_id() if self._cache else None
+        if not boot_id:
+            return None
+
+        return self._cache.lookup(name, boot_id)
+
+    def _boot_store(self, name, data):
+        """Cache data under name until the next boot."""
+        boot_id = self._get_boot_id() if self._cache else None
+        if boot_id:
+            self._cache.store(name, boot_id, data)
+
+    def _unlisted_versions_result(self, no_api_version_result):
+        """Return the newest versions of an unversioned request.
+
+        They are cached for this boot if the request listed them.
+        """
+        newest_api = self._parse_unlisted_versions(no_api_version_result)
+        if no_api_version_result:
+            self._boot_store('newest-versions', newest_api)
+        return newest_api
+
+    @staticmethod
+    def _trace_response(trace, response):
+        """Set the outcome of the last attempt of a request span."""
+        if isinstance(response, Exception):
+            trace.set(status=None, error=type(response).__name__)
+        else:
+            trace.set(status=response[0], error=None)
+
+    @staticmethod
+    def _parse_api_versions(api_versions):
+        """Return the versions listed by the versions endpoint."""
+        if api_versions:
+            return sorted(api_versions.get('apiVersions', []), reverse=True)
+        # if something went wrong with the query
+        # default to oldest version
+        return ['2017-03-01']
+
+    @staticmethod
+    def _parse_unlisted_versions(no_api_version_result):
+        """Return the newest versions listed in an unversioned request."""
+        newest_api = ['2017-03-01']
+        if no_api_version_result:
+            data = json.loads(no_api_version_result)
+            newest_api = data['newest-versions']
+        return newest_api
+
+
+class AzureMetadata(_MetadataBase):
     """Class for querying Azure instance metadata."""
 
-    def __init__(self, api_version=None):
+    _MOUNTINFO = '/proc/self/mountinfo'
+    _SYS_DEV_BLOCK = '/sys/dev/block'
+
+    def __init__(
+            self, api_version=None, cache=None, pool=None, retry_policy=None,
+            rate_limiter=None, kvp_pool=None
+    ):
+        super().__init__(cache, retry_policy, rate_limiter, kvp_pool)
+        # all requests of an instance share keep-alive connections
+        self._pool = pool if pool else ConnectionPool()
+        # documents being fetched, concurrent calls wait for those
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
         self.set_api_version(api_version)
 
-    def get_all(self):
+    def close(self):
+        """Close the connections to the metadata server."""
+        self._pool.close()
+
+    def get_all(self, kvp=False):
         """Return all metadata.
 
         Return instance metadata and, if attested data is available in
-        api version, attested data.
+        api version, attested data. The data of the Hyper-V KVP pools is
+        added as 'kvp' if kvp is set.
         """
-        result = self.get_instance_data()
+        plan = self.fetch_plan()
+        if kvp:
+            plan.add('kvp', self.get_kvp_data)
+        return self.merge_results(plan.run())
 
-        # 2018-10-01 seems to be the earliest version
-        # when attested metadata is available
-        if self._api_version >= '2018-10-01':
-            result['attestedData'] = self.get_attested_data()
+    def fetch_plan(self):
+        """Return a FetchPlan with the requests needed by get_all.
 
-        return result
+        Further requests can be added to the plan, their results are
+        merged by merge_results() under the name they were added with.
+        """
+        plan = FetchPlan()
+        plan.add('instance', self.get_instance_data)
+        if self.has_attested_data(self._api_version):
+            plan.add('attestedData', self.get_attested_data)
+
+        return plan
+
+    def get_document(self, disk_tag=False, device=None, classic=None,
+                     kvp=False):
+        """Return all metadata as presented by the azuremetadata tool.
+
+        On top of get_all() this covers instances in ASM, aka Classic, and
+        adds the disk tag as billingTag if disk_tag is set. classic may be
+        passed if the result of is_classic() is known already. kvp is
+        passed to get_all().
+        """
+        data = {}
+        if classic is None:
+            # known without a request after the first probe in this boot
+            classic = self._boot_lookup('classic')
+
+        # ASM gets retired in 2023, rip this code out, it's ugly!
+        if classic:
+            # Set the api version to the first implementation, it works in ASM
+            self.set_api_version('2017-04-02')
+        # End code removal in 2023
+
+        # The ASM probe, the disk tag and the instance metadata are
+        # independent of each other, fetch them all at once. Attested data
+        # fails with a retried 500 in ASM, it waits for the probe.
+        attested = self.has_attested_data(self._api_version)
+        plan = FetchPlan()
+        plan.add('instance', self.get_instance_data)
+        if attested and classic is False:
+            plan.add('attestedData', self.get_attested_data)
+        if classic is None:
+            plan.add('classic', self.is_classic)
+        if disk_tag:
+            plan.add('billingTag', self.get_disk_tag, device)
+        if kvp:
+            plan.add('kvp', self.get_kvp_data)
+        results = plan.run()
+
+        # ASM gets retired in 2023, rip this code out, it's ugly!
+        if classic is None and results.pop('classic'):
+            self.set_api_version('2017-04-02')
+            results.update(self.fetch_plan().run())
+            classic = True
+        if classic:
+            data.update(self._get_classic_data())
+        # End code removal in 2023
+
+        if not classic and attested and 'attestedData' not in results:
+            results['attestedData'] = self.get_attested_data()
+
+        if 'billingTag' in results:
+            data['billingTag'] = results.pop('billingTag')
+
+        data.update(self.merge_results(results))
+        return data
+
+    def get_cached_data(self):
+        """Return the metadata documents found in the cache.
+
+        Nothing is fetched, return None if the instance metadata is not
+        cached. Attested data is included if it is cached too.
+        """
+        if not self._cache:
+            return None
+
+        data = self._cache.get('instance', self._api_version)
+        if data is None:
+            return None
+
+        results = {'instance': data}
+        attested_data = self._cache.get('attested', self._api_version)
+        if attested_data is not None:
+            results['attestedData'] = attested_data
+
+        return self.merge_results(results)
+
+    def is_classic(self):
+        """Return True if the instance is deployed with ASM, aka Classic.
+
+        Heuristic data: When requesting compute data with a newer API
+        version in ASM it results in a 404 response, that's the best thing
+        we have to go on to figure out whether or not we are in ASM.
+        """
+        import http.client
+
+        # ASM gets retired in 2023, rip this code out, it's ugly!
+        with span('classic-probe') as trace:
+            classic = self._boot_lookup('classic')
+            trace.set(cached=classic is not None)
+            if classic is not None:
+                return classic
+
+            try:
+                status, _, _, _ = self._request(self._CLASSIC_PROBE_URL)
+            except (OSError, http.client.HTTPException):
+                # no way to tell, the metadata requests will report the
+                # error
+                return False
+
+            # the probe fails with 404 in ASM only, errors tell nothing
+            if status == 404 or status < 400:
+                self._boot_store('classic', status == 404)
+
+            return status == 404
 
     def get_instance_data(self):
-        return self._make_request(
-            "http://169.254.169.254/metadata/instance?api-version={}"
-            .format(quote(self._api_version))
-        )
+        return self._get_document(*self._document_url('instance'))
 
     def get_attested_data(self):
-        return self._make_request(
-            "http://169.254.169.254/metadata/attested/document?api-version={}"
-            .format(quote(self._api_version))
+        return self._get_document(*self._document_url('attested'))
+
+    def get_instance_path(self, path, quiet=False):
+        """Return the part of the instance metadata at path.
+
+        path is a sequence of keys and list indexes below
+        /metadata/instance, e.g. ('network', 'interface', 0). If quiet is
+        set errors are not reported: None is returned if there is nothing
+        at path and RequestError is raised if the request failed.
+        """
+        return self._get_document(
+            *self._document_url('instance', path), quiet=quiet
         )
 
+    def get_query_data(self, query):
+        """Return the smallest document that can answer query.
+
+        query is a list of (key, index) tuples as taken by
+        AzureMetadataUtils.query(). Only the part of the metadata the
+        query refers to is fetched and returned with the same structure
+        the full document has. Return None if the query cannot be
+        answered from a part of the metadata, the full document must be
+        used then. That is the case for queries going on after their
+        first value, the keys at the top level depend on all of the
+        metadata. RequestError is raised if the request failed.
+        """
+        if not query:
+            return None
+
+        key = query[0][0]
+        if key == 'attestedData' and len(query) > 1:
+            if not self.has_attested_data(self._api_version):
+                return None
+            path = [key]
+            data = self._get_document(
+                *self._document_url('attested'), quiet=True
+            )
+        elif key in self.INSTANCE_ROOT_KEYS and len(query) > 1:
+            # The last key is a child of the path, so the path points to
+            # a dict or a list that can be fetched as JSON. Only the root
+            # keys are known to be dicts, stop at the first key without
+            # an index as it may refer to a list.
+            path = [key]
+            for key, index in query[1:-1]:
+                path.append(key)
+                if isinstance(index, bool):
+                    break
+                path.append(index)
+
+            data = self.get_instance_path(path, quiet=True)
+        else:
+            return None
+
+        if data is None:
+            return None
+
+        for item in reversed(path):
+            if isinstance(item, int):
+                # pad the list so that the item stays at its index
+                data = [{}] * item + [data]
+            else:
+                data = {item: data}
+
+        if not self._is_single_value_query(data, query):
+            return None
+
+        return data
+
     def get_disk_tag(self, device=None):
         if not device:
-            device = self._find_block_device()
+            with span('find-block-device') as trace:
+                device = self._find_block_device()
+                trace.set(device=device)
 
         if not device:
             return ''
 
+        # the tag does not change as long as the disk stays the same,
+        # spare the device read if it is known already
+        identity = None
+        if self._cache:
+            identity = self._get_device_identity(device)
+            if identity:
+                tag = self._cache.lookup('disktag', identity)
+                if tag:
+                    return tag
+
+        import uuid
+
         try:
-            with open(device, 'rb') as fh:
+            with span('read-disk-tag', device=device), \
+                    open(device, 'rb') as fh:
                 fh.seek(65536)
-                return str(uuid.UUID(bytes_le=fh.read(16)))
+                tag = str(uuid.UUID(bytes_le=fh.read(16)))
         except OSError as e:
             print("An error occurred when reading disk tag:", file=sys.stderr)
             print(e, file=sys.stderr)
             return ''
 
+        if identity:
+            self._cache.store('disktag', identity, tag)
+
+        return tag
+
     def list_api_versions(self):
         # currently, there is no other way to query
         # for API versions, so the newest ones are
@@ -83,13 +787,167 @@ class AzureMetadata:
     def set_api_version(self, api_version):
         """Set the API version to use for queries"""
         if not api_version:
-            self._api_version = '2017-04-02'
+            self._api_version = self.DEFAULT_API_VERSION
         else:
             self._api_version = self._get_api(api_version)
 
+    @staticmethod
+    def _is_single_value_query(data, query):
+        """Return True if query ends at its first value in data.
+
+        The keys are looked up below each other the way
+        AzureMetadataUtils does, a query ending at a dict or a list or
+        not found in data returns False.
+        """
+        node = data
+        for position, (key, index) in enumerate(query, 1):
+            value = node.get(key) if isinstance(node, dict) else None
+            if value is None:
+                return False
+
+            if isinstance(index, bool):
+                index = 0
+            if isinstance(value, list) and -len(value) <= index < len(value):
+                node = value[index]
+            elif isinstance(value, dict):
+                node = value
+            else:
+                return position == len(query)
+
+        return False
+
+    def _get_document(self, endpoint, url, quiet=False):
+        """Return the document from the cache or fetch it from url.
+
+        Concurrent calls for the same document share a single fetch, the
+        first call fetches it and the others wait for its result.
+        """
+        key = (endpoint, self._api_version)
+        with self._inflight_lock:
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = _Flight()
+
+        if not leader:
+            return flight.wait()
+
+        try:
+            flight.result = self._fetch_document(endpoint, url, quiet)
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._inflight_lock:
+                del self._inflight[key]
+            flight.done.set()
+
+        return flight.result
+
+    def _fetch_document(self, endpoint, url, quiet=False):
+        with span('document', endpoint=endpoint) as trace:
+            return self._fetch_document_traced(endpoint, url, quiet, trace)
+
+    def _fetch_document_traced(self, endpoint, url, quiet, trace):
+        trace.set(source='server')
+        if not self._cache:
+            return self._make_request(url, quiet=quiet)
+
+        data = self._cache.get(endpoint, self._api_version)
+        if data is not None:
+            trace.set(source='cache')
+            return data
+
+        # Other processes may be fetching the document right now, wait
+        # for them and use their result instead of fetching it again. A
+        # process holding the lock for longer than a fetch takes is stuck,
+        # fetch the document without the lock then.
+        started = time()
+        with self._cache.lock(
+                endpoint, self._api_version,
+                timeout=self._retry_policy.max_duration()
+        ):
+            data = self._cache.get(
+                endpoint, self._api_version, newer_than=started
+            )
+            if data is not None:
+                # fetched by another process in the meantime
+                trace.set(source='cache-wait')
+                return data
+
+            data = self._make_request(url, quiet=quiet)
+
+            # errors are signaled with an empty result, don't cache those
+            if data:
+                self._cache.set(endpoint, self._api_version, data)
+
+        return data
+
+    def _get_classic_data(self):
+        """Return the data standing in for what ASM does not provide."""
+        data = {}
+        # Special code for SUSE, ugh becasue we know what we are
+        # looking for there is unfortunately no better way.
+        vm_id = self.get_kvp_data().get('VirtualMachineId')
+        if vm_id is not None:
+            data['subscriptionId'] = 'classic-{}'.format(vm_id.lower())
+        else:
+            data['subscriptionId'] = 'classic-{}'.format(
+                random.randint(0, 10 ** 9)
+            )
+        # ensuring that --attestedData --signature and
+        # --signature are available
+        data['attestedData'] = {}
+        data['attestedData']['signature'] = ''
+        data['signature'] = ''
+        return data
+
+    @staticmethod
+    def _get_device_identity(device):
+        """Return a string identifying the block device in this boot.
+
+        It is made of the device number, the serial or WWN of the disk
+        and the boot ID. Return None if device is not a block device.
+        """
+        try:
+            st = os.stat(device)
+        except OSError:
+            return None
+
+        if not stat.S_ISBLK(st.st_mode):
+            return None
+
+        devnum = '{}:{}'.format(os.major(st.st_rdev), os.minor(st.st_rdev))
+        path = os.path.realpath(
+            os.path.join(AzureMetadata._SYS_DEV_BLOCK, devnum)
+        )
+        if os.path.exists(os.path.join(path, 'partition')):
+            path = os.path.dirname(path)
+
+        serial = ''
+        for name in ('wwid', 'device/wwid', 'serial', 'device/serial'):
+            try:
+                with open(os.path.join(path, name)) as fh:
+                    serial = fh.read().strip()
+            except OSError:
+                continue
+            if serial:
+                break
+
+        boot_id = AzureMetadata._get_boot_id()
+        if not boot_id:
+            return None
+
+        return '{}|{}|{}'.format(devnum, serial, boot_id)
+
     @staticmethod
     def _find_block_device(mountpoint="/"):
         """Return detected root device path or None if detection failed."""
+        device = AzureMetadata._find_block_device_sysfs(mountpoint)
+        if device:
+            return device
+
+        # sysfs did not lead to a disk, let lsblk have a go
         out, err = AzureMetadata._get_lsblk_output()
 
         if err or not out:
@@ -109,13 +967,106 @@ class AzureMetadata:
             return None
 
     @staticmethod
-    def _get_lsblk_output():
-        proc = subprocess.Popen(
-            ["lsblk", "--json"],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
+    def _find_block_device_sysfs(mountpoint="/"):
+        """Return the disk holding mountpoint or None if it is not found.
+
+        The device of the mountpoint is looked up in mountinfo and followed
+        through partitions and device mapper/md slaves down to the disk.
+        """
+        devnum = AzureMetadata._get_mount_devnum(mountpoint)
+        if not devnum:
+            return None
+
+        disks = AzureMetadata._get_sysfs_disks(
+            os.path.join(AzureMetadata._SYS_DEV_BLOCK, devnum)
         )
-        out, err = proc.communicate()
+        if not disks:
+            return None
+
+        # device mapper may span several disks, pick the first one as
+        # lsblk would list it
+        return '/dev/{}'.format(sorted(disks)[0].replace('!', '/'))
+
+    @staticmethod
+    def _get_mount_devnum(mountpoint):
+        """Return 'major:minor' of the device mounted at mountpoint."""
+        devnum = None
+        source = None
+        try:
+            with open(AzureMetadata._MOUNTINFO) as fh:
+                for line in fh:
+                    fields = line.split()
+                    try:
+                        separator = fields.index('-', 6)
+                    except ValueError:
+                        continue
+                    if AzureMetadata._unescape_mount(fields[4]) == mountpoint:
+                        # later mounts hide earlier ones
+                        devnum = fields[2]
+                        source = fields[separator + 2]
+        except OSError:
+            return None
+
+        if devnum and devnum.startswith('0:'):
+            # e.g. btrfs uses anonymous device numbers, the mount source
+            # tells the real device
+            try:
+                rdev = os.stat(AzureMetadata._unescape_mount(source)).st_rdev
+            except (OSError, TypeError):
+                return None
+            if not rdev:
+                return None
+            devnum = '{}:{}'.format(os.major(rdev), os.minor(rdev))
+
+        return devnum
+
+    @staticmethod
+    def _get_sysfs_disks(path):
+        """Return the names of the disks underlying the sysfs device."""
+        path = os.path.realpath(path)
+        if not os.path.isdir(path):
+            return []
+
+        if os.path.exists(os.path.join(path, 'partition')):
+            path = os.path.dirname(path)
+
+        slaves_path = os.path.join(path, 'slaves')
+        try:
+            slaves = sorted(os.listdir(slaves_path))
+        except OSError:
+            slaves = []
+
+        if not slaves:
+            return [os.path.basename(path)]
+
+        disks = []
+        for slave in slaves:
+            for disk in AzureMetadata._get_sysfs_disks(
+                    os.path.join(slaves_path, slave)
+            ):
+                if disk not in disks:
+                    disks.append(disk)
+
+        return disks
+
+    @staticmethod
+    def _unescape_mount(value):
+        """Decode the octal escapes mountinfo uses for whitespace."""
+        return re.sub(
+            r'\\([0-7]{3})', lambda match: chr(int(match.group(1), 8)), value
+        )
+
+    @staticmethod
+    def _get_lsblk_output():
+        import subprocess
+
+        with span('lsblk'):
+            proc = subprocess.Popen(
+                ["lsblk", "--json"],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE
+            )
+            out, err = proc.communicate()
 
         return out, err
 
@@ -136,76 +1087,86 @@ class AzureMetadata:
 
         return False
 
-    @staticmethod
-    def _make_request(url, no_api=False):
-        tries = 0
-        last_error = None
-        while tries < 5:
+    def _make_request(self, url, no_api=False, quiet=False):
+        import http.client
+
+        try:
+            response = self._request(url)
+        except (OSError, http.client.HTTPException) as e:
+            return self._request_failed(e, quiet)
+
+        return self._parse_response(response, no_api, quiet)
+
+    def _request(self, url):
+        """Perform a request, retrying as defined by the retry policy.
+
+        Return the last response, raise the last error if the request
+        did not get any response.
+        """
+        with span('request', url=url) as trace:
+            return self._request_traced(url, trace)
+
+    def _request_traced(self, url, trace):
+        import http.client
+
+        policy = self._retry_policy
+        attempt = 0
+        while True:
+            if self._rate_limiter:
+                with span('rate-limit') as wait_trace:
+                    wait_trace.set(wait=self._rate_limiter.acquire(
+                        max_wait=policy.remaining()
+                    ))
+
+            timeout = policy.attempt_timeout()
+            if timeout <= 0:
+                raise TimeoutError("Deadline exceeded")
+
+            attempt += 1
+            trace.set(attempts=attempt)
             try:
-                req = urllib.request.Request(url, headers={'Metadata': 'true'})
-                response = urllib.request.urlopen(req, timeout=2)
-
-                data = response.read()
-                if isinstance(data, bytes):
-                    data = data.decode('utf-8')
-                return json.loads(data)
-            except urllib.error.HTTPError as e:
-                # remove this case when versions API
-                # endpoint retrieves all the versions
-                if no_api:
-                    err = e.read()
-                    if isinstance(err, bytes):
-                        err = err.decode('utf-8')
-                    if 'newest-versions' in err:
-                        return err
-                print("An error occurred when fetching metadata:",
-                      file=sys.stderr)
-                print(e, file=sys.stderr)
-                print(e.read(), file=sys.stderr)
-                return {}
-            except OSError as e:
-                tries += 1
-                last_error = e
-                # Sleep a second before retrying again with
-                # the hope that network goes up
-                sleep(1)
+                response = self._pool.request(
+                    url, headers=self._REQUEST_HEADERS, timeout=timeout
+                )
+            except (OSError, http.client.HTTPException) as e:
+                response = e
+            self._trace_response(trace, response)
 
-        print("An error occurred when fetching metadata:", file=sys.stderr)
-        print(last_error, file=sys.stderr)
-        return {}
+            delay = self._retry_delay(attempt, response)
+            if delay is None:
+                if isinstance(response, Exception):
+                    raise response
+                return response
 
-    @staticmethod
-    def _get_api(api_version):
+            with span('retry-sleep', attempt=attempt, delay=delay):
+                sleep(delay)
+
+    def _get_api(self, api_version):
         """Return the latest API version available if 'latest' provided or api_version."""
         if api_version == 'latest':
             # the endpoint GET /metadata/versions
             # does not return all the API versions
             # excluding the version that returns license type inside attested data
             # when that gets fixed, use _get_api_newest_versions() method
-            api_newest_versions = AzureMetadata._get_api_unlisted_versions()
+            api_newest_versions = self._get_api_unlisted_versions()
             api_version = api_newest_versions[0]
         return api_version
 
-    @staticmethod
-    def _get_api_newest_versions():
-        api_versions = AzureMetadata._make_request(
-            "http://169.254.169.254/metadata/versions"
+    def _get_api_newest_versions(self):
+        return self._parse_api_versions(
+            self._make_request(self._VERSIONS_URL)
         )
-        if api_versions:
-            return sorted(api_versions.get('apiVersions', []), reverse=True)
-        # if something went wrong with the query
-        # default to oldest version
-        return ['2017-03-01']
 
-    @staticmethod
-    def _get_api_unlisted_versions():
-        newest_api = ['2017-03-01']
-        # When no API version is specified,
-        # the response includes a list of the newest supported versions.
-        no_api_version_result = AzureMetadata._make_request(
-            "http://169.254.169.254/metadata/instance", True
-        )
-        if no_api_version_result:
-            data = json.loads(no_api_version_result)
-            newest_api = data['newest-versions']
-        return newest_api
+    def _get_api_unlisted_versions(self):
+        with span('negotiate-api-version') as trace:
+            # The request fails on purpose, don't repeat it in every run
+            newest_api = self._boot_lookup('newest-versions')
+            trace.set(cached=bool(newest_api))
+            if newest_api:
+                return newest_api
+
+            # When no API version is specified,
+            # the response includes a list of the newest supported versions.
+            return self._unlisted_versions_result(
+                self._make_request(self._UNVERSIONED_URL, True)
+            )
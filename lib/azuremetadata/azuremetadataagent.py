@@ -0,0 +1,255 @@
+# Copyright (c) 2020 SUSE LLC
+#
+# This file is part of azuremetadata.
+#
+# azuremetadata is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# azuremetadata is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with azuremetadata.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import socket
+import struct
+import sys
+import threading
+
+from azuremetadata.azuremetadatatrace import span
+from azuremetadata.azuremetadatautils import (
+    AzureMetadataUtils, QueryArgumentError, QueryException
+)
+
+DEFAULT_SOCKET_PATH = '/run/azuremetadata.sock'
+
+
+class AgentError(Exception):
+    pass
+
+
+class MetadataAgent:
+    """Serve metadata over a Unix domain socket.
+
+    The metadata document is kept in memory and refreshed in the
+    background. Clients send one JSON request per line and get one JSON
+    response per line:
+
+        {"op": "query", "api": null, "query": [["compute", true], ...]}
+        {"op": "query", "api": null, "args": ["--compute", ...]}
+        {"op": "document", "api": null}
+
+    A query is given either parsed or as command line arguments. The
+    response holds either "result" or "error" and "type", where type is
+    "query" for query errors and "argument" for arguments that cannot be
+    parsed. Requests for another API version than
+    the one the agent was started with are refused.
+    """
+
+    # only root can read the disk tag, don't hand it out to others
+    ROOT_ONLY_KEYS = ('billingTag',)
+
+    def __init__(
+            self, metadata_factory, socket_path=DEFAULT_SOCKET_PATH,
+            refresh_interval=60, api_version=None, disk_tag=False,
+            device=None
+    ):
+        # each refresh gets a new AzureMetadata, so that retry deadlines
+        # apply to a single refresh
+        self._metadata_factory = metadata_factory
+        self._socket_path = socket_path
+        self._refresh_interval = refresh_interval
+        self._api_version = api_version
+        self._disk_tag = disk_tag
+        self._device = device
+        self._utils = None
+        self._server = None
+        self._stop = threading.Event()
+
+    def refresh(self):
+        """Fetch the metadata, keep the previous data on failure."""
+        data = self._metadata_factory().get_document(
+            disk_tag=self._disk_tag, device=self._device
+        )
+        # the document still has the other parts, e.g. the disk tag, if
+        # the instance metadata could not be fetched
+        if not data.get('compute'):
+            return False
+
+        public_data = {
+            key: value for key, value in data.items()
+            if key not in self.ROOT_ONLY_KEYS
+        }
+        # swap both at once, requests being served keep their view
+        self._utils = (
+            AzureMetadataUtils(data), AzureMetadataUtils(public_data)
+        )
+        return True
+
+    def handle_request(self, request, uid=None):
+        """Return the response to a decoded request."""
+        if not isinstance(request, dict):
+            return {'error': 'Invalid request', 'type': 'request'}
+
+        if request.get('api') != self._api_version:
+            return {'error': 'Unsupported API version', 'type': 'request'}
+
+        utils = self._utils
+        if not utils:
+            return {'error': 'No metadata available', 'type': 'request'}
+        util = utils[0] if uid == 0 else utils[1]
+
+        op = request.get('op')
+        if op == 'document':
+            return {'result': util.data}
+
+        if op == 'query':
+            try:
+                if 'args' in request:
+                    query = util.parse_query(
+                        [str(item) for item in request['args']]
+                    )
+                else:
+                    query = [
+                        tuple(item) for item in request.get('query', [])
+                    ]
+                return {'result': util.query(query)}
+            except QueryArgumentError as e:
+                return {'error': str(e), 'type': 'argument'}
+            except QueryException as e:
+                return {'error': str(e), 'type': 'query'}
+            except (TypeError, ValueError):
+                return {'error': 'Invalid query', 'type': 'request'}
+
+        return {'error': 'Unknown operation', 'type': 'request'}
+
+    def serve_forever(self):
+        """Serve requests until shutdown() is called."""
+        import socketserver
+
+        self.refresh()
+        refresher = threading.Thread(target=self._refresh_loop, daemon=True)
+        refresher.start()
+
+        if os.path.exists(self._socket_path):
+            os.unlink(self._socket_path)
+
+        agent = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                uid = agent._get_peer_uid(self.connection)
+                for line in self.rfile:
+                    try:
+                        request = json.loads(line.decode('utf-8'))
+                    except ValueError:
+                        response = {
+                            'error': 'Invalid request', 'type': 'request'
+                        }
+                    else:
+                        response = agent.handle_request(request, uid)
+                    self.wfile.write(json.dumps(response).encode() + b'\n')
+                    self.wfile.flush()
+
+        self._server = socketserver.ThreadingUnixStreamServer(
+            self._socket_path, Handler
+        )
+        self._server.daemon_threads = True
+        os.chmod(self._socket_path, 0o666)
+
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+            try:
+                os.unlink(self._socket_path)
+            except OSError:
+                pass
+
+    def shutdown(self):
+        self._stop.set()
+        if self._server:
+            self._server.shutdown()
+
+    def _refresh_loop(self):
+        while not self._stop.wait(self._refresh_interval):
+            try:
+                self.refresh()
+            except Exception as e:
+                print("An error occurred when refreshing metadata:",
+                      file=sys.stderr)
+                print(e, file=sys.stderr)
+
+    @staticmethod
+    def _get_peer_uid(connection):
+        try:
+            creds = connection.getsockopt(
+                socket.SOL_SOCKET, socket.SO_PEERCRED,
+                struct.calcsize('3i')
+            )
+        except (AttributeError, OSError):
+            return None
+
+        _, uid, _ = struct.unpack('3i', creds)
+        return uid
+
+
+class AgentClient:
+    """Client of a MetadataAgent."""
+
+    def __init__(self, socket_path=DEFAULT_SOCKET_PATH, timeout=1):
+        self._socket_path = socket_path
+        self._timeout = timeout
+
+    def available(self):
+        return os.path.exists(self._socket_path)
+
+    def query(self, query, api_version=None):
+        """Return the result of the query.
+
+        QueryException is raised if the query fails, AgentError if the
+        agent cannot answer.
+        """
+        return self._call({
+            'op': 'query', 'api': api_version,
+            'query': [list(item) for item in query]
+        })
+
+    def query_arguments(self, arguments, api_version=None):
+        """Return the result of the query given by command line arguments.
+
+        QueryArgumentError is raised if the arguments cannot be parsed.
+        """
+        return self._call({
+            'op': 'query', 'api': api_version, 'args': list(arguments)
+        })
+
+    def get_document(self, api_version=None):
+        return self._call({'op': 'document', 'api': api_version})
+
+    def _call(self, request):
+        try:
+            with span('agent', op=request['op']), \
+                    socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.settimeout(self._timeout)
+                sock.connect(self._socket_path)
+                sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+                with sock.makefile('rb') as fh:
+                    response = json.loads(fh.readline().decode('utf-8'))
+        except (OSError, ValueError) as e:
+            raise AgentError(str(e))
+
+        if 'error' in response:
+            if response.get('type') == 'argument':
+                raise QueryArgumentError(response['error'])
+            if response.get('type') == 'query':
+                raise QueryException(response['error'])
+            raise AgentError(response['error'])
+
+        return response.get('result')
@@ -0,0 +1,460 @@
+# Copyright (c) 2020 SUSE LLC
+#
+# This file is part of azuremetadata.
+#
+# azuremetadata is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# azuremetadata is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with azuremetadata.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import copy
+import http.client
+import io
+from time import time
+from urllib.parse import urlsplit
+
+from azuremetadata.azuremetadata import (
+    AzureMetadata, _MetadataBase, _is_stale_connection_error
+)
+from azuremetadata.azuremetadatatrace import span
+
+
+class AsyncConnectionPool:
+    """Pool of keep-alive HTTP connections on asyncio streams.
+
+    The asyncio counterpart of ConnectionPool, requests return the same
+    tuples and raise the same errors.
+    """
+
+    # as enforced by http.client
+    _MAX_LINE = 65536
+    _MAX_HEADERS = 100
+
+    def __init__(self, timeout=2):
+        self._timeout = timeout
+        self._idle = {}
+
+    async def request(self, url, headers=None, timeout=None):
+        """Perform a GET request.
+
+        Return the status, reason, body and headers of the response.
+        OSError and http.client.HTTPException are raised on connection
+        failures, TimeoutError if there is no response within timeout
+        seconds, which overrides the pool timeout for this request.
+        """
+        parts = urlsplit(url)
+        target = parts.path or '/'
+        if parts.query:
+            target += '?' + parts.query
+        address = (parts.hostname, parts.port or 80)
+        request = self._format_request(target, address, headers)
+        timeout = self._timeout if timeout is None else timeout
+
+        conn = self._acquire(address)
+        try:
+            response, conn = await self._send(conn, address, request, timeout)
+        except (OSError, http.client.HTTPException) as e:
+            if conn is None or not _is_stale_connection_error(e):
+                raise
+            # the server may have closed the idle connection in the
+            # meantime, try again once with a new one
+            response, conn = await self._send(None, address, request, timeout)
+
+        status, reason, body, response_headers, will_close = response
+        if will_close:
+            conn[1].close()
+        else:
+            self._idle.setdefault(address, []).append(conn)
+
+        return status, reason, body, response_headers
+
+    async def close(self):
+        """Close all idle connections."""
+        idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for _, writer in connections:
+                writer.close()
+                try:
+                    await writer.wait_closed()
+                except OSError:
+                    pass
+
+    def _acquire(self, address):
+        connections = self._idle.get(address, [])
+        while connections:
+            reader, writer = connections.pop()
+            if not reader.at_eof() and not writer.is_closing():
+                return reader, writer
+            writer.close()
+        return None
+
+    async def _send(self, conn, address, request, timeout):
+        """Send request on conn or a new connection, return the response.
+
+        The connection is returned with the response, it is closed if
+        the request fails, times out or gets cancelled.
+        """
+        try:
+            return await asyncio.wait_for(
+                self._exchange(conn, address, request), timeout
+            )
+        except asyncio.TimeoutError:
+            # asyncio.TimeoutError is not an OSError before Python 3.11
+            raise TimeoutError('timed out')
+
+    async def _exchange(self, conn, address, request):
+        if conn is None:
+            conn = await asyncio.open_connection(*address)
+
+        reader, writer = conn
+        try:
+            writer.write(request)
+            await writer.drain()
+            response = await self._read_response(reader)
+        except BaseException:
+            writer.close()
+            raise
+
+        return response, conn
+
+    @staticmethod
+    def _format_request(target, address, headers):
+        host, port = address
+        if port != 80:
+            host = '{}:{}'.format(host, port)
+        lines = [
+            'GET {} HTTP/1.1'.format(target),
+            'Host: {}'.format(host),
+            'Accept-Encoding: identity',
+        ]
+        for name, value in (headers or {}).items():
+            lines.append('{}: {}'.format(name, value))
+
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+    async def _read_response(self, reader):
+        line = await self._readline(reader)
+        if not line:
+            raise http.client.RemoteDisconnected(
+                'Remote end closed connection without response'
+            )
+
+        try:
+            version, status, reason = (
+                line.decode('iso-8859-1').rstrip('\r\n').split(None, 2) + ['']
+            )[:3]
+            status = int(status)
+        except ValueError:
+            raise http.client.BadStatusLine(line)
+        if not version.startswith('HTTP/') or not 100 <= status <= 999:
+            raise http.client.BadStatusLine(line)
+
+        lines = []
+        while True:
+            line = await self._readline(reader)
+            lines.append(line)
+            if line in (b'\r\n', b'\n', b''):
+                break
+            if len(lines) > self._MAX_HEADERS:
+                raise http.client.HTTPException(
+                    'got more than {} headers'.format(self._MAX_HEADERS)
+                )
+        headers = http.client.parse_headers(io.BytesIO(b''.join(lines)))
+
+        connection = headers.get('Connection', '').lower()
+        will_close = 'close' in connection or (
+            version == 'HTTP/1.0' and 'keep-alive' not in connection
+        )
+
+        try:
+            if status in (204, 304) or status < 200:
+                body = b''
+            elif 'chunked' in headers.get('Transfer-Encoding', '').lower():
+                body = await self._read_chunked(reader)
+            elif headers.get('Content-Length') is not None:
+                try:
+                    length = int(headers['Content-Length'])
+                except ValueError:
+                    raise http.client.HTTPException(
+                        'invalid Content-Length'
+                    )
+                body = await reader.readexactly(length)
+            else:
+                body = await reader.read()
+                will_close = True
+        except asyncio.IncompleteReadError as e:
+            raise http.client.IncompleteRead(e.partial, e.expected)
+
+        return status, reason.strip(), body, headers, will_close
+
+    async def _read_chunked(self, reader):
+        chunks = []
+        while True:
+            line = await self._readline(reader)
+            try:
+                size = int(line.split(b';', 1)[0], 16)
+            except ValueError:
+                raise http.client.IncompleteRead(b''.join(chunks))
+            if not size:
+                break
+            chunks.append(await reader.readexactly(size))
+            await self._readline(reader)
+
+        # trailers
+        while await self._readline(reader) not in (b'\r\n', b'\n', b''):
+            pass
+
+        return b''.join(chunks)
+
+    async def _readline(self, reader):
+        try:
+            line = await reader.readline()
+        except ValueError:
+            raise http.client.LineTooLong('line')
+        if len(line) > self._MAX_LINE:
+            raise http.client.LineTooLong('line')
+        return line
+
+
+class AsyncAzureMetadata(_MetadataBase):
+    """Class for querying Azure instance metadata from asyncio code.
+
+    The coroutines match the methods of AzureMetadata, without blocking
+    the event loop. Requests of get_all() run concurrently, timeouts and
+    retry delays are cancellable, and cancelling a call cancels its
+    requests. Requests, responses and API versions are handled by the
+    code AzureMetadata uses.
+    """
+
+    def __init__(
+            self, api_version=None, cache=None, pool=None, retry_policy=None,
+            rate_limiter=None, kvp_pool=None
+    ):
+        super().__init__(cache, retry_policy, rate_limiter, kvp_pool)
+        self._pool = pool if pool else AsyncConnectionPool()
+        # documents being fetched, concurrent calls wait for those
+        self._inflight = {}
+        # 'latest' needs a request, it is resolved by the first call
+        self._pending_api_version = None
+        if api_version == 'latest':
+            self._pending_api_version = api_version
+        elif api_version:
+            self._api_version = api_version
+
+    async def close(self):
+        """Close the connections to the metadata server."""
+        await self._pool.close()
+
+    async def get_all(self, kvp=False):
+        """Return all metadata.
+
+        Return instance metadata and, if attested data is available in
+        api version, attested data. The data of the Hyper-V KVP pools is
+        added as 'kvp' if kvp is set.
+        """
+        await self._resolve_api_version()
+        names = ['instance']
+        requests = [self.get_instance_data()]
+        if self.has_attested_data(self._api_version):
+            names.append('attestedData')
+            requests.append(self.get_attested_data())
+
+        results = dict(zip(names, await asyncio.gather(*requests)))
+        if kvp:
+            # local files, mapped rather than read
+            results['kvp'] = self.get_kvp_data()
+        return self.merge_results(results)
+
+    async def get_instance_data(self):
+        await self._resolve_api_version()
+        return await self._get_document(*self._document_url('instance'))
+
+    async def get_attested_data(self):
+        await self._resolve_api_version()
+        return await self._get_document(*self._document_url('attested'))
+
+    async def get_instance_path(self, path, quiet=False):
+        """Return the part of the instance metadata at path.
+
+        See AzureMetadata.get_instance_path().
+        """
+        await self._resolve_api_version()
+        return await self._get_document(
+            *self._document_url('instance', path), quiet=quiet
+        )
+
+    async def get_disk_tag(self, device=None):
+        """Return the disk tag, it is read in a worker thread."""
+        # the tag is read from the local disk, no metadata request is
+        # involved
+        metadata = AzureMetadata(cache=self._cache)
+        return await asyncio.get_event_loop().run_in_executor(
+            None, metadata.get_disk_tag, device
+        )
+
+    async def list_api_versions(self):
+        return self._parse_api_versions(
+            await self._make_request(self._VERSIONS_URL)
+        )
+
+    async def set_api_version(self, api_version):
+        """Set the API version to use for queries"""
+        if not api_version:
+            self._api_version = self.DEFAULT_API_VERSION
+        elif api_version == 'latest':
+            # see AzureMetadata._get_api()
+            newest_api = self._boot_lookup('newest-versions')
+            if not newest_api:
+                newest_api = self._unlisted_versions_result(
+                    await self._make_request(self._UNVERSIONED_URL, True)
+                )
+            self._api_version = newest_api[0]
+        else:
+            self._api_version = api_version
+        self._pending_api_version = None
+
+    async def _resolve_api_version(self):
+        if self._pending_api_version:
+            await self._get_shared(
+                ('api-version',), self.set_api_version,
+                self._pending_api_version
+            )
+
+    async def _get_document(self, endpoint, url, quiet=False):
+        """Return the document from the cache or fetch it from url.
+
+        Concurrent calls for the same document share a single fetch.
+        """
+        data = await self._get_shared(
+            (endpoint, self._api_version),
+            self._fetch_document, endpoint, url, quiet
+        )
+        # callers may modify the documents they get
+        return copy.deepcopy(data)
+
+    async def _get_shared(self, key, func, *args):
+        """Return the result of func(*args) run once for all callers.
+
+        Calls with the same key while func runs wait for its result. func
+        is cancelled when all of its callers are cancelled.
+        """
+        flight = self._inflight.get(key)
+        if flight is None:
+            task = asyncio.ensure_future(func(*args))
+            flight = self._inflight[key] = [task, 0]
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+
+        task = flight[0]
+        flight[1] += 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if flight[1] == 1:
+                task.cancel()
+            raise
+        finally:
+            flight[1] -= 1
+
+    async def _fetch_document(self, endpoint, url, quiet=False):
+        with span('document', endpoint=endpoint) as trace:
+            return await self._fetch_document_traced(
+                endpoint, url, quiet, trace
+            )
+
+    async def _fetch_document_traced(self, endpoint, url, quiet, trace):
+        trace.set(source='server')
+        if not self._cache:
+            return await self._make_request(url, quiet=quiet)
+
+        data = self._cache.get(endpoint, self._api_version)
+        if data is not None:
+            trace.set(source='cache')
+            return data
+
+        # Other processes may be fetching the document right now, wait
+        # for them and use their result instead of fetching it again, as
+        # long as a fetch takes at most. The lock is polled, waiting for
+        # it must not block the loop.
+        started = time()
+        expires = started + self._retry_policy.max_duration()
+        while True:
+            with self._cache.lock(
+                    endpoint, self._api_version, timeout=0
+            ) as locked:
+                # None if there is no lock to wait for
+                if locked is not False or time() >= expires:
+                    data = self._cache.get(
+                        endpoint, self._api_version, newer_than=started
+                    )
+                    if data is not None:
+                        # fetched by another process in the meantime
+                        trace.set(source='cache-wait')
+                        return data
+
+                    data = await self._make_request(url, quiet=quiet)
+
+                    # errors are signaled with an empty result, don't
+                    # cache those
+                    if data:
+                        self._cache.set(endpoint, self._api_version, data)
+
+                    return data
+
+            await asyncio.sleep(0.01)
+
+    async def _make_request(self, url, no_api=False, quiet=False):
+        try:
+            response = await self._request(url)
+        except (OSError, http.client.HTTPException) as e:
+            return self._request_failed(e, quiet)
+
+        return self._parse_response(response, no_api, quiet)
+
+    async def _request(self, url):
+        """Perform a request, retrying as defined by the retry policy.
+
+        See AzureMetadata._request().
+        """
+        with span('request', url=url) as trace:
+            return await self._request_traced(url, trace)
+
+    async def _request_traced(self, url, trace):
+        policy = self._retry_policy
+        attempt = 0
+        while True:
+            if self._rate_limiter:
+                wait = self._rate_limiter.reserve(max_wait=policy.remaining())
+                with span('rate-limit', wait=wait):
+                    await asyncio.sleep(wait)
+
+            timeout = policy.attempt_timeout()
+            if timeout <= 0:
+                raise TimeoutError("Deadline exceeded")
+
+            attempt += 1
+            trace.set(attempts=attempt)
+            try:
+                response = await self._pool.request(
+                    url, headers=self._REQUEST_HEADERS, timeout=timeout
+                )
+            except (OSError, http.client.HTTPException) as e:
+                response = e
+            self._trace_response(trace, response)
+
+            delay = self._retry_delay(attempt, response)
+            if delay is None:
+                if isinstance(response, Exception):
+                    raise response
+                return response
+
+            with span('retry-sleep', attempt=attempt, delay=delay):
+                await asyncio.sleep(delay)
@@ -0,0 +1,230 @@
+# Copyright (c) 2020 SUSE LLC
+#
+# This file is part of azuremetadata.
+#
+# azuremetadata is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# azuremetadata is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with azuremetadata.  If not, see <http://www.gnu.org/licenses/>.
+
+import fcntl
+import json
+import os
+import time
+
+from contextlib import contextmanager
+
+
+def default_cache_dir():
+    """Return the default cache directory or None if there is none.
+
+    root uses /run/azuremetadata, other users get a directory in their
+    runtime directory, if the session provides one.
+    """
+    if os.geteuid() == 0:
+        return '/run/azuremetadata'
+
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        return os.path.join(runtime_dir, 'azuremetadata')
+
+    return None
+
+
+class ResponseCache:
+    """On-disk cache for metadata documents.
+
+    Entries are keyed by endpoint and API version and expire after the
+    TTL configured for their endpoint.
+    """
+
+    DEFAULT_TTLS = {
+        'instance': 300,
+        # attested data carries a signature, keep it short lived so that
+        # it gets refreshed well before it expires
+        'attested': 60,
+    }
+
+    def __init__(
+            self, path=None, ttls=None, refresh=False, refresh_lookups=True
+    ):
+        self._path = path if path else default_cache_dir()
+        self._ttls = dict(self.DEFAULT_TTLS)
+        if ttls:
+            self._ttls.update(ttls)
+        # in refresh mode entries are never read, only (re)written
+        self._refresh = refresh
+        # whether refresh mode applies to the entries of lookup() too,
+        # e.g. the disk tag, which do not go stale while their key matches
+        self._refresh_lookups = refresh and refresh_lookups
+
+    @property
+    def path(self):
+        return self._path
+
+    def get(self, endpoint, api_version, newer_than=None):
+        """Return cached data or None if missing or expired.
+
+        If newer_than is given only data stored at or after that time is
+        returned, regardless of its TTL and of refresh mode.
+        """
+        if not self._path or (self._refresh and newer_than is None):
+            return None
+
+        entry = self._read(self._entry_name(endpoint, api_version))
+        if not entry:
+            return None
+
+        if newer_than is not None:
+            if entry.get('timestamp', 0) < newer_than:
+                return None
+            return entry.get('data')
+
+        # parts of a document, e.g. 'instance/compute', expire like the
+        # whole document
+        ttl = self._ttls.get(endpoint.split('/')[0], 0)
+        age = time.time() - entry.get('timestamp', 0)
+        # a timestamp from the future means the clock jumped, don't trust it
+        if age < 0 or age > ttl:
+            return None
+
+        return entry.get('data')
+
+    def set(self, endpoint, api_version, data):
+        """Store data atomically, failures are silently ignored."""
+        self._write(
+            self._entry_name(endpoint, api_version),
+            {'timestamp': time.time(), 'data': data}
+        )
+
+    @contextmanager
+    def lock(self, endpoint, api_version, timeout=None):
+        """Hold the lock of an entry, e.g. while fetching its data.
+
+        Processes fetching the same data take turns, those that had to
+        wait can pick up the data stored by the first one with get() and
+        newer_than. Yield True if the lock is held, False if it was not
+        free within timeout seconds and None if there is no lock, e.g.
+        without a cache directory.
+        """
+        fd = None
+        if self._path:
+            try:
+                os.makedirs(self._path, mode=0o700, exist_ok=True)
+                fd = os.open(
+                    os.path.join(
+                        self._path,
+                        self._entry_name(endpoint, api_version, '.lock')
+                    ),
+                    os.O_RDWR | os.O_CREAT, 0o600
+                )
+            except OSError:
+                fd = None
+
+        try:
+            yield None if fd is None else self._flock(fd, timeout)
+        finally:
+            if fd is not None:
+                # releases the lock
+                os.close(fd)
+
+    def lookup(self, name, key):
+        """Return the data stored under name if it was stored with key.
+
+        Unlike documents these entries do not expire, they are valid as
+        long as the key they were stored with matches.
+        """
+        if not self._path or self._refresh_lookups:
+            return None
+
+        entry = self._read(name + '.json')
+        if not entry or entry.get('key') != key:
+            return None
+
+        return entry.get('data')
+
+    def store(self, name, key, data):
+        """Store data under name along with the key it is valid for."""
+        self._write(name + '.json', {'key': key, 'data': data})
+
+    def clear(self):
+        """Remove all cached entries."""
+        if not self._path:
+            return
+
+        try:
+            names = os.listdir(self._path)
+        except OSError:
+            return
+
+        for name in names:
+            if name.endswith('.json'):
+                try:
+                    os.unlink(os.path.join(self._path, name))
+                except OSError:
+                    pass
+
+    def _read(self, name):
+        try:
+            with open(os.path.join(self._path, name)) as fh:
+                entry = json.load(fh)
+        except (OSError, ValueError):
+            return None
+
+        return entry if isinstance(entry, dict) else None
+
+    def _write(self, name, entry):
+        if not self._path:
+            return
+
+        import tempfile
+
+        try:
+            os.makedirs(self._path, mode=0o700, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self._path, prefix='.tmp-')
+        except OSError:
+            return
+
+        try:
+            with os.fdopen(fd, 'w') as fh:
+                json.dump(entry, fh)
+            os.replace(tmp_path, os.path.join(self._path, name))
+        except (OSError, TypeError, ValueError):
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+
+    @staticmethod
+    def _flock(fd, timeout):
+        try:
+            if timeout is None:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                return True
+
+            expires = time.monotonic() + timeout
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    return True
+                except BlockingIOError:
+                    if time.monotonic() >= expires:
+                        return False
+                    time.sleep(0.01)
+        except OSError:
+            # e.g. no locking on the file system
+            return None
+
+    @staticmethod
+    def _entry_name(endpoint, api_version, suffix='.json'):
+        return '{}-{}{}'.format(endpoint, api_version, suffix).replace(
+            '/', '_'
+        )
@@ -0,0 +1,478 @@
+# Copyright (c) 2020 SUSE LLC
+#
+# This file is part of azuremetadata.
+#
+# azuremetadata is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# azuremetadata is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with azuremetadata.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import fnmatch
+import itertools
+import json
+import os
+import sys
+
+from azuremetadata.azuremetadatautils import AzureMetadataUtils
+
+# concurrent.futures and sqlite3 are imported where they are used, the
+# command line tool imports this module for every invocation
+
+# a file holds a single snapshot, a stream one snapshot per line
+SNAPSHOT_SUFFIXES = ('.json',)
+STREAM_SUFFIXES = ('.ndjson', '.jsonl')
+
+DEFAULT_CHUNK_SIZE = 64
+
+
+def list_sources(paths):
+    """Generate the snapshot files and streams in paths.
+
+    Directories are searched for files with the snapshot and stream
+    suffixes, in the order of their paths; files are taken as they are
+    and '-' stands for a stream on standard input.
+    """
+    for path in paths:
+        if path != '-' and os.path.isdir(path):
+            sources = []
+            for root, _, names in os.walk(path):
+                sources.extend(
+                    os.path.join(root, name) for name in names
+                    if name.endswith(SNAPSHOT_SUFFIXES + STREAM_SUFFIXES)
+                )
+            yield from sorted(sources)
+        else:
+            yield path
+
+
+def read_snapshots(source):
+    """Generate the name, the line number, the text and the read error
+    of the snapshots in source.
+
+    Snapshots in a stream are named after the stream and their line,
+    e.g. 'fleet.ndjson:12'; the line number of a snapshot file is 0.
+    Snapshots that cannot be read, e.g. because they are no UTF-8 text,
+    come with the error instead of the text. If source cannot be read
+    at all the error is reported under the name of source.
+    """
+    try:
+        if source == '-':
+            yield from _read_stream(sys.stdin.buffer, source)
+        elif source.endswith(STREAM_SUFFIXES):
+            with open(source, 'rb') as fh:
+                yield from _read_stream(fh, source)
+        else:
+            with open(source, encoding='utf-8') as fh:
+                text = fh.read()
+            yield source, 0, text, None
+    except (OSError, UnicodeDecodeError) as e:
+        yield source, 0, None, str(e)
+
+
+def _read_stream(fh, source):
+    # lines are decoded one by one, so that a bad one spoils only itself
+    for line_number, line in enumerate(fh, 1):
+        if not line.strip():
+            continue
+
+        name = '{}:{}'.format(source, line_number)
+        try:
+            yield name, line_number, line.decode('utf-8'), None
+        except UnicodeDecodeError as e:
+            yield name, line_number, None, str(e)
+
+
+def answer_text(value):
+    """Return an answer as text, values that are no scalars as JSON."""
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return str(value)
+
+
+def evaluate(text, queries):
+    """Return the answers to queries on the snapshot in text.
+
+    The answers map every query to a (value, error) tuple, error is None
+    if the query succeeded. ValueError is raised if text holds no
+    metadata document.
+    """
+    data = json.loads(text)
+    if not isinstance(data, dict):
+        raise ValueError('not a metadata document')
+
+    util = AzureMetadataUtils(data)
+    return {
+        query: (util.result_value(result) if error is None else None, error)
+        for query, (result, error) in zip(
+            queries, util.query_batch(queries)
+        )
+    }
+
+
+def _evaluate_chunk(queries, chunk):
+    """Return the answers to queries on each snapshot of chunk.
+
+    chunk is a list of (name, source, line, text, error) tuples as
+    generated by read_snapshots(), they are returned with the answers or
+    the error in place of the text.
+    """
+    results = []
+    for name, source, line, text, error in chunk:
+        if error is not None:
+            results.append((name, source, line, None, error))
+            continue
+        try:
+            results.append((name, source, line, evaluate(text, queries), None))
+        except ValueError as e:
+            # json.JSONDecodeError is a ValueError
+            results.append((name, source, line, None, str(e)))
+    return results
+
+
+def _map_chunks(func, chunks, processes):
+    """Generate func(chunk) for every chunk, in the order of the chunks.
+
+    The chunks are passed to a pool of processes, a few at a time, so
+    that the snapshots are read no faster than they are evaluated.
+    """
+    if processes == 1:
+        yield from map(func, chunks)
+        return
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    processes = processes or os.cpu_count() or 1
+    pending = collections.deque()
+    with ProcessPoolExecutor(processes) as executor:
+        try:
+            for chunk in chunks:
+                pending.append(executor.submit(func, chunk))
+                if len(pending) >= 2 * processes:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            # the caller stopped early
+            for future in pending:
+                future.cancel()
+
+
+def _chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _matches(text, pattern):
+    return fnmatch.fnmatchcase(text, pattern)
+
+
+def _record(name, answers, error, select):
+    """Return the result of a snapshot as reported to the caller."""
+    if error is not None:
+        return {'snapshot': name, 'error': error}
+
+    record = {'snapshot': name, 'results': {}}
+    errors = {}
+    for query in select:
+        value, query_error = answers[query]
+        if query_error is None:
+            record['results'][query] = value
+        else:
+            errors[query] = query_error
+    if errors:
+        record['errors'] = errors
+    return record
+
+
+class FleetQuery:
+    """Queries run on the saved metadata of many instances.
+
+    The snapshots are the --json output of the command line tool, or
+    get_all() documents, in files, directories or NDJSON streams.
+    select are the queries to answer, given as strings like the lines of
+    a query file, e.g. '--compute --vmId'. where is a sequence of
+    (query, pattern) tuples: only snapshots where the answer to every
+    query matches the shell pattern, e.g. 'Standard_D*', are reported.
+
+    The snapshots are parsed by a pool of processes, processes defaults
+    to the number of CPUs, 1 evaluates them in this process.
+    """
+
+    def __init__(self, select=(), where=(), processes=None,
+                 chunk_size=DEFAULT_CHUNK_SIZE):
+        self.select = list(select)
+        self.where = [tuple(condition) for condition in where]
+        self.processes = processes
+        self.chunk_size = chunk_size
+
+    @property
+    def queries(self):
+        """All queries answered for each snapshot, without duplicates."""
+        return list(dict.fromkeys(
+            self.select + [query for query, _ in self.where]
+        ))
+
+    def run(self, paths):
+        """Generate a record for each snapshot in paths.
+
+        Records are dicts with the name of the snapshot and either the
+        results of the selected queries, plus the errors of the failed
+        ones if any, or the error that kept the snapshot from being
+        parsed. Snapshots not matching where are skipped.
+        """
+        import functools
+
+        snapshots = (
+            (name, source, line, text, error)
+            for source in list_sources(paths)
+            for name, line, text, error in read_snapshots(source)
+        )
+        for results in _map_chunks(
+                functools.partial(_evaluate_chunk, self.queries),
+                _chunked(snapshots, self.chunk_size), self.processes
+        ):
+            for name, _, _, answers, error in results:
+                if error is None and not self.match(answers):
+                    continue
+                yield _record(name, answers, error, self.select)
+
+    def match(self, answers):
+        """Return True if the answers of a snapshot match where."""
+        for query, pattern in self.where:
+            value, error = answers[query]
+            if error is not None or \
+                    not _matches(answer_text(value), pattern):
+                return False
+        return True
+
+
+class FleetIndex:
+    """On-disk index of the answers to queries on many snapshots.
+
+    The index is a SQLite database. update() evaluates the snapshots
+    that are new or changed since the last update, search() answers
+    queries from the index without reading any snapshot.
+    """
+
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS sources (
+            source TEXT PRIMARY KEY,
+            mtime INTEGER,
+            size INTEGER
+        );
+        CREATE TABLE IF NOT EXISTS queries (
+            query TEXT PRIMARY KEY
+        );
+        CREATE TABLE IF NOT EXISTS snapshots (
+            id INTEGER PRIMARY KEY,
+            source TEXT,
+            line INTEGER,
+            name TEXT,
+            error TEXT
+        );
+        CREATE INDEX IF NOT EXISTS snapshots_source
+            ON snapshots (source, line);
+        CREATE TABLE IF NOT EXISTS answers (
+            snapshot INTEGER,
+            query TEXT,
+            value TEXT,
+            text TEXT,
+            error TEXT,
+            PRIMARY KEY (snapshot, query)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS answers_text ON answers (query, text);
+    """
+
+    def __init__(self, path):
+        import sqlite3
+
+        self.path = path
+        self._db = sqlite3.connect(path)
+        self._db.executescript(self._SCHEMA)
+        self._db.create_function(
+            'fnmatch', 2, _matches, deterministic=True
+        )
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def queries(self):
+        """The queries answered for every snapshot in the index."""
+        return [
+            query for query, in
+            self._db.execute('SELECT query FROM queries ORDER BY query')
+        ]
+
+    def update(self, paths, queries=(), processes=None,
+               chunk_size=DEFAULT_CHUNK_SIZE):
+        """Update the index to the snapshots in paths.
+
+        The queries are added to the ones already indexed; if there are
+        new ones all snapshots are evaluated again, otherwise only the
+        sources changed since the last update. Sources no longer in
+        paths are dropped. Return the number of 'evaluated', 'unchanged'
+        and 'removed' sources.
+        """
+        import functools
+
+        indexed = set(self.queries)
+        queries = sorted(indexed.union(queries))
+        refresh = indexed != set(queries)
+        stats = {'evaluated': 0, 'unchanged': 0, 'removed': 0}
+        seen = set()
+
+        def stale_snapshots():
+            for source in list_sources(paths):
+                if source == '-':
+                    raise ValueError('standard input cannot be indexed')
+                if source in seen:
+                    continue
+                seen.add(source)
+
+                try:
+                    info = os.stat(source)
+                    state = (info.st_mtime_ns, info.st_size)
+                except OSError as e:
+                    # reported like a source that cannot be read, and
+                    # evaluated again by the next update
+                    state = (None, None)
+                    error = str(e)
+                else:
+                    error = None
+                if error is None and not refresh and self._db.execute(
+                        'SELECT mtime, size FROM sources WHERE source = ?',
+                        (source,)
+                ).fetchone() == state:
+                    stats['unchanged'] += 1
+                    continue
+
+                stats['evaluated'] += 1
+                self._remove_source(source)
+                self._db.execute(
+                    'INSERT INTO sources VALUES (?, ?, ?)',
+                    (source,) + state
+                )
+                if error is not None:
+                    yield source, source, 0, None, error
+                    continue
+                for name, line, text, error in read_snapshots(source):
+                    yield name, source, line, text, error
+
+        with self._db:
+            self._db.executemany(
+                'INSERT OR IGNORE INTO queries VALUES (?)',
+                [(query,) for query in queries]
+            )
+            for results in _map_chunks(
+                    functools.partial(_evaluate_chunk, queries),
+                    _chunked(stale_snapshots(), chunk_size), processes
+            ):
+                self._store(results)
+
+            for source, in self._db.execute(
+                    'SELECT source FROM sources'
+            ).fetchall():
+                if source not in seen:
+                    stats['removed'] += 1
+                    self._remove_source(source)
+
+        return stats
+
+    def _remove_source(self, source):
+        self._db.execute(
+            'DELETE FROM answers WHERE snapshot IN '
+            '(SELECT id FROM snapshots WHERE source = ?)', (source,)
+        )
+        self._db.execute('DELETE FROM snapshots WHERE source = ?', (source,))
+        self._db.execute('DELETE FROM sources WHERE source = ?', (source,))
+
+    def _store(self, results):
+        for name, source, line, answers, error in results:
+            snapshot = self._db.execute(
+                'INSERT INTO snapshots (source, line, name, error) '
+                'VALUES (?, ?, ?, ?)', (source, line, name, error)
+            ).lastrowid
+            if answers is None:
+                continue
+            self._db.executemany(
+                'INSERT INTO answers VALUES (?, ?, ?, ?, ?)', [
+                    (snapshot, query,
+                     json.dumps(value) if error is None else None,
+                     answer_text(value) if error is None else None,
+                     error)
+                    for query, (value, error) in answers.items()
+                ]
+            )
+
+    def search(self, select=(), where=()):
+        """Generate the records FleetQuery(select, where) would.
+
+        The snapshots are in the order of the paths of their sources.
+        ValueError is raised if a query is not in the index.
+        """
+        select = list(select)
+        where = [tuple(condition) for condition in where]
+        missing = set(select + [query for query, _ in where]) - \
+            set(self.queries)
+        if missing:
+            raise ValueError('not indexed: {}'.format(
+                ', '.join(sorted(missing))
+            ))
+
+        conditions = []
+        params = []
+        for query, pattern in where:
+            # a pattern without wildcards can be looked up in the index
+            if any(char in pattern for char in '*?['):
+                test = 'fnmatch(text, ?)'
+            else:
+                test = 'text = ?'
+            conditions.append(
+                'EXISTS (SELECT 1 FROM answers WHERE snapshot = id AND '
+                'query = ? AND error IS NULL AND {})'.format(test)
+            )
+            params.extend((query, pattern))
+
+        sql = 'SELECT id, name, error FROM snapshots'
+        if conditions:
+            # snapshots that could not be parsed are always reported
+            sql += ' WHERE error IS NOT NULL OR ({})'.format(
+                ' AND '.join(conditions)
+            )
+        sql += ' ORDER BY source, line'
+
+        answers_sql = 'SELECT query, value, error FROM answers ' \
+            'WHERE snapshot = ? AND query IN ({})'.format(
+                ', '.join('?' * len(select))
+            )
+        for snapshot, name, error in self._db.execute(sql, params):
+            answers = {}
+            if error is None and select:
+                for query, value, query_error in self._db.execute(
+                        answers_sql, [snapshot] + select
+                ):
+                    answers[query] = (
+                        json.loads(value) if query_error is None else None,
+                        query_error
+                    )
+            yield _record(name, answers, error, select)
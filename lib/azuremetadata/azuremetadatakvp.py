@@ -0,0 +1,132 @@
+# Copyright (c) 2020 SUSE LLC
+#
+# This file is part of azuremetadata.
+#
+# azuremetadata is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# azuremetadata is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with azuremetadata.  If not, see <http://www.gnu.org/licenses/>.
+
+import fcntl
+import mmap
+import os
+import re
+
+DEFAULT_KVP_DIR = '/var/lib/hyperv'
+
+# records are a NUL padded key and value
+KEY_SIZE = 512
+VALUE_SIZE = 2048
+RECORD_SIZE = KEY_SIZE + VALUE_SIZE
+
+# pools of hv_kvp_daemon, the host provides the data about the VM, e.g.
+# VirtualMachineId and HostName, in the auto external pool
+POOL_EXTERNAL = 0
+POOL_GUEST = 1
+POOL_AUTO = 2
+POOL_AUTO_EXTERNAL = 3
+POOL_AUTO_INTERNAL = 4
+
+_POOL_FILE = re.compile(r'^\.kvp_pool_(\d+)$')
+
+
+class KvpPool:
+    """Reader of the Hyper-V data exchange (KVP) pools.
+
+    hv_kvp_daemon keeps the key/value pairs the host and the guest
+    exchange in .kvp_pool_<number> files. All pool files are mapped
+    into memory and indexed the first time a value is looked up; the
+    data is local, no request is made.
+    """
+
+    def __init__(self, directory=DEFAULT_KVP_DIR):
+        self.directory = directory
+        self._pools = None
+
+    @property
+    def pools(self):
+        """Map of the pool numbers to dicts of their keys and values."""
+        if self._pools is None:
+            self._pools = self._load()
+        return self._pools
+
+    def get(self, key, default=None, pool=POOL_AUTO_EXTERNAL):
+        """Return the value of key in pool or default."""
+        return self.pools.get(pool, {}).get(key, default)
+
+    def get_metadata(self):
+        """Return the host-provided data about the VM as a dict."""
+        return dict(self.pools.get(POOL_AUTO_EXTERNAL, {}))
+
+    def _load(self):
+        pools = {}
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return pools
+
+        for name in sorted(names):
+            match = _POOL_FILE.match(name)
+            if match:
+                records = self._read_pool(os.path.join(self.directory, name))
+                if records is not None:
+                    pools[int(match.group(1))] = records
+
+        return pools
+
+    @classmethod
+    def _read_pool(cls, path):
+        """Return the records in the pool file at path, None on errors."""
+        try:
+            with open(path, 'rb') as fh:
+                # hv_kvp_daemon locks the pool while it writes it
+                fcntl.lockf(fh, fcntl.LOCK_SH)
+                try:
+                    size = os.fstat(fh.fileno()).st_size
+                    if size < RECORD_SIZE:
+                        return {}
+                    with mmap.mmap(
+                            fh.fileno(), 0, access=mmap.ACCESS_READ
+                    ) as pool:
+                        return cls._parse_records(pool, size)
+                finally:
+                    fcntl.lockf(fh, fcntl.LOCK_UN)
+        except OSError:
+            return None
+
+    @staticmethod
+    def _parse_records(pool, size):
+        """Return the keys and values of the records in pool.
+
+        Only the keys and values are copied out of the mapping, not
+        their padding. A partial record at the end is ignored.
+        """
+        records = {}
+        for offset in range(0, size - RECORD_SIZE + 1, RECORD_SIZE):
+            key_end = pool.find(b'\x00', offset, offset + KEY_SIZE)
+            if key_end == offset:
+                continue
+            if key_end < 0:
+                key_end = offset + KEY_SIZE
+
+            value_start = offset + KEY_SIZE
+            value_end = pool.find(
+                b'\x00', value_start, value_start + VALUE_SIZE
+            )
+            if value_end < 0:
+                value_end = value_start + VALUE_SIZE
+
+            key = pool[offset:key_end].decode('utf-8', 'replace')
+            records[key] = pool[value_start:value_end].decode(
+                'utf-8', 'replace'
+            )
+
+        return records
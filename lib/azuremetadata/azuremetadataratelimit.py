@@ -0,0 +1,204 @@
+# Copyright (c) 2020 SUSE LLC
+#
+# This file is part of azuremetadata.
+#
+# azuremetadata is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# azuremetadata is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with azuremetadata.  If not, see <http://www.gnu.org/licenses/>.
+
+import fcntl
+import math
+import os
+import stat
+import struct
+import threading
+from time import monotonic, sleep
+
+# shared by all users, root creates it sticky and world-writable like /tmp
+SHARED_STATE_DIR = '/run/azuremetadata-ratelimit'
+
+
+def default_state_path():
+    """Return the default rate limiter state file."""
+    return os.path.join(SHARED_STATE_DIR, 'state')
+
+
+class RateLimiter:
+    """Token bucket limiting the rate of metadata requests.
+
+    The bucket holds up to burst tokens and gets rate tokens per second,
+    every request takes one. A request finding the bucket empty reserves
+    the next token and waits for it, so that waiting requests are served
+    in order.
+
+    The bucket is kept in the file at path and locked with flock(), all
+    processes using the same file share it. Without a usable file the
+    bucket is shared by the threads of the process only.
+    """
+
+    # IMDS throttles at about 5 requests per second
+    DEFAULT_RATE = 5
+
+    # tokens and the monotonic time they were counted at, the monotonic
+    # clock is the same for all processes until the next boot, which
+    # clears /run anyway
+    _STATE = struct.Struct('=dd')
+
+    def __init__(self, path=None, rate=DEFAULT_RATE, burst=None):
+        self._path = path
+        self._rate = rate
+        self._burst = burst if burst else rate
+        self._state = None
+        self._lock = threading.Lock()
+        self._waits = 0
+        self._wait_time = 0.0
+
+    def acquire(self, max_wait=None):
+        """Take a token, wait for it if the bucket is empty.
+
+        Return the time waited. TimeoutError is raised right away if the
+        token is not available within max_wait seconds.
+        """
+        wait = self.reserve(max_wait)
+        if wait > 0:
+            sleep(wait)
+
+        return wait
+
+    def reserve(self, max_wait=None):
+        """Take a token and return the time to wait until it is due.
+
+        The caller must wait that long before making its request, e.g.
+        with asyncio.sleep(). TimeoutError is raised as by acquire().
+        """
+        wait = self._transact(lambda tokens: self._reserve(tokens, max_wait))
+        if wait is None:
+            raise TimeoutError("Rate limit exceeds deadline")
+
+        if wait > 0:
+            with self._lock:
+                self._waits += 1
+                self._wait_time += wait
+
+        return wait
+
+    def throttled(self):
+        """Empty the bucket, the server throttled a request."""
+        self._transact(lambda tokens: (min(tokens, 0), None))
+
+    def stats(self):
+        """Return the number of waits and the total time waited."""
+        with self._lock:
+            return {'waits': self._waits, 'wait_time': self._wait_time}
+
+    def _reserve(self, tokens, max_wait):
+        wait = max(0, (1 - tokens) / self._rate)
+        if max_wait is not None and wait > max_wait:
+            return tokens, None
+
+        return tokens - 1, wait
+
+    def _transact(self, func):
+        """Refill the bucket and apply func to the number of tokens.
+
+        func returns the new number of tokens and the result to return.
+        """
+        with self._lock:
+            fd = self._open()
+            if fd is not None:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX)
+                    tokens, now = self._refill(self._read(fd))
+                    tokens, result = func(tokens)
+                    os.pwrite(fd, self._STATE.pack(tokens, now), 0)
+                    return result
+                except OSError:
+                    # e.g. a read-only or full file system, fall back to
+                    # the bucket of the process
+                    pass
+                finally:
+                    # releases the lock
+                    os.close(fd)
+
+            tokens, now = self._refill(self._state)
+            tokens, result = func(tokens)
+            self._state = (tokens, now)
+
+        return result
+
+    def _refill(self, state):
+        now = monotonic()
+        if not state:
+            return self._burst, now
+
+        elapsed = now - state[1]
+        # don't trust state from the future
+        if elapsed < 0:
+            return self._burst, now
+
+        # any user can write the file, don't let it queue requests for
+        # longer than a minute
+        tokens = max(state[0], -60 * self._rate)
+        return min(self._burst, tokens + elapsed * self._rate), now
+
+    def _open(self):
+        if not self._path:
+            return None
+
+        try:
+            return self._open_state()
+        except FileNotFoundError:
+            try:
+                directory = os.path.dirname(self._path)
+                os.mkdir(directory)
+                # mkdir() applies the umask
+                os.chmod(directory, 0o1777)
+            except OSError:
+                pass
+        except OSError:
+            return None
+
+        try:
+            return self._open_state()
+        except OSError:
+            return None
+
+    def _open_state(self):
+        # the directory is writable by all users, don't follow a link
+        # someone else put there
+        fd = os.open(
+            self._path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o666
+        )
+        try:
+            if stat.S_IMODE(os.fstat(fd).st_mode) != 0o666:
+                # the umask applied when the file was created
+                os.fchmod(fd, 0o666)
+        except OSError:
+            # the file of another user, it is usable as it is
+            pass
+
+        return fd
+
+    def _read(self, fd):
+        try:
+            data = os.pread(fd, self._STATE.size, 0)
+        except OSError:
+            return None
+
+        if len(data) != self._STATE.size:
+            return None
+
+        state = self._STATE.unpack(data)
+        if not all(math.isfinite(item) for item in state):
+            return None
+
+        return state
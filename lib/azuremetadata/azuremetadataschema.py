@@ -0,0 +1,75 @@
+# Copyright (c) 2020 SUSE LLC
+#
+# This file is part of azuremetadata.
+#
+# azuremetadata is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# azuremetadata is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with azuremetadata.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+
+SCHEMA_DIR = os.path.join(os.path.dirname(__file__), 'schemas')
+
+
+def make_schema(document):
+    """Return the key schema of a metadata document.
+
+    The schema has the structure of the document with all values
+    replaced by empty strings and lists cut down to their first item,
+    it lists the keys a document can be queried for.
+    """
+    if isinstance(document, dict):
+        return {key: make_schema(value) for key, value in document.items()}
+
+    if isinstance(document, list):
+        return [make_schema(document[0])] if document else []
+
+    return ''
+
+
+def available_versions(path=SCHEMA_DIR):
+    """Return the API versions with a bundled schema, oldest first."""
+    try:
+        names = os.listdir(path)
+    except OSError:
+        return []
+
+    return sorted(
+        name[:-len('.json')] for name in names if name.endswith('.json')
+    )
+
+
+def load_schema(api_version=None, path=SCHEMA_DIR):
+    """Return the bundled schema for api_version or None.
+
+    The schema of the newest version not newer than api_version is used,
+    the oldest one if there is none. None selects the oldest schema, it
+    matches the default API version, 'latest' the newest.
+    """
+    versions = available_versions(path)
+    if not versions:
+        return None
+
+    version = versions[0]
+    if api_version == 'latest':
+        version = versions[-1]
+    elif api_version:
+        older = [item for item in versions if item <= api_version]
+        if older:
+            version = older[-1]
+
+    try:
+        with open(os.path.join(path, version + '.json')) as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return None
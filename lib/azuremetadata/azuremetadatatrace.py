@@ -0,0 +1,167 @@
+# Copyright (c) 2020 SUSE LLC
+#
+# This file is part of azuremetadata.
+#
+# azuremetadata is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# azuremetadata is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with azuremetadata.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Timing of the phases of metadata requests and queries.
+
+The library wraps its phases, e.g. requests, retry delays and reading
+the disk tag, in span() calls. Nothing is recorded until a Tracer is
+installed with set_tracer(), span() then costs a function call.
+"""
+
+import threading
+from contextvars import ContextVar
+from time import monotonic
+
+# innermost span of the current thread or asyncio task
+_current = ContextVar('azuremetadata_span', default=None)
+
+_tracer = None
+
+
+class Span:
+    """A phase being timed, attributes can be added while it runs."""
+
+    __slots__ = ('name', 'attributes', '_tracer', '_start', '_token')
+
+    def __init__(self, tracer, name, attributes):
+        self.name = name
+        self.attributes = attributes
+        self._tracer = tracer
+        self._start = None
+        self._token = None
+
+    def set(self, **attributes):
+        """Add attributes to the span, e.g. the outcome of the phase."""
+        self.attributes.update(attributes)
+
+    def __enter__(self):
+        self._start = monotonic()
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end = monotonic()
+        _current.reset(self._token)
+        parent = _current.get()
+        if exc_type is not None:
+            self.attributes['error'] = exc_type.__name__
+        self._tracer.record(
+            self.name, self._start, end,
+            parent=parent.name if parent else None, **self.attributes
+        )
+        return False
+
+
+class _NullSpan:
+    """Stands in for Span if no tracer is installed."""
+
+    __slots__ = ()
+
+    def set(self, **attributes):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Tracer:
+    """Recorder of spans.
+
+    Every finished span is a dict with its name, its start relative to
+    the creation of the tracer and its duration in seconds, the name of
+    the thread and of the enclosing span, and its attributes. Spans are
+    passed to callback if there is one, e.g. to export them, and kept
+    for trace() otherwise.
+    """
+
+    def __init__(self, callback=None):
+        self._callback = callback
+        self._origin = monotonic()
+        self._spans = []
+        self._lock = threading.Lock()
+
+    @property
+    def origin(self):
+        """The monotonic() time the tracer was created at."""
+        return self._origin
+
+    def span(self, name, **attributes):
+        """Return a Span context manager timing a phase."""
+        return Span(self, name, attributes)
+
+    def record(self, name, start, end=None, **attributes):
+        """Record a span from monotonic() times, end defaults to now."""
+        if end is None:
+            end = monotonic()
+
+        span = {
+            'name': name,
+            'start': round(start - self._origin, 6),
+            'duration': round(end - start, 6),
+            'thread': threading.current_thread().name,
+            'parent': None,
+        }
+        span.update(attributes)
+
+        if self._callback:
+            self._callback(span)
+        else:
+            with self._lock:
+                self._spans.append(span)
+
+    def trace(self):
+        """Return the time since the tracer was created and the spans."""
+        with self._lock:
+            spans = list(self._spans)
+
+        return {
+            'total': round(monotonic() - self._origin, 6),
+            'spans': spans,
+        }
+
+
+def set_tracer(tracer):
+    """Install tracer for all spans, None to stop tracing.
+
+    Return the tracer installed before.
+    """
+    global _tracer
+    previous, _tracer = _tracer, tracer
+    return previous
+
+
+def get_tracer():
+    """Return the installed tracer or None."""
+    return _tracer
+
+
+def span(name, **attributes):
+    """Return a context manager timing the phase name.
+
+    Attributes describe the phase, more can be added with set() on the
+    returned object.
+    """
+    tracer = _tracer
+    if tracer is None:
+        return _NULL_SPAN
+    return tracer.span(name, **attributes)
@@ -15,36 +15,194 @@
 # You should have received a copy of the GNU General Public License
 # along with azuremetadata.  If not, see <http://www.gnu.org/licenses/>.
 
+import itertools
+import re
+import shlex
+import sys
 import warnings
 import json
 
+from azuremetadata.azuremetadatatrace import span
+
+
 class QueryException(Exception):
     pass
 
 
+class QueryArgumentError(QueryException):
+    """Raised if query arguments cannot be parsed."""
+    pass
+
+
+class QueryParser:
+    """Parser of query arguments, e.g. '--network --interface 0 --ipv4'.
+
+    Arguments are taken as the command line tool always took them, as if
+    every key was an option with an optional integer value: '--key',
+    '--key INDEX' and '--key=INDEX', unique prefixes of keys and negative
+    indexes are accepted and errors are reported with the same messages.
+    The order of the arguments is kept.
+
+    keys are the known keys, in the order ambiguous prefixes are reported.
+    Without keys any key is accepted as it is and prefixes are not
+    expanded, this allows for parsing a query before the metadata is
+    known.
+    """
+
+    _NEGATIVE_NUMBER = re.compile(r'^-\d+$|^-\d*\.\d+$')
+
+    def __init__(self, keys=None):
+        self._keys = None
+        if keys is not None:
+            self._keys = {key: None for key in keys}
+
+    def parse(self, arguments):
+        """Return the query as a list of (key, index) tuples.
+
+        The index is True if an argument has none. QueryArgumentError is
+        raised for invalid arguments.
+        """
+        arguments = list(arguments)
+        # nothing after '--' is an option
+        end = arguments.index('--') if '--' in arguments else len(arguments)
+        # look for ambiguous options first, as argparse does
+        options = [self._match(item) for item in arguments[:end]]
+        options += [None] * (len(arguments) - end)
+
+        query = []
+        unrecognized = []
+        idx = 0
+        while idx < len(arguments):
+            option = options[idx]
+            argument = arguments[idx]
+            idx += 1
+
+            if not option:
+                unrecognized.append(argument)
+                continue
+
+            key, value = option
+            if value is None and idx < len(arguments) and \
+                    options[idx] is None and \
+                    not self._is_option(arguments[idx]):
+                value = arguments[idx]
+                idx += 1
+
+            if value is None:
+                query.append((key, True))
+                continue
+
+            try:
+                query.append((key, int(value)))
+            except ValueError:
+                raise QueryArgumentError(
+                    "argument --{}: invalid int value: {!r}".format(
+                        key, value
+                    )
+                )
+
+        if unrecognized:
+            raise QueryArgumentError(
+                "unrecognized arguments: {}".format(' '.join(unrecognized))
+            )
+
+        return query
+
+    def _is_option(self, argument):
+        return argument.startswith('-') and argument != '-' and \
+            ' ' not in argument and not self._NEGATIVE_NUMBER.match(argument)
+
+    def _match(self, argument):
+        """Return the key and the value of an option or None."""
+        if not argument.startswith('--') or len(argument) < 3:
+            return None
+
+        name, sep, value = argument[2:].partition('=')
+        value = value if sep else None
+
+        if self._keys is None:
+            return (name, value) if name else None
+
+        if name in self._keys:
+            return name, value
+
+        matches = [key for key in self._keys if key.startswith(name)]
+        if len(matches) > 1:
+            raise QueryArgumentError(
+                "ambiguous option: {} could match {}".format(
+                    argument, ', '.join('--' + key for key in matches)
+                )
+            )
+        if matches:
+            return matches[0], value
+
+        return None
+
+
 class AzureMetadataUtils:
     PRINT_MODE_HELP = 1
     PRINT_MODE_VALUES = 2
     PRINT_MODE_XML = 3
 
+    CHUNK_SIZE = 65536
+
+    _SHELL_NAME_INVALID = re.compile(r'[^A-Za-z0-9_]')
+
+    # same as xml.sax.saxutils.escape(), which takes long to import
+    _XML_ESCAPES = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;'})
+
     def __init__(self, data):
         self._data = data
         self._parents = {}
         self._available_params = {}
-        self._parse_data(self._data)
+        self._index = {}
+        self._key_paths = {}
+        self._query_parser = None
+        with span('parse-data'):
+            self._parse_data(self._data)
+
+    @property
+    def data(self):
+        return self._data
 
     @property
     def available_params(self):
         return self._available_params
 
-    def _parse_data(self, data, parent_key=''):
+    @property
+    def index(self):
+        """Map of the full path of every node to its value.
+
+        A path is a tuple of keys and list indexes, e.g.
+        ('network', 'interface', 0, 'macAddress').
+        """
+        return self._index
+
+    @property
+    def key_paths(self):
+        """Map of every key to the full paths it occurs at."""
+        return self._key_paths
+
+    @property
+    def query_parser(self):
+        """QueryParser for the keys of the data."""
+        if self._query_parser is None:
+            self._query_parser = QueryParser(self._available_params)
+        return self._query_parser
+
+    def parse_query(self, arguments):
+        """Return the query given by command line style arguments."""
+        return self.query_parser.parse(arguments)
+
+    def _parse_data(self, data, parent_key='', path=()):
         if isinstance(data, list):
-            for item in data:
+            for idx, item in enumerate(data):
                 if not isinstance(item, dict):
                     warnings.warn("Only list of dicts is supported")
                     return False
 
-                self._parse_data(item, parent_key)
+                self._index[path + (idx,)] = item
+                self._parse_data(item, parent_key, path + (idx,))
 
         elif isinstance(data, dict):
             for key, value in data.items():
@@ -52,8 +210,12 @@ class AzureMetadataUtils:
                     self._parents[key] = []
                 self._parents[key].append(parent_key)
 
+                key_path = path + (key,)
+                self._index[key_path] = value
+                self._key_paths.setdefault(key, []).append(key_path)
+
                 if isinstance(value, (list, dict)):
-                    if self._parse_data(value, key):
+                    if self._parse_data(value, key, key_path):
                         self._available_params[key] = value
                 else:
                     self._available_params[key] = value
@@ -64,116 +226,266 @@ class AzureMetadataUtils:
 
     def print_pretty(
             self, print_xml=False, print_json=False,
-            data=None, file=None
+            data=None, file=None, print_shell=False
     ):
         if not data:
             data = self._data
 
-        if print_xml:
-            print('<document>' + json.dumps(data) + '</document>', file=file)
+        if print_shell:
+            self._write_chunks(self._render_shell(data), file)
+        elif print_xml:
+            self._write_chunks(itertools.chain(
+                ['<document>\n'],
+                self._render(self.PRINT_MODE_XML, data, depth=1),
+                ['</document>\n']
+            ), file)
         elif print_json:
             print(json.dumps(data), file=file)
         else:
             self._pretty_print(self.PRINT_MODE_VALUES, data, file=file)
 
     def _pretty_print(self, print_mode, data, depth=0, file=None):
-        """Print all available options as an indented tree."""
+        """Print all available options as an indented tree.
+
+        The output is written in large chunks rather than line by line.
+        """
+        self._write_chunks(self._render(print_mode, data, depth), file)
+
+    def _render(self, print_mode, data, depth=0):
+        """Generate the lines of the indented tree."""
         indent = ' ' * depth * 4
 
         for key, value in data.items():
             if isinstance(value, dict):
                 if print_mode == self.PRINT_MODE_HELP:
-                    print("{}--{}".format(indent, key), file=file)
+                    yield "{}--{}\n".format(indent, key)
                 elif print_mode == self.PRINT_MODE_VALUES:
-                    print("{}{}:".format(indent, key), file=file)
+                    yield "{}{}:\n".format(indent, key)
                 else:
-                    print("{}<{}>".format(indent, key), file=file)
+                    yield "{}<{}>\n".format(indent, key)
 
-                self._pretty_print(
-                    print_mode, value, depth=depth + 1, file=file
-                )
+                yield from self._render(print_mode, value, depth + 1)
 
                 if print_mode == self.PRINT_MODE_XML:
-                    print("{}</{}>".format(indent, key), file=file)
+                    yield "{}</{}>\n".format(indent, key)
             elif isinstance(value, list):
+                if not value and print_mode == self.PRINT_MODE_XML:
+                    # an empty list is not the same as a missing key
+                    yield "{}<{}/>\n".format(indent, key)
+
                 for idx, val in enumerate(value):
+                    if not isinstance(val, dict):
+                        if print_mode == self.PRINT_MODE_HELP:
+                            yield "{}--{} {}\n".format(indent, key, idx)
+                        elif print_mode == self.PRINT_MODE_VALUES:
+                            yield "{}{}[{}]: {}\n".format(
+                                indent, key, idx, val
+                            )
+                        else:
+                            yield "{}<{} index='{}'>{}</{}>\n".format(
+                                indent, key, idx, self._xml_value(val), key
+                            )
+                        continue
+
                     if print_mode == self.PRINT_MODE_HELP:
-                        print("{}--{} {}".format(indent, key, idx), file=file)
+                        yield "{}--{} {}\n".format(indent, key, idx)
                     elif print_mode == self.PRINT_MODE_VALUES:
-                        print("{}{}[{}]:".format(indent, key, idx), file=file)
+                        yield "{}{}[{}]:\n".format(indent, key, idx)
                     else:
-                        print("{}<{} index='{}'>".format(indent, key, idx),
-                              file=file)
+                        yield "{}<{} index='{}'>\n".format(indent, key, idx)
+
+                    yield from self._render(print_mode, val, depth + 1)
 
-                    self._pretty_print(
-                        print_mode, val, depth=depth + 1, file=file)
                     if print_mode == self.PRINT_MODE_XML:
-                        print("{}</{}>".format(indent, key),
-                              file=file)
+                        yield "{}</{}>\n".format(indent, key)
             else:
                 if print_mode == self.PRINT_MODE_HELP:
-                    print("{}--{}".format(indent, key), file=file)
+                    yield "{}--{}\n".format(indent, key)
                 elif print_mode == self.PRINT_MODE_VALUES:
-                    print("{}{}: {}".format(indent, key, value), file=file)
+                    yield "{}{}: {}\n".format(indent, key, value)
                 else:
-                    print("{}<{}>{}</{}>".format(indent, key, value, key),
-                          file=file)
+                    yield "{}<{}>{}</{}>\n".format(
+                        indent, key, self._xml_value(value), key
+                    )
+
+    def _render_shell(self, data, path=()):
+        """Generate a shell variable assignment for every value.
+
+        Variables are named after the path of the value, e.g.
+        NETWORK_INTERFACE_0_MACADDRESS, values are quoted for the shell.
+        """
+        items = data.items() if isinstance(data, dict) else enumerate(data)
+        for key, value in items:
+            item_path = path + (key,)
+            if isinstance(value, (dict, list)):
+                yield from self._render_shell(value, item_path)
+            else:
+                yield "{}={}\n".format(
+                    self._shell_name(item_path), self._shell_value(value)
+                )
+
+    @classmethod
+    def _shell_name(cls, path):
+        return cls._SHELL_NAME_INVALID.sub(
+            '_', '_'.join(str(item) for item in path)
+        ).upper()
+
+    @staticmethod
+    def _shell_value(value):
+        if value is None:
+            return "''"
+        if isinstance(value, bool):
+            return 'true' if value else 'false'
+        return shlex.quote(str(value))
+
+    @classmethod
+    def _xml_value(cls, value):
+        """Return value as escaped XML character data."""
+        if value is None:
+            return ''
+        if isinstance(value, bool):
+            return 'true' if value else 'false'
+        return str(value).translate(cls._XML_ESCAPES)
+
+    @classmethod
+    def _write_chunks(cls, lines, file=None):
+        """Write lines in chunks of about CHUNK_SIZE characters."""
+        if file is None:
+            file = sys.stdout
+
+        chunk = []
+        size = 0
+        for line in lines:
+            chunk.append(line)
+            size += len(line)
+            if size >= cls.CHUNK_SIZE:
+                file.write(''.join(chunk))
+                chunk = []
+                size = 0
+
+        if chunk:
+            file.write(''.join(chunk))
 
     def query(self, args):
         """Generate output based on command line arguments."""
-        root = self._available_params
         result = {}
-        parents = []
+        for parents, arg, _, value in self._resolve_query(args):
+            target = result
+            for item in parents:
+                target[item] = {}
+                target = target[item]
+
+            target[arg] = value
+
+        return result
+
+    def select(self, args):
+        """Return the values the query selects in the document structure.
+
+        Unlike query() the result keeps the list indexes, lists are padded
+        with empty dicts so that the items stay at their index.
+        """
+        result = {}
+        for _, _, node_path, value in self._resolve_query(args):
+            target = result
+            for item, next_item in zip(node_path, node_path[1:]):
+                if isinstance(item, int):
+                    target.extend({} for _ in range(item + 1 - len(target)))
+                elif item not in target:
+                    target[item] = [] if isinstance(next_item, int) else {}
+                target = target[item]
+
+            target[node_path[-1]] = value
 
-        while len(args) > 0:
-            arg, argval = args.pop(0)
+        return result
 
+    def _resolve_query(self, args):
+        """Generate the parents, key, full path and value of every value
+        the query selects.
+        """
+        parents = []
+        # path of the node the query is in, None at the top level
+        path = None
+
+        for arg, argval in args:
             if isinstance(argval, bool):
                 argval = 0
 
             if self._available_params.get(arg) is None:
                 raise QueryException("Nothing found for '{}'".format(arg))
 
-            value = root.get(arg)
-
-            if root == self._available_params and len(self._parents[arg]) > 1:
+            if path is not None:
+                node_path = path + (arg,)
+            elif len(self._parents[arg]) > 1:
                 if self._data.get(arg) is None:
                     raise QueryException(
                         "Argument '{}' is ambiguous: possible parents {}"
                         .format(arg, self._parents[arg])
                     )
-                else:
-                    value = self._data.get(arg)
-
-            if isinstance(value, list):
-                try:
-                    root = value[argval]
-                    parents.append(arg)
-                    continue
-                except IndexError:
-                    # in case of empty list attributes
-                    # instead of empty strings or None
-                    pass
+                node_path = (arg,)
+            else:
+                node_path = self._key_paths[arg][0]
+
+            value = self._index.get(node_path)
+
+            # in case of empty list attributes instead of empty strings
+            # or None an index out of range yields the list itself
+            if isinstance(value, list) and -len(value) <= argval < len(value):
+                path = node_path + (argval % len(value),)
+                parents.append(arg)
+                continue
 
             if isinstance(value, dict):
-                root = value
+                path = node_path
                 parents.append(arg)
                 continue
 
             if value is None:
                 raise QueryException("Nothing found for '{}'".format(arg))
-            else:
-                target = result
-                for item in parents:
-                    target[item] = {}
-                    target = target[item]
 
-                target[arg] = value
+            yield parents, arg, node_path, value
 
-            root = self._available_params
+            path = None
             parents = []
 
-        if root != self._available_params:
+        if path is not None:
             raise QueryException("Unfinished query")
 
+    @staticmethod
+    def result_value(result):
+        """Return the value a query result consists of.
+
+        A result with more than one value, or a list, is returned as it
+        is.
+        """
+        values = []
+        nodes = [result]
+        while nodes:
+            node = nodes.pop()
+            for value in node.values():
+                if isinstance(value, dict):
+                    nodes.append(value)
+                else:
+                    values.append(value)
+
+        if len(values) == 1 and not isinstance(values[0], list):
+            return values[0]
         return result
+
+    def query_batch(self, queries):
+        """Answer queries given as strings, e.g. '--compute --vmId'.
+
+        Return a (result, error) tuple for every query in the order of
+        the queries. error is None if the query succeeded and the error
+        message otherwise, a failing query does not affect the others.
+        """
+        results = []
+        for query in queries:
+            try:
+                args = self.parse_query(shlex.split(query))
+                results.append((self.query(args), None))
+            except (QueryException, ValueError) as e:
+                # ValueError is raised by shlex for unbalanced quotes
+                results.append((None, str(e)))
+
+        return results
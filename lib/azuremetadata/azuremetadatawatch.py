@@ -0,0 +1,180 @@
+# Copyright (c) 2020 SUSE LLC
+#
+# This file is part of azuremetadata.
+#
+# azuremetadata is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# azuremetadata is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with azuremetadata.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import json
+import threading
+
+from collections import namedtuple
+
+from azuremetadata.azuremetadatautils import (
+    AzureMetadataUtils, QueryException
+)
+
+# children is a dict or a list of nodes, None for values
+HashNode = namedtuple('HashNode', ['digest', 'value', 'children'])
+
+
+def hash_tree(document):
+    """Return the tree of digests of document and all its parts.
+
+    Two subtrees have the same digest if and only if they have the same
+    content, which lets diff_trees() skip unchanged parts without looking
+    into them.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+
+    if isinstance(document, dict):
+        children = {key: hash_tree(value) for key, value in document.items()}
+        digest.update(b'{')
+        for key in sorted(children):
+            digest.update(json.dumps(key).encode('utf-8'))
+            digest.update(children[key].digest)
+    elif isinstance(document, list):
+        children = [hash_tree(value) for value in document]
+        digest.update(b'[')
+        for child in children:
+            digest.update(child.digest)
+    else:
+        children = None
+        digest.update(json.dumps(document).encode('utf-8'))
+
+    return HashNode(digest.digest(), document, children)
+
+
+def diff_trees(old, new, path=()):
+    """Generate the changes from the old to the new hash tree.
+
+    Every change is a dict with the type, 'added', 'removed' or
+    'changed', the path of the changed value as a list of keys and list
+    indexes, and the old and/or the new value.
+    """
+    if old.digest == new.digest:
+        return
+
+    if isinstance(old.children, dict) and isinstance(new.children, dict):
+        for key, child in old.children.items():
+            if key in new.children:
+                yield from diff_trees(
+                    child, new.children[key], path + (key,)
+                )
+            else:
+                yield _event('removed', path + (key,), old=child.value)
+
+        for key, child in new.children.items():
+            if key not in old.children:
+                yield _event('added', path + (key,), new=child.value)
+
+    elif isinstance(old.children, list) and isinstance(new.children, list):
+        for idx, (old_child, new_child) in enumerate(
+                zip(old.children, new.children)
+        ):
+            yield from diff_trees(old_child, new_child, path + (idx,))
+
+        for idx in range(len(new.children), len(old.children)):
+            yield _event(
+                'removed', path + (idx,), old=old.children[idx].value
+            )
+        for idx in range(len(old.children), len(new.children)):
+            yield _event('added', path + (idx,), new=new.children[idx].value)
+
+    else:
+        yield _event('changed', path, old=old.value, new=new.value)
+
+
+def _event(event_type, path, **values):
+    event = {'type': event_type, 'path': list(path)}
+    event.update(values)
+    return event
+
+
+def query_fetch(fetch, arguments):
+    """Return a fetch function for MetadataWatcher watching a query.
+
+    The function returns the part of the document fetch returns that the
+    query arguments, e.g. ['--compute', '--tags'], select. Once the query
+    selected something a query error means the part was removed, {} is
+    returned then and the watcher reports the removal. Until then query
+    errors are raised, e.g. for misspelled keys.
+    """
+    selected = False
+
+    def fetch_query():
+        nonlocal selected
+        document = fetch()
+        if document is None:
+            return None
+
+        util = AzureMetadataUtils(document)
+        try:
+            result = util.select(util.parse_query(arguments))
+        except QueryException:
+            if not selected:
+                raise
+            return {}
+
+        selected = True
+        return result
+
+    return fetch_query
+
+
+class MetadataWatcher:
+    """Report changes of a metadata document between polls.
+
+    fetch is called to get the current document, it returns None if the
+    document cannot be fetched. It must not return
+    cached data, e.g. get_instance_data of an AzureMetadata without a
+    cache or with a cache in refresh mode will do.
+    """
+
+    def __init__(self, fetch):
+        self._fetch = fetch
+        self._tree = None
+
+    def poll(self):
+        """Fetch the document and return the changes since the last poll.
+
+        The first successful poll has nothing to compare to and returns
+        no changes, neither does a failed one.
+        """
+        document = self._fetch()
+        if document is None:
+            return []
+
+        tree = hash_tree(document)
+        previous, self._tree = self._tree, tree
+        if previous is None:
+            return []
+
+        return list(diff_trees(previous, tree))
+
+    def watch(self, interval, stop=None):
+        """Poll every interval seconds and generate the changes found.
+
+        Each poll that finds changes generates a list of them. Polling
+        ends when the threading.Event stop is set.
+        """
+        if stop is None:
+            stop = threading.Event()
+
+        while True:
+            changes = self.poll()
+            if changes:
+                yield changes
+            if stop.wait(interval):
+                return
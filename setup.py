@@ -32,7 +32,7 @@ setup(
     author_email='public-cloud-dev@susecloud.net',
     version=version,
     packages=find_packages('lib'),
-    package_data={'azuremetadata': ['VERSION']},
+    package_data={'azuremetadata': ['VERSION', 'schemas/*.json']},
     package_dir={
         '': 'lib',
     },
@@ -1,37 +1,598 @@
 #!/usr/bin/env python3
 
-from flask import Flask, request, send_from_directory
-from werkzeug.exceptions import NotFound
+# Copyright (c) 2020 SUSE LLC
+#
+# This file is part of azuremetadata.
+#
+# azuremetadata is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# azuremetadata is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with azuremetadata.  If not, see <http://www.gnu.org/licenses/>.
 
+"""Local stand-in for the Azure instance metadata server.
 
-app = Flask(__name__)
+The documents are served from the fixtures directory, e.g.
+metadata-v2019-08-15.json for /metadata/instance?api-version=2019-08-15,
+including sub-paths like /metadata/instance/network/interface/0 and
+format=text. Versions without a fixture get the document of the newest
+older version. Requests without an API version or with one the server
+does not offer fail with 400 and the newest versions, /metadata/versions
+lists the offered versions.
 
+Latency and faults are configured per path prefix, the longest prefix
+matching a request applies, '/' matches all of them. Latencies are in
+milliseconds:
 
-@app.route('/metadata/instance')
-def instance():
-    api_version = request.args.get("api-version")
+    fixed:MS  uniform:LOW:HIGH  normal:MEAN:STDDEV
+    lognormal:MEDIAN:SIGMA  exponential:MEAN
 
-    if api_version:
+Faults are a comma separated list of an HTTP status or 'reset' and its
+probability, e.g. 429:0.1,reset:0.01; a reset closes the connection
+without a response. --asm answers compute requests of the versions not
+available in ASM with 404, like the server of a Classic deployment.
+
+    stub_server.py --latency /=normal:2:0.5 \\
+        --latency /metadata/attested=lognormal:40:0.5 \\
+        --fault /metadata/instance=429:0.05,500:0.01,reset:0.005
+
+The server handles all connections in a single asyncio loop, keeps them
+alive and serves thousands of requests per second. GET /stub/counters
+returns the number of requests per endpoint, status and fault as JSON,
+?reset=1 zeroes them; they are printed when the server is stopped.
+"""
+
+import argparse
+import asyncio
+import collections
+import json
+import os
+import random
+import re
+import signal
+import socket
+import struct
+import sys
+from urllib.parse import parse_qs, unquote, urlsplit
+
+DEFAULT_PORT = 8888
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'fixtures')
+
+# versions offered by the server besides those of the fixtures
+SERVER_VERSIONS = (
+    '2017-03-01', '2017-04-02', '2017-08-01', '2017-10-01', '2017-12-01',
+    '2018-02-01', '2018-04-02', '2018-10-01', '2019-02-01', '2019-03-11',
+    '2019-04-30', '2019-06-01', '2019-06-04', '2019-08-01', '2019-08-15',
+    '2019-11-01', '2020-06-01', '2020-07-15', '2020-09-01', '2020-10-01',
+)
+
+# compute data of this version and newer ones is missing in ASM
+ASM_COMPUTE_VERSION = '2019-11-01'
+
+# number of newest versions listed in the 400 responses
+NEWEST_VERSIONS = 3
+
+REASONS = {
+    200: 'OK',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    410: 'Gone',
+    429: 'Too Many Requests',
+    500: 'Internal Server Error',
+    503: 'Service Unavailable',
+}
+
+# request header lines and body size limits
+MAX_HEADERS = 100
+MAX_BODY = 64 * 1024
+
+_FIXTURE_NAME = re.compile(
+    r'^(metadata|attested-data)-v(\d{4}-\d{2}-\d{2})(?:-(.+))?\.json$'
+)
+
+# fixture name prefixes of the endpoints
+_ENDPOINT_FIXTURES = {
+    'instance': 'metadata',
+    'attested': 'attested-data',
+}
+
+
+class Latency:
+    """Random delay of a response drawn from a distribution."""
+
+    DISTRIBUTIONS = {
+        'fixed': (1, lambda ms: ms),
+        'uniform': (2, random.uniform),
+        'normal': (2, random.gauss),
+        'lognormal': (2, lambda median, sigma: median * random.lognormvariate(
+            0, sigma
+        )),
+        'exponential': (1, lambda mean: random.expovariate(1 / mean)),
+    }
+
+    def __init__(self, spec):
+        name, _, params = spec.partition(':')
+        if name not in self.DISTRIBUTIONS:
+            raise ValueError('unknown distribution {!r}'.format(name))
+        count, self._func = self.DISTRIBUTIONS[name]
         try:
-            return send_from_directory('fixtures', f'metadata-v{api_version}.json')
-        except NotFound:
-            return f'Unknown API version', 404
-    else:
-        return f'API version not specified', 400
+            self._params = [float(param) for param in params.split(':')]
+        except ValueError:
+            raise ValueError('invalid parameters {!r}'.format(params))
+        if len(self._params) != count or min(self._params) < 0:
+            raise ValueError('{} takes {} non-negative parameters'.format(
+                name, count
+            ))
+        if name == 'exponential' and not self._params[0]:
+            raise ValueError('exponential takes a positive mean')
+        self.spec = spec
+
+    def sample(self):
+        """Return a delay in seconds."""
+        return max(0.0, self._func(*self._params)) / 1000
+
+
+class Faults:
+    """Probabilities of failing a request with a status or a reset."""
+
+    def __init__(self, spec):
+        self.faults = []
+        for item in spec.split(','):
+            kind, _, probability = item.partition(':')
+            if kind != 'reset':
+                try:
+                    kind = int(kind)
+                except ValueError:
+                    raise ValueError('unknown fault {!r}'.format(kind))
+                if not 400 <= kind < 600:
+                    raise ValueError('fault status {} is no error'.format(
+                        kind
+                    ))
+            try:
+                probability = float(probability or 1)
+            except ValueError:
+                raise ValueError('invalid probability {!r}'.format(
+                    probability
+                ))
+            if not 0 <= probability <= 1:
+                raise ValueError('probability {} is not in [0, 1]'.format(
+                    probability
+                ))
+            self.faults.append((kind, probability))
 
+        if sum(probability for _, probability in self.faults) > 1:
+            raise ValueError('the probabilities add up to more than 1')
 
-@app.route('/metadata/attested/document')
-def attested_document():
-    api_version = request.args.get("api-version")
+    def sample(self):
+        """Return the fault to inject or None."""
+        value = random.random()
+        for kind, probability in self.faults:
+            if value < probability:
+                return kind
+            value -= probability
+        return None
 
-    if api_version:
+
+class PrefixTable:
+    """Values looked up by the longest path prefix of a request."""
+
+    def __init__(self):
+        self._items = []
+
+    def add(self, prefix, value):
+        prefix = '/' + prefix.strip('/')
+        self._items = [
+            item for item in self._items if item[0] != prefix
+        ] + [(prefix, value)]
+        self._items.sort(key=lambda item: len(item[0]), reverse=True)
+
+    def lookup(self, path):
+        for prefix, value in self._items:
+            if prefix == '/' or path == prefix or \
+                    path.startswith(prefix + '/'):
+                return value
+        return None
+
+
+def _prefix_option(parse):
+    """Return an argparse type for PREFIX=SPEC parsed with parse."""
+    def option(value):
+        prefix, _, spec = value.rpartition('=')
+        if not prefix.startswith('/'):
+            raise argparse.ArgumentTypeError(
+                'expected PREFIX=SPEC, PREFIX starting with /'
+            )
         try:
-            return send_from_directory('fixtures', f'attested-data-v{api_version}.json')
-        except NotFound:
-            return f'Unknown API version', 404
+            return prefix, parse(spec)
+        except ValueError as e:
+            raise argparse.ArgumentTypeError(str(e))
+    return option
+
+
+def load_fixtures(path, variant=None):
+    """Return the documents in the fixtures at path.
+
+    The result maps the endpoint names to dicts of the documents by API
+    version. Fixtures of variant, e.g. single-network-if, replace the
+    plain ones.
+    """
+    documents = {endpoint: {} for endpoint in _ENDPOINT_FIXTURES}
+    prefixes = {
+        prefix: endpoint for endpoint, prefix in _ENDPOINT_FIXTURES.items()
+    }
+    for name in sorted(os.listdir(path)):
+        match = _FIXTURE_NAME.match(name)
+        if not match:
+            continue
+        prefix, version, suffix = match.groups()
+        if suffix and suffix != variant:
+            continue
+        versions = documents[prefixes[prefix]]
+        if version in versions and not suffix:
+            continue
+        with open(os.path.join(path, name)) as fh:
+            versions[version] = json.load(fh)
+
+    return documents
+
+
+def to_text(data):
+    """Return data as the server formats it for format=text."""
+    if isinstance(data, dict):
+        items = data.items()
+    elif isinstance(data, list):
+        items = ((str(index), value) for index, value in enumerate(data))
+    elif isinstance(data, bool):
+        return 'true' if data else 'false'
     else:
-        return f'API version not specified', 400
+        return '' if data is None else str(data)
+
+    # keys of containers end in a slash
+    return '\n'.join(
+        key + '/' if isinstance(value, (dict, list)) else key
+        for key, value in items
+    )
+
+
+class Simulator:
+    """The responses of the metadata server and their counters."""
+
+    def __init__(self, documents, latencies=None, faults=None,
+                 asm=False, retry_after=None, versions=SERVER_VERSIONS):
+        self.documents = documents
+        self.latencies = latencies or PrefixTable()
+        self.faults = faults or PrefixTable()
+        self.asm = asm
+        self.retry_after = retry_after
+        self.counters = collections.Counter()
+        self.connections = 0
+        # the tasks serving the open connections
+        self._handlers = set()
+
+        self.versions = sorted(
+            set(versions).union(*documents.values()), reverse=True
+        )
+        self._version_error = {
+            'error': 'Bad request. api-version is invalid or was not '
+                     'specified in the request. For more information '
+                     'refer to aka.ms/azureimds',
+            'newest-versions': self.versions[:NEWEST_VERSIONS],
+        }
+        # encoded responses by request target
+        self._responses = {}
+
+    def count(self, name):
+        self.counters[name] += 1
+
+    def snapshot(self, reset=False):
+        """Return the counters, zero them if reset is set."""
+        counters = dict(sorted(self.counters.items()))
+        counters['connections'] = self.connections
+        if reset:
+            self.counters.clear()
+            self.connections = 0
+        return counters
+
+    def delay(self, path):
+        latency = self.latencies.lookup(path)
+        return latency.sample() if latency else 0
+
+    def fault(self, path):
+        faults = self.faults.lookup(path)
+        return faults.sample() if faults else None
+
+    def respond(self, method, target, headers):
+        """Return the status, the headers and the body of a request.
+
+        The status is 'reset' if the connection is to be reset.
+        """
+        path = urlsplit(target).path
+        endpoint = path.rstrip('/').split('/')[:3]
+        self.count('requests')
+        self.count('endpoint ' + ('/'.join(endpoint) or '/'))
+
+        if path.startswith('/stub/'):
+            return self._respond_stub(path, target)
+
+        fault = self.fault(path)
+        if fault == 'reset':
+            self.count('fault reset')
+            return 'reset', {}, b''
+        if fault:
+            self.count('fault {}'.format(fault))
+            extra = {}
+            if fault == 429 and self.retry_after is not None:
+                extra['Retry-After'] = str(self.retry_after)
+            _, _, content_type, body = self._error(
+                fault, REASONS.get(fault, 'Injected fault')
+            )
+            return fault, extra, content_type, body
+
+        if method != 'GET':
+            return self._error(405, 'Method not allowed')
+        if headers.get('metadata', '').lower() != 'true':
+            return self._error(
+                400, 'Bad request. Required metadata header not specified'
+            )
+
+        response = self._responses.get(target)
+        if response is None:
+            response = self._respond_metadata(path, target)
+            if len(self._responses) < 10000:
+                self._responses[target] = response
+        return response
+
+    def _respond_stub(self, path, target):
+        if path == '/stub/counters':
+            query = parse_qs(urlsplit(target).query)
+            return self._json(self.snapshot('reset' in query))
+        return self._error(404, 'Not found')
+
+    def _respond_metadata(self, path, target):
+        query = parse_qs(urlsplit(target).query)
+        version = query.get('api-version', [None])[0]
+        text = query.get('format', ['json'])[0] == 'text'
+
+        parts = [unquote(part) for part in path.strip('/').split('/')]
+        if parts == ['metadata', 'versions']:
+            return self._json({'apiVersions': self.versions})
+        if parts[:2] == ['metadata', 'instance']:
+            endpoint, keys = 'instance', parts[2:]
+        elif parts[:3] == ['metadata', 'attested', 'document']:
+            endpoint, keys = 'attested', parts[3:]
+        else:
+            return self._error(404, 'Not found')
+
+        if version not in self.versions:
+            return self._json(self._version_error, 400)
+        fixtures = [
+            fixture for fixture in self.documents[endpoint]
+            if fixture <= version
+        ]
+        if not fixtures:
+            return self._error(404, 'Not found')
+
+        if self.asm and endpoint == 'instance' and keys[:1] == ['compute'] \
+                and version >= ASM_COMPUTE_VERSION:
+            return self._error(404, 'Not found')
+
+        data = self.documents[endpoint][max(fixtures)]
+        for key in keys:
+            try:
+                if isinstance(data, list):
+                    data = data[int(key)]
+                elif isinstance(data, dict):
+                    data = data[key]
+                else:
+                    raise KeyError(key)
+            except (KeyError, IndexError, ValueError):
+                return self._error(404, 'Not found')
+
+        if text:
+            return 200, {}, 'text/plain; charset=utf-8', \
+                to_text(data).encode('utf-8')
+        return self._json(data)
+
+    @staticmethod
+    def _json(data, status=200):
+        return status, {}, 'application/json; charset=utf-8', \
+            json.dumps(data).encode('utf-8')
+
+    def _error(self, status, message):
+        return self._json({'error': message}, status)
+
+    async def handle(self, reader, writer):
+        """Serve the requests of a connection."""
+        self.connections += 1
+        self._handlers.add(asyncio.current_task())
+        try:
+            while True:
+                request = await self._read_request(reader)
+                if request is None:
+                    break
+                method, target, version, headers = request
+
+                path = urlsplit(target).path
+                delay = self.delay(path) if not path.startswith('/stub/') \
+                    else 0
+                if delay:
+                    await asyncio.sleep(delay)
+
+                response = self.respond(method, target, headers)
+                if response[0] == 'reset':
+                    self._reset(writer)
+                    return
+
+                status, extra, content_type, body = response
+                self.count('status {}'.format(status))
+                close = version == 'HTTP/1.0' or \
+                    headers.get('connection', '').lower() == 'close'
+                writer.write(self._format_response(
+                    status, extra, content_type, body, close
+                ))
+                await writer.drain()
+                if close:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError,
+                asyncio.LimitOverrunError, ValueError):
+            # the client went away or sent garbage
+            pass
+        except asyncio.CancelledError:
+            # the server is stopped, asyncio.start_server() reports
+            # cancelled handlers as errors
+            pass
+        finally:
+            self._handlers.discard(asyncio.current_task())
+            writer.close()
+
+    async def close(self):
+        """Close the open connections."""
+        handlers = list(self._handlers)
+        for task in handlers:
+            task.cancel()
+        await asyncio.gather(*handlers)
+
+    @staticmethod
+    async def _read_request(reader):
+        """Return the method, target, version and headers or None."""
+        line = await reader.readline()
+        if not line:
+            return None
+        method, target, version = line.decode('latin-1').split()
+
+        headers = {}
+        for _ in range(MAX_HEADERS):
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        else:
+            raise ValueError('too many headers')
+
+        # requests have no body, but drop one if it is sent
+        length = int(headers.get('content-length', 0))
+        if not 0 <= length <= MAX_BODY:
+            raise ValueError('invalid body length')
+        if length:
+            await reader.readexactly(length)
+
+        return method, target, version, headers
+
+    @staticmethod
+    def _format_response(status, extra, content_type, body, close):
+        lines = [
+            'HTTP/1.1 {} {}'.format(status, REASONS.get(status, 'Error')),
+            'Content-Type: ' + content_type,
+            'Content-Length: {}'.format(len(body)),
+            'Server: Microsoft-IIS/10.0',
+        ]
+        lines.extend('{}: {}'.format(*item) for item in extra.items())
+        if close:
+            lines.append('Connection: close')
+        return '\r\n'.join(lines + ['', '']).encode('latin-1') + body
+
+    @staticmethod
+    def _reset(writer):
+        """Close the connection with a TCP reset."""
+        sock = writer.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(
+                socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0)
+            )
+        writer.transport.abort()
+
+
+async def serve(simulator, host, port):
+    """Run the server until it is cancelled or gets SIGINT or SIGTERM."""
+    server = await asyncio.start_server(
+        simulator.handle, host, port, reuse_address=True, backlog=1024
+    )
+    loop = asyncio.get_running_loop()
+    stopped = loop.create_future()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stopped.cancel)
+
+    print('Serving {} on {}'.format(
+        ', '.join(simulator.versions),
+        ', '.join('{}:{}'.format(*sock.getsockname()[:2])
+                  for sock in server.sockets)
+    ), file=sys.stderr)
+    async with server:
+        try:
+            await stopped
+        except asyncio.CancelledError:
+            pass
+        server.close()
+        await simulator.close()
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument('--host', default='0.0.0.0',
+                        help="Address to listen on (default: 0.0.0.0)")
+    parser.add_argument('-p', '--port', type=int, default=DEFAULT_PORT,
+                        help="Port to listen on (default: {})".format(
+                            DEFAULT_PORT))
+    parser.add_argument('--fixtures', default=FIXTURES,
+                        help="Directory of the documents to serve")
+    parser.add_argument('--variant',
+                        help="Serve the fixtures of a variant, e.g. "
+                             "single-network-if, where there are some")
+    parser.add_argument('--latency', action='append', default=[],
+                        type=_prefix_option(Latency),
+                        metavar='PREFIX=DISTRIBUTION',
+                        help="Delay the responses to the requests below "
+                             "PREFIX")
+    parser.add_argument('--fault', action='append', default=[],
+                        type=_prefix_option(Faults),
+                        metavar='PREFIX=FAULTS',
+                        help="Fail requests below PREFIX at random")
+    parser.add_argument('--retry-after', type=int, metavar='SECONDS',
+                        help="Retry-After header of the 429 responses")
+    parser.add_argument('--versions', type=lambda value: value.split(','),
+                        default=SERVER_VERSIONS,
+                        help="Comma separated API versions the server "
+                             "offers besides those of the fixtures")
+    parser.add_argument('--asm', action='store_true',
+                        help="Serve as in an ASM (Classic) deployment")
+    parser.add_argument('--seed', type=int,
+                        help="Seed of the latencies and faults")
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    latencies = PrefixTable()
+    for prefix, latency in args.latency:
+        latencies.add(prefix, latency)
+    faults = PrefixTable()
+    for prefix, fault in args.fault:
+        faults.add(prefix, fault)
+
+    simulator = Simulator(
+        load_fixtures(args.fixtures, args.variant), latencies, faults,
+        args.asm, args.retry_after, args.versions
+    )
+    try:
+        asyncio.run(serve(simulator, args.host, args.port))
+    finally:
+        print(json.dumps(simulator.snapshot(), indent=4), file=sys.stderr)
 
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port='8888')
+    main()
@@ -0,0 +1,160 @@
+# Copyright (c) 2020 SUSE LLC
+#
+# This file is part of azuremetadata.
+#
+# azuremetadata is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# azuremetadata is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with azuremetadata.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import threading
+import time
+
+import pytest
+from azuremetadata import azuremetadataagent, azuremetadatautils
+from mock import Mock
+
+data = {
+    'billingTag': 'tag',
+    'compute': {'vmId': 'foo', 'name': 'bar'},
+}
+
+
+def create_agent(document=data, **kwargs):
+    metadata = Mock()
+    metadata.get_document.return_value = document
+    return azuremetadataagent.MetadataAgent(lambda: metadata, **kwargs)
+
+
+def test_handle_request_query():
+    agent = create_agent()
+    agent.refresh()
+
+    response = agent.handle_request(
+        {'op': 'query', 'api': None, 'query': [['compute', True],
+                                               ['vmId', True]]}
+    )
+    assert response == {'result': {'compute': {'vmId': 'foo'}}}
+
+    response = agent.handle_request(
+        {'op': 'query', 'api': None, 'query': [['foo', True]]}
+    )
+    assert response == {'error': "Nothing found for 'foo'", 'type': 'query'}
+
+    response = agent.handle_request(
+        {'op': 'query', 'api': None, 'args': ['--comp', '--vmId']}
+    )
+    assert response == {'result': {'compute': {'vmId': 'foo'}}}
+
+    response = agent.handle_request(
+        {'op': 'query', 'api': None, 'args': ['--compute', 'foo']}
+    )
+    assert response == {
+        'error': "argument --compute: invalid int value: 'foo'",
+        'type': 'argument'
+    }
+
+
+def test_handle_request_document():
+    agent = create_agent()
+    agent.refresh()
+
+    assert agent.handle_request({'op': 'document', 'api': None}, uid=0) == \
+        {'result': data}
+    # the disk tag is only handed out to root
+    assert agent.handle_request({'op': 'document', 'api': None}, uid=1000) \
+        == {'result': {'compute': {'vmId': 'foo', 'name': 'bar'}}}
+    assert agent.handle_request(
+        {'op': 'query', 'api': None, 'query': [['billingTag', True]]},
+        uid=1000
+    )['type'] == 'query'
+
+
+@pytest.mark.parametrize(
+    "request_,error",
+    [
+        ([], 'Invalid request'),
+        ({'op': 'document', 'api': '2019-08-15'}, 'Unsupported API version'),
+        ({'op': 'foo', 'api': None}, 'Unknown operation'),
+        ({'op': 'query', 'api': None, 'query': 1}, 'Invalid query'),
+        ({'op': 'query', 'api': None, 'args': 1}, 'Invalid query'),
+    ]
+)
+def test_handle_request_errors(request_, error):
+    agent = create_agent()
+    agent.refresh()
+
+    assert agent.handle_request(request_) == \
+        {'error': error, 'type': 'request'}
+
+
+def test_refresh_failure():
+    # what get_document() returns if the metadata server is unreachable
+    agent = create_agent(document={'billingTag': 'tag', 'attestedData': {}})
+
+    assert not agent.refresh()
+    assert agent.handle_request({'op': 'document', 'api': None}) == \
+        {'error': 'No metadata available', 'type': 'request'}
+
+
+def test_refresh_failure_keeps_data():
+    metadata = Mock()
+    metadata.get_document.return_value = data
+    agent = azuremetadataagent.MetadataAgent(lambda: metadata)
+    assert agent.refresh()
+
+    metadata.get_document.return_value = {'attestedData': {}}
+    assert not agent.refresh()
+    assert agent.handle_request({'op': 'document', 'api': None}, uid=0) == \
+        {'result': data}
+
+
+def test_agent_client(tmp_path):
+    socket_path = str(tmp_path / 'agent.sock')
+    agent = create_agent(socket_path=socket_path, refresh_interval=3600)
+    server = threading.Thread(target=agent.serve_forever)
+    server.start()
+
+    try:
+        client = azuremetadataagent.AgentClient(socket_path)
+        for _ in range(100):
+            if client.available():
+                break
+            time.sleep(0.01)
+
+        assert client.query([('compute', True), ('name', True)]) == \
+            {'compute': {'name': 'bar'}}
+        assert client.get_document()['compute']['vmId'] == 'foo'
+
+        with pytest.raises(azuremetadatautils.QueryException):
+            client.query([('foo', True)])
+
+        assert client.query_arguments(['--compute', '--name']) == \
+            {'compute': {'name': 'bar'}}
+        with pytest.raises(azuremetadatautils.QueryArgumentError):
+            client.query_arguments(['--foo'])
+
+        with pytest.raises(azuremetadataagent.AgentError):
+            client.get_document('2019-08-15')
+    finally:
+        agent.shutdown()
+        server.join()
+
+    assert not os.path.exists(socket_path)
+
+
+def test_agent_client_unavailable(tmp_path):
+    client = azuremetadataagent.AgentClient(str(tmp_path / 'agent.sock'))
+
+    assert not client.available()
+    with pytest.raises(azuremetadataagent.AgentError):
+        client.get_document()
@@ -0,0 +1,504 @@
+# Copyright (c) 2020 SUSE LLC
+#
+# This file is part of azuremetadata.
+#
+# azuremetadata is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# azuremetadata is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with azuremetadata.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import http.client
+import json
+
+import pytest
+
+from azuremetadata import (
+    azuremetadata, azuremetadataasync, azuremetadatatrace
+)
+from azuremetadata.azuremetadatacache import ResponseCache
+from mock import patch, Mock
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        # e.g. server connections still waiting
+        tasks = asyncio.all_tasks(loop)
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            loop.run_until_complete(
+                asyncio.gather(*tasks, return_exceptions=True)
+            )
+        loop.close()
+
+
+class FakePool:
+    """AsyncConnectionPool answering from a dict of URL paths."""
+
+    def __init__(self, responses, delay=0):
+        self.responses = responses
+        self.delay = delay
+        self.requests = []
+        self.active = 0
+        self.max_active = 0
+
+    async def request(self, url, headers=None, timeout=None):
+        self.requests.append(url)
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            self.active -= 1
+
+        response = self.responses[url.split('169.254.169.254', 1)[1]]
+        if isinstance(response, list):
+            response = response.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        status, body = response
+        return status, 'Reason', json.dumps(body).encode('utf-8'), {}
+
+    async def close(self):
+        pass
+
+
+async def serve(responses):
+    """Start a server sending the responses, one per request.
+
+    Return the server and the number of connections made to it.
+    """
+    connections = []
+
+    async def handle(reader, writer):
+        connections.append(writer)
+        try:
+            while responses:
+                line = await reader.readline()
+                if not line:
+                    break
+                while line not in (b'\r\n', b''):
+                    line = await reader.readline()
+                response = responses.pop(0)
+                if response is None:
+                    # never answer
+                    await asyncio.sleep(10)
+                writer.write(response)
+                await writer.drain()
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, '127.0.0.1', 0)
+    return server, connections
+
+
+def test_pool_keep_alive():
+    async def requests():
+        server, connections = await serve([
+            b'HTTP/1.1 200 OK\r\nContent-Length: 3\r\n\r\nfoo',
+            b'HTTP/1.1 429 Too Many Requests\r\nretry-after: 1\r\n'
+            b'Transfer-Encoding: chunked\r\n\r\n'
+            b'2\r\nba\r\n1;ext=1\r\nr\r\n0\r\n\r\n',
+            b'HTTP/1.1 200 OK\r\nConnection: close\r\n\r\nbaz',
+        ])
+        url = 'http://127.0.0.1:{}/metadata?foo=bar'.format(
+            server.sockets[0].getsockname()[1]
+        )
+        pool = azuremetadataasync.AsyncConnectionPool()
+        try:
+            results = [await pool.request(url) for _ in range(3)]
+        finally:
+            await pool.close()
+            server.close()
+        return results, len(connections)
+
+    results, connections = run(requests())
+
+    assert [result[:3] for result in results] == [
+        (200, 'OK', b'foo'),
+        (429, 'Too Many Requests', b'bar'),
+        (200, 'OK', b'baz'),
+    ]
+    assert results[1][3].get('Retry-After') == '1'
+    assert connections == 1
+
+
+def test_pool_reconnect():
+    async def requests():
+        server, connections = await serve([
+            b'HTTP/1.1 200 OK\r\nContent-Length: 3\r\n\r\nfoo',
+        ])
+        url = 'http://127.0.0.1:{}/'.format(
+            server.sockets[0].getsockname()[1]
+        )
+        pool = azuremetadataasync.AsyncConnectionPool()
+        try:
+            first = await pool.request(url)
+            # the server closed the idle connection
+            server_responses = [
+                b'HTTP/1.1 200 OK\r\nContent-Length: 3\r\n\r\nbar'
+            ]
+            server.close()
+            server, _ = await serve(server_responses)
+            url = 'http://127.0.0.1:{}/'.format(
+                server.sockets[0].getsockname()[1]
+            )
+            second = await pool.request(url)
+        finally:
+            await pool.close()
+            server.close()
+        return first[2], second[2]
+
+    assert run(requests()) == (b'foo', b'bar')
+
+
+def test_pool_timeout():
+    async def request():
+        server, _ = await serve([None])
+        url = 'http://127.0.0.1:{}/'.format(
+            server.sockets[0].getsockname()[1]
+        )
+        pool = azuremetadataasync.AsyncConnectionPool()
+        try:
+            await pool.request(url, timeout=0.05)
+        finally:
+            await pool.close()
+            server.close()
+
+    with pytest.raises(TimeoutError):
+        run(request())
+
+
+def test_pool_timeout_not_retried():
+    async def requests():
+        server, connections = await serve([
+            b'HTTP/1.1 200 OK\r\nContent-Length: 3\r\n\r\nfoo', None
+        ])
+        url = 'http://127.0.0.1:{}/'.format(
+            server.sockets[0].getsockname()[1]
+        )
+        pool = azuremetadataasync.AsyncConnectionPool()
+        try:
+            await pool.request(url)
+            # the kept-alive connection does not answer
+            with pytest.raises(TimeoutError):
+                await pool.request(url, timeout=0.05)
+        finally:
+            await pool.close()
+            server.close()
+        return len(connections)
+
+    # no second connection was opened
+    assert run(requests()) == 1
+
+
+def test_pool_bad_response():
+    async def request():
+        server, _ = await serve([b'garbage\r\n\r\n'])
+        url = 'http://127.0.0.1:{}/'.format(
+            server.sockets[0].getsockname()[1]
+        )
+        pool = azuremetadataasync.AsyncConnectionPool()
+        try:
+            await pool.request(url)
+        finally:
+            await pool.close()
+            server.close()
+
+    with pytest.raises(http.client.BadStatusLine):
+        run(request())
+
+
+def test_get_all():
+    pool = FakePool({
+        '/metadata/instance?api-version=2020-02-02': (200, {'foo': 'bar'}),
+        '/metadata/attested/document?api-version=2020-02-02': (
+            200, {'signature': 'baz'}
+        ),
+    }, delay=0.01)
+    metadata = azuremetadataasync.AsyncAzureMetadata(
+        api_version='2020-02-02', pool=pool
+    )
+
+    assert run(metadata.get_all()) == {
+        'foo': 'bar', 'attestedData': {'signature': 'baz'}
+    }
+    # the documents are fetched concurrently
+    assert pool.max_active == 2
+
+
+def test_get_all_no_attested_data():
+    pool = FakePool({
+        '/metadata/instance?api-version=2017-04-02': (200, {'foo': 'bar'}),
+    })
+    metadata = azuremetadataasync.AsyncAzureMetadata(pool=pool)
+
+    assert run(metadata.get_all()) == {'foo': 'bar'}
+    assert len(pool.requests) == 1
+
+
+def test_get_all_kvp():
+    pool = FakePool({
+        '/metadata/instance?api-version=2017-04-02': (200, {'foo': 'bar'}),
+    })
+    kvp_pool = Mock()
+    kvp_pool.get_metadata.return_value = {'HostName': 'host-1'}
+    metadata = azuremetadataasync.AsyncAzureMetadata(
+        pool=pool, kvp_pool=kvp_pool
+    )
+
+    assert run(metadata.get_all(kvp=True)) == {
+        'foo': 'bar', 'kvp': {'HostName': 'host-1'}
+    }
+
+
+def test_get_instance_path():
+    pool = FakePool({
+        '/metadata/instance/network/interface/0?api-version=2020-02-02': (
+            200, {'macAddress': 'foo'}
+        ),
+    })
+    metadata = azuremetadataasync.AsyncAzureMetadata(
+        api_version='2020-02-02', pool=pool
+    )
+
+    assert run(metadata.get_instance_path(('network', 'interface', 0))) == {
+        'macAddress': 'foo'
+    }
+
+
+@patch('sys.stderr')
+def test_request_retry(stderr_mock):
+    pool = FakePool({
+        '/metadata/instance?api-version=2020-02-02': [
+            OSError('foo'), (503, {}), (200, {'foo': 'bar'})
+        ],
+        '/metadata/attested/document?api-version=2020-02-02': (
+            404, {'error': 'Not found'}
+        ),
+    })
+    metadata = azuremetadataasync.AsyncAzureMetadata(
+        api_version='2020-02-02', pool=pool,
+        retry_policy=azuremetadata.RetryPolicy(backoff=0)
+    )
+
+    assert run(metadata.get_instance_data()) == {'foo': 'bar'}
+    assert len(pool.requests) == 3
+    # errors are reported like AzureMetadata does
+    assert run(metadata.get_attested_data()) == {}
+    assert len(pool.requests) == 4
+    assert stderr_mock.write.call_count > 0
+
+
+def test_request_rate_limited():
+    pool = FakePool({
+        '/metadata/instance?api-version=2020-02-02': (200, {'foo': 'bar'}),
+    })
+    rate_limiter = Mock()
+    rate_limiter.reserve.return_value = 0
+    metadata = azuremetadataasync.AsyncAzureMetadata(
+        api_version='2020-02-02', pool=pool, rate_limiter=rate_limiter
+    )
+
+    run(metadata.get_instance_data())
+    rate_limiter.reserve.assert_called_once_with(max_wait=None)
+    rate_limiter.acquire.assert_not_called()
+
+
+def test_latest_api_version():
+    pool = FakePool({
+        '/metadata/instance': (
+            400, {'newest-versions': ['2020-09-01', '2020-07-15']}
+        ),
+        '/metadata/instance?api-version=2020-09-01': (200, {'foo': 'bar'}),
+        '/metadata/attested/document?api-version=2020-09-01': (
+            200, {'signature': 'baz'}
+        ),
+    }, delay=0.01)
+    metadata = azuremetadataasync.AsyncAzureMetadata(
+        api_version='latest', pool=pool
+    )
+
+    assert run(metadata.get_all()) == {
+        'foo': 'bar', 'attestedData': {'signature': 'baz'}
+    }
+    # the version is resolved once
+    assert pool.requests.count('http://169.254.169.254/metadata/instance') \
+        == 1
+
+
+def test_latest_api_version_cached(tmp_path):
+    pool = FakePool({
+        '/metadata/instance': (
+            400, {'newest-versions': ['2020-09-01', '2020-07-15']}
+        ),
+    })
+    boot_id = tmp_path / 'boot_id'
+    boot_id.write_text('boot\n')
+    cache = ResponseCache(str(tmp_path / 'cache'))
+
+    with patch.object(
+            azuremetadataasync.AsyncAzureMetadata, '_BOOT_ID', str(boot_id)
+    ):
+        # negotiated before, e.g. by AzureMetadata
+        cache.store('newest-versions', 'boot', ['2020-07-15'])
+        metadata = azuremetadataasync.AsyncAzureMetadata(
+            api_version='latest', pool=pool, cache=cache
+        )
+        run(metadata._resolve_api_version())
+        assert metadata._api_version == '2020-07-15'
+        assert not pool.requests
+
+
+def test_list_api_versions():
+    pool = FakePool({
+        '/metadata/versions': (
+            200, {'apiVersions': ['2017-04-02', '2019-08-15']}
+        ),
+    })
+    metadata = azuremetadataasync.AsyncAzureMetadata(pool=pool)
+
+    assert run(metadata.list_api_versions()) == ['2019-08-15', '2017-04-02']
+
+
+def test_get_instance_data_single_flight():
+    pool = FakePool({
+        '/metadata/instance?api-version=2020-02-02': (200, {'foo': 'bar'}),
+    }, delay=0.01)
+    metadata = azuremetadataasync.AsyncAzureMetadata(
+        api_version='2020-02-02', pool=pool
+    )
+
+    async def get():
+        return await asyncio.gather(
+            *[metadata.get_instance_data() for _ in range(4)]
+        )
+
+    results = run(get())
+    assert results == [{'foo': 'bar'}] * 4
+    assert len(pool.requests) == 1
+    # every caller gets its own copy
+    results[0]['foo'] = 'baz'
+    assert results[1] == {'foo': 'bar'}
+
+
+def test_get_instance_data_cancel():
+    pool = FakePool({
+        '/metadata/instance?api-version=2020-02-02': (200, {'foo': 'bar'}),
+    }, delay=10)
+    metadata = azuremetadataasync.AsyncAzureMetadata(
+        api_version='2020-02-02', pool=pool
+    )
+
+    async def get():
+        task = asyncio.ensure_future(metadata.get_instance_data())
+        await asyncio.sleep(0.01)
+        assert pool.active == 1
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        await asyncio.sleep(0)
+        return pool.active
+
+    # the request is cancelled with its only caller
+    assert run(get()) == 0
+    assert not metadata._inflight
+
+
+def test_get_instance_data_cached(tmp_path):
+    pool = FakePool({
+        '/metadata/instance?api-version=2020-02-02': (200, {'foo': 'bar'}),
+    })
+    cache = ResponseCache(str(tmp_path))
+    metadata = azuremetadataasync.AsyncAzureMetadata(
+        api_version='2020-02-02', pool=pool, cache=cache
+    )
+
+    assert run(metadata.get_instance_data()) == {'foo': 'bar'}
+    assert run(metadata.get_instance_data()) == {'foo': 'bar'}
+    assert len(pool.requests) == 1
+    assert cache.get('instance', '2020-02-02') == {'foo': 'bar'}
+
+
+def test_get_instance_data_span(tmp_path):
+    pool = FakePool({
+        '/metadata/instance?api-version=2020-02-02': (200, {'foo': 'bar'}),
+    })
+    metadata = azuremetadataasync.AsyncAzureMetadata(
+        api_version='2020-02-02', pool=pool, cache=ResponseCache(str(tmp_path))
+    )
+    tracer = azuremetadatatrace.Tracer()
+    previous = azuremetadatatrace.set_tracer(tracer)
+    try:
+        run(metadata.get_instance_data())
+        run(metadata.get_instance_data())
+    finally:
+        azuremetadatatrace.set_tracer(previous)
+
+    spans = [
+        span for span in tracer.trace()['spans'] if span['name'] == 'document'
+    ]
+    assert [span['source'] for span in spans] == ['server', 'cache']
+    assert spans[0]['endpoint'] == 'instance'
+
+
+def test_get_instance_data_waits_for_other_process(tmp_path):
+    pool = FakePool({
+        '/metadata/instance?api-version=2020-02-02': (200, {'foo': 'baz'}),
+    })
+    other = ResponseCache(str(tmp_path))
+    metadata = azuremetadataasync.AsyncAzureMetadata(
+        api_version='2020-02-02', pool=pool,
+        cache=ResponseCache(str(tmp_path), refresh=True)
+    )
+
+    async def get():
+        with other.lock('instance', '2020-02-02'):
+            task = asyncio.ensure_future(metadata.get_instance_data())
+            # the loop keeps running while waiting for the lock
+            await asyncio.sleep(0.05)
+            assert not task.done()
+            other.set('instance', '2020-02-02', {'foo': 'bar'})
+        return await task
+
+    assert run(get()) == {'foo': 'bar'}
+    assert not pool.requests
+
+
+def test_get_instance_data_stuck_process(tmp_path):
+    pool = FakePool({
+        '/metadata/instance?api-version=2020-02-02': (200, {'foo': 'baz'}),
+    })
+    other = ResponseCache(str(tmp_path))
+    metadata = azuremetadataasync.AsyncAzureMetadata(
+        api_version='2020-02-02', pool=pool,
+        cache=ResponseCache(str(tmp_path)),
+        retry_policy=azuremetadata.RetryPolicy(
+            attempts=1, timeout=0.1, max_backoff=0
+        )
+    )
+
+    # the lock is not released, the document is fetched once a fetch
+    # would have been done
+    with other.lock('instance', '2020-02-02'):
+        assert run(metadata.get_instance_data()) == {'foo': 'baz'}
+    assert len(pool.requests) == 1
+
+
+def test_get_disk_tag():
+    metadata = azuremetadataasync.AsyncAzureMetadata()
+
+    assert run(metadata.get_disk_tag('./fixtures/disk.bin')) == \
+        '00112233-4455-6677-8899-aabbccddeeff'
@@ -0,0 +1,438 @@
+# Copyright (c) 2020 SUSE LLC
+#
+# This file is part of azuremetadata.
+#
+# azuremetadata is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# azuremetadata is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with azuremetadata.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import stat
+import threading
+
+import pytest
+
+from azuremetadata import azuremetadata, azuremetadatacache
+from mock import patch, Mock
+
+
+def test_cache_roundtrip(tmp_path):
+    cache = azuremetadatacache.ResponseCache(str(tmp_path))
+    cache.set('instance', '2019-08-15', {'foo': 'bar'})
+
+    assert cache.get('instance', '2019-08-15') == {'foo': 'bar'}
+    assert cache.get('instance', '2017-04-02') is None
+    assert cache.get('attested', '2019-08-15') is None
+    # no temporary files are left behind
+    assert os.listdir(str(tmp_path)) == ['instance-2019-08-15.json']
+
+
+@patch('time.time')
+def test_cache_ttl(time_mock, tmp_path):
+    cache = azuremetadatacache.ResponseCache(
+        str(tmp_path), ttls={'instance': 100}
+    )
+    time_mock.return_value = 1000
+    cache.set('instance', '2019-08-15', {'foo': 'bar'})
+    cache.set('attested', '2019-08-15', {'signature': 'foo'})
+
+    time_mock.return_value = 1070
+    assert cache.get('instance', '2019-08-15') == {'foo': 'bar'}
+    assert cache.get('attested', '2019-08-15') is None
+
+    time_mock.return_value = 1101
+    assert cache.get('instance', '2019-08-15') is None
+
+    # clock went backwards
+    time_mock.return_value = 900
+    assert cache.get('instance', '2019-08-15') is None
+
+
+def test_cache_refresh(tmp_path):
+    azuremetadatacache.ResponseCache(str(tmp_path)).set(
+        'instance', '2019-08-15', {'foo': 'bar'}
+    )
+    cache = azuremetadatacache.ResponseCache(str(tmp_path), refresh=True)
+    assert cache.get('instance', '2019-08-15') is None
+
+    cache.set('instance', '2019-08-15', {'foo': 'baz'})
+    cache = azuremetadatacache.ResponseCache(str(tmp_path))
+    assert cache.get('instance', '2019-08-15') == {'foo': 'baz'}
+
+
+def test_cache_corrupt_entry(tmp_path):
+    cache = azuremetadatacache.ResponseCache(str(tmp_path))
+    with open(str(tmp_path / 'instance-2019-08-15.json'), 'w') as fh:
+        fh.write('{"foo')
+
+    assert cache.get('instance', '2019-08-15') is None
+
+
+def test_cache_clear(tmp_path):
+    cache = azuremetadatacache.ResponseCache(str(tmp_path))
+    cache.set('instance', '2019-08-15', {'foo': 'bar'})
+    cache.clear()
+
+    assert cache.get('instance', '2019-08-15') is None
+
+
+@patch('os.geteuid')
+def test_default_cache_dir(geteuid_mock):
+    geteuid_mock.return_value = 0
+    assert azuremetadatacache.default_cache_dir() == '/run/azuremetadata'
+
+    geteuid_mock.return_value = 1000
+    with patch.dict(os.environ, {'XDG_RUNTIME_DIR': '/run/user/1000'}):
+        assert azuremetadatacache.default_cache_dir() == \
+            '/run/user/1000/azuremetadata'
+
+    with patch.dict(os.environ, {}, clear=True):
+        assert azuremetadatacache.default_cache_dir() is None
+
+
+@patch('http.client.HTTPConnection')
+def test_get_instance_data_cached(connection_mock, tmp_path):
+    expected_data = {"foo": "bar"}
+    response = connection_mock.return_value.getresponse.return_value
+    response.status = 200
+    response.read.return_value = json.dumps(expected_data)
+    response.will_close = False
+
+    cache = azuremetadatacache.ResponseCache(str(tmp_path))
+    metadata = azuremetadata.AzureMetadata(
+        api_version='2020-02-02', cache=cache
+    )
+
+    assert metadata.get_instance_data() == expected_data
+    assert metadata.get_instance_data() == expected_data
+    assert connection_mock.return_value.request.call_count == 1
+    assert cache.get('instance', '2020-02-02') == expected_data
+
+
+@patch('sys.stderr')
+@patch('azuremetadata.azuremetadata.sleep')
+@patch('http.client.HTTPConnection')
+def test_get_instance_data_error_not_cached(connection_mock, sleep_mock,
+                                            stderr_mock, tmp_path):
+    response = connection_mock.return_value.getresponse.return_value
+    response.status = 500
+    response.reason = 'Internal Server Error'
+    response.read.return_value = b''
+    response.will_close = False
+
+    cache = azuremetadatacache.ResponseCache(str(tmp_path))
+    metadata = azuremetadata.AzureMetadata(
+        api_version='2020-02-02', cache=cache
+    )
+
+    assert metadata.get_instance_data() == {}
+    assert cache.get('instance', '2020-02-02') is None
+
+
+@patch('http.client.HTTPConnection')
+def test_get_cached_data(connection_mock, tmp_path):
+    cache = azuremetadatacache.ResponseCache(str(tmp_path))
+    metadata = azuremetadata.AzureMetadata(
+        api_version='2020-02-02', cache=cache
+    )
+    assert metadata.get_cached_data() is None
+    assert azuremetadata.AzureMetadata().get_cached_data() is None
+
+    cache.set('attested', '2020-02-02', {'signature': 'foo'})
+    assert metadata.get_cached_data() is None
+
+    cache.set('instance', '2020-02-02', {'compute': {'vmId': 'bar'}})
+    assert metadata.get_cached_data() == {
+        'compute': {'vmId': 'bar'}, 'attestedData': {'signature': 'foo'}
+    }
+    # the cache is all there is to it
+    assert not connection_mock.called
+
+
+def test_cache_lookup(tmp_path):
+    cache = azuremetadatacache.ResponseCache(str(tmp_path))
+    cache.store('disktag', '8:0|serial|boot', 'tag')
+
+    assert cache.lookup('disktag', '8:0|serial|boot') == 'tag'
+    assert cache.lookup('disktag', '8:0|serial|other-boot') is None
+    assert cache.lookup('foo', '8:0|serial|boot') is None
+
+    cache = azuremetadatacache.ResponseCache(str(tmp_path), refresh=True)
+    assert cache.lookup('disktag', '8:0|serial|boot') is None
+
+    # documents are fetched again, lookups are still served
+    cache = azuremetadatacache.ResponseCache(
+        str(tmp_path), refresh=True, refresh_lookups=False
+    )
+    cache.set('instance', '2020-06-01', {'foo': 'bar'})
+    assert cache.get('instance', '2020-06-01') is None
+    assert cache.lookup('disktag', '8:0|serial|boot') == 'tag'
+
+
+@patch('azuremetadata.azuremetadata.AzureMetadata._get_device_identity')
+def test_get_disk_tag_cached(identity_mock, tmp_path):
+    identity_mock.return_value = '8:0|serial|boot'
+    cache = azuremetadatacache.ResponseCache(str(tmp_path))
+    metadata = azuremetadata.AzureMetadata(cache=cache)
+
+    tag = '00112233-4455-6677-8899-aabbccddeeff'
+    assert metadata.get_disk_tag('./fixtures/disk.bin') == tag
+    assert cache.lookup('disktag', '8:0|serial|boot') == tag
+
+    # the device is not read again
+    assert metadata.get_disk_tag('./fixtures/missing.bin') == tag
+
+    # the device changed
+    identity_mock.return_value = '8:16|serial|boot'
+    with patch('sys.stderr'):
+        assert metadata.get_disk_tag('./fixtures/missing.bin') == ''
+
+
+@patch('os.stat')
+def test_get_device_identity(stat_mock, tmp_path):
+    stat_mock.return_value = Mock(
+        st_mode=stat.S_IFBLK | 0o660, st_rdev=os.makedev(8, 2)
+    )
+    disk = tmp_path / 'devices' / 'sda'
+    (disk / 'sda2').mkdir(parents=True)
+    (disk / 'sda2' / 'partition').write_text('2')
+    (disk / 'device').mkdir()
+    (disk / 'device' / 'wwid').write_text('naa.60022480f00\n')
+    (tmp_path / 'block').mkdir()
+    os.symlink(str(disk / 'sda2'), str(tmp_path / 'block' / '8:2'))
+    (tmp_path / 'boot_id').write_text('boot\n')
+
+    with patch.object(azuremetadata.AzureMetadata, '_SYS_DEV_BLOCK',
+                      str(tmp_path / 'block')), \
+            patch.object(azuremetadata.AzureMetadata, '_BOOT_ID',
+                         str(tmp_path / 'boot_id')):
+        identity = azuremetadata.AzureMetadata._get_device_identity(
+            '/dev/sda'
+        )
+
+    assert identity == '8:2|naa.60022480f00|boot'
+
+
+def test_get_device_identity_no_block_device():
+    assert azuremetadata.AzureMetadata._get_device_identity(
+        './fixtures/disk.bin'
+    ) is None
+
+
+@patch('http.client.HTTPConnection')
+def test_latest_api_version_cached(connection_mock, tmp_path):
+    response = connection_mock.return_value.getresponse.return_value
+    response.status = 400
+    response.reason = 'Bad Request'
+    response.read.return_value = b'{"newest-versions": ["2020-09-01"]}'
+    response.will_close = False
+    boot_id = tmp_path / 'boot_id'
+    boot_id.write_text('boot\n')
+    cache = azuremetadatacache.ResponseCache(str(tmp_path / 'cache'))
+
+    with patch.object(azuremetadata.AzureMetadata, '_BOOT_ID', str(boot_id)):
+        for _ in range(2):
+            metadata = azuremetadata.AzureMetadata('latest', cache=cache)
+            assert metadata._api_version == '2020-09-01'
+        assert connection_mock.return_value.request.call_count == 1
+
+        # the versions may have changed with a redeployment
+        boot_id.write_text('other\n')
+        azuremetadata.AzureMetadata('latest', cache=cache)
+        assert connection_mock.return_value.request.call_count == 2
+
+        # nothing to remember if the request failed
+        cache.clear()
+        response.read.return_value = b'{"error": "foo"}'
+        for _ in range(2):
+            metadata = azuremetadata.AzureMetadata('latest', cache=cache)
+            assert metadata._api_version == '2017-03-01'
+        assert connection_mock.return_value.request.call_count == 4
+
+
+@patch('azuremetadata.azuremetadata.sleep')
+@patch('http.client.HTTPConnection')
+def test_is_classic_cached(connection_mock, sleep_mock, tmp_path):
+    response = connection_mock.return_value.getresponse.return_value
+    response.status = 404
+    response.reason = 'Not Found'
+    response.read.return_value = b'Not found'
+    response.will_close = False
+    boot_id = tmp_path / 'boot_id'
+    boot_id.write_text('boot\n')
+    cache = azuremetadatacache.ResponseCache(str(tmp_path / 'cache'))
+
+    with patch.object(azuremetadata.AzureMetadata, '_BOOT_ID', str(boot_id)):
+        for _ in range(2):
+            assert azuremetadata.AzureMetadata(cache=cache).is_classic()
+        assert connection_mock.return_value.request.call_count == 1
+
+        # errors tell nothing about the deployment model
+        cache.clear()
+        response.status = 500
+        response.reason = 'Internal Server Error'
+        assert not azuremetadata.AzureMetadata(cache=cache).is_classic()
+        assert cache.lookup('classic', 'boot') is None
+
+        response.status = 200
+        response.reason = 'OK'
+        assert not azuremetadata.AzureMetadata(cache=cache).is_classic()
+        assert cache.lookup('classic', 'boot') is False
+
+        # refresh mode probes again
+        refresh_cache = azuremetadatacache.ResponseCache(
+            str(tmp_path / 'cache'), refresh=True
+        )
+        calls = connection_mock.return_value.request.call_count
+        azuremetadata.AzureMetadata(cache=refresh_cache).is_classic()
+        assert connection_mock.return_value.request.call_count == calls + 1
+
+
+def test_cache_newer_than(tmp_path):
+    cache = azuremetadatacache.ResponseCache(str(tmp_path))
+    with patch('time.time', return_value=1000):
+        cache.set('instance', '2019-08-15', {'foo': 'bar'})
+
+    # regardless of the TTL
+    assert cache.get('instance', '2019-08-15', newer_than=1000) == {
+        'foo': 'bar'
+    }
+    assert cache.get('instance', '2019-08-15', newer_than=1001) is None
+
+    # data stored by another process in refresh mode is fresh
+    cache = azuremetadatacache.ResponseCache(str(tmp_path), refresh=True)
+    assert cache.get('instance', '2019-08-15') is None
+    assert cache.get('instance', '2019-08-15', newer_than=999) == {
+        'foo': 'bar'
+    }
+
+
+def test_cache_lock(tmp_path):
+    cache = azuremetadatacache.ResponseCache(str(tmp_path / 'cache'))
+    other = azuremetadatacache.ResponseCache(str(tmp_path / 'cache'))
+
+    with cache.lock('instance', '2019-08-15') as locked:
+        assert locked
+        with other.lock('instance', '2019-08-15', timeout=0.05) as locked:
+            assert locked is False
+        # entries are locked separately
+        with other.lock('attested', '2019-08-15', timeout=0) as locked:
+            assert locked
+
+    with other.lock('instance', '2019-08-15', timeout=0) as locked:
+        assert locked
+
+    # no cache directory
+    with patch.object(
+            azuremetadatacache, 'default_cache_dir', return_value=None
+    ):
+        cache = azuremetadatacache.ResponseCache()
+    with cache.lock('instance', '2019-08-15') as locked:
+        assert locked is None
+
+
+@patch('http.client.HTTPConnection')
+def test_get_instance_data_single_flight(connection_mock, tmp_path):
+    started = threading.Event()
+    release = threading.Event()
+
+    def getresponse():
+        started.set()
+        release.wait(5)
+        response = Mock(status=200, reason='OK', will_close=False)
+        response.read.return_value = b'{"foo": "bar"}'
+        return response
+
+    connection_mock.return_value.getresponse.side_effect = getresponse
+    metadata = azuremetadata.AzureMetadata(
+        api_version='2020-02-02',
+        cache=azuremetadatacache.ResponseCache(str(tmp_path), refresh=True)
+    )
+
+    results = []
+    threads = [
+        threading.Thread(
+            target=lambda: results.append(metadata.get_instance_data())
+        ) for _ in range(4)
+    ]
+    threads[0].start()
+    assert started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert results == [{'foo': 'bar'}] * 4
+    assert connection_mock.return_value.request.call_count == 1
+    # every caller gets its own copy
+    results[0]['foo'] = 'baz'
+    assert results[1] == {'foo': 'bar'}
+
+
+@patch('http.client.HTTPConnection')
+def test_get_instance_data_single_flight_error(connection_mock):
+    metadata = azuremetadata.AzureMetadata(api_version='2020-02-02')
+    flight = azuremetadata._Flight()
+    metadata._inflight[('instance', '2020-02-02')] = flight
+    flight.error = OSError('foo')
+    flight.done.set()
+
+    with pytest.raises(OSError):
+        metadata.get_instance_data()
+    connection_mock.return_value.request.assert_not_called()
+
+
+def test_get_document_waits_for_other_process(tmp_path):
+    cache = azuremetadatacache.ResponseCache(str(tmp_path), refresh=True)
+    other = azuremetadatacache.ResponseCache(str(tmp_path))
+    metadata = azuremetadata.AzureMetadata(
+        api_version='2020-02-02', cache=cache
+    )
+    metadata._make_request = Mock(return_value={'foo': 'baz'})
+
+    results = []
+    # another process fetches the document while this one waits
+    with other.lock('instance', '2020-02-02'):
+        thread = threading.Thread(target=lambda: results.append(
+            metadata._get_document('instance', 'url')
+        ))
+        thread.start()
+        thread.join(0.1)
+        other.set('instance', '2020-02-02', {'foo': 'bar'})
+    thread.join(5)
+
+    assert results == [{'foo': 'bar'}]
+    metadata._make_request.assert_not_called()
+
+    # data stored before the call started is refreshed
+    assert metadata._get_document('instance', 'url') == {'foo': 'baz'}
+    assert metadata._make_request.call_count == 1
+
+
+def test_get_document_stuck_process(tmp_path):
+    cache = azuremetadatacache.ResponseCache(str(tmp_path))
+    other = azuremetadatacache.ResponseCache(str(tmp_path))
+    metadata = azuremetadata.AzureMetadata(
+        api_version='2020-02-02', cache=cache,
+        retry_policy=azuremetadata.RetryPolicy(
+            attempts=1, timeout=0.1, max_backoff=0
+        )
+    )
+    metadata._make_request = Mock(return_value={'foo': 'baz'})
+
+    # the process holding the lock does not get anywhere, the document is
+    # fetched once a fetch would have been done
+    with other.lock('instance', '2020-02-02'):
+        assert metadata._get_document('instance', 'url') == {'foo': 'baz'}
+    assert metadata._make_request.call_count == 1
@@ -0,0 +1,186 @@
+# Copyright (c) 2020 SUSE LLC
+#
+# This file is part of azuremetadata.
+#
+# azuremetadata is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# azuremetadata is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with azuremetadata.  If not, see <http://www.gnu.org/licenses/>.
+
+import copy
+import json
+import os
+
+import pytest
+
+from azuremetadata import azuremetadatafleet
+
+with open('fixtures/metadata-v2019-08-15.json') as fh:
+    FIXTURE = json.load(fh)
+
+SIZES = ['Standard_D2_v2', 'Standard_B1s', 'Standard_D4_v3']
+
+
+def snapshot(vm_id, size):
+    data = copy.deepcopy(FIXTURE)
+    data['compute']['vmId'] = vm_id
+    data['compute']['vmSize'] = size
+    return data
+
+
+@pytest.fixture
+def fleet(tmpdir):
+    """A directory of snapshot files and an NDJSON stream."""
+    for idx in range(2):
+        with open(str(tmpdir.join('vm{}.json'.format(idx))), 'w') as fh:
+            json.dump(snapshot('file-{}'.format(idx), SIZES[idx]), fh)
+
+    stream = tmpdir.mkdir('streams').join('fleet.ndjson')
+    with open(str(stream), 'w') as fh:
+        for idx in range(6):
+            fh.write(json.dumps(
+                snapshot('line-{}'.format(idx), SIZES[idx % 3])
+            ) + '\n')
+        fh.write('\n{"broken\n')
+
+    return str(tmpdir)
+
+
+def names(records):
+    return [os.path.basename(record['snapshot']) for record in records]
+
+
+@pytest.mark.parametrize('processes', [1, 2])
+def test_query(fleet, processes):
+    query = azuremetadatafleet.FleetQuery(
+        ['--compute --vmId', '--network --interface 1 --macAddress',
+         '--compute --tagsList', '--compute --foo'],
+        where=[('--compute --vmSize', 'Standard_D*')],
+        processes=processes, chunk_size=2
+    )
+    records = list(query.run([fleet]))
+
+    assert names(records) == [
+        'fleet.ndjson:1', 'fleet.ndjson:3', 'fleet.ndjson:4',
+        'fleet.ndjson:6', 'fleet.ndjson:8', 'vm0.json'
+    ]
+    assert records[0]['results'] == {
+        '--compute --vmId': 'line-0',
+        '--network --interface 1 --macAddress': '000D3AADD853',
+        # lists are kept in the result
+        '--compute --tagsList': {'compute': {'tagsList': []}},
+    }
+    assert records[0]['errors'] == {
+        '--compute --foo': 'unrecognized arguments: --foo'
+    }
+    assert records[4] == {
+        'snapshot': os.path.join(fleet, 'streams', 'fleet.ndjson:8'),
+        'error': records[4]['error'],
+    }
+
+
+def test_query_failed_condition(fleet):
+    query = azuremetadatafleet.FleetQuery(
+        ['--compute --vmId'], where=[('--compute --foo', '*')], processes=1
+    )
+    # only the broken snapshot is reported
+    assert names(query.run([fleet])) == ['fleet.ndjson:8']
+
+
+def test_index(fleet, tmpdir):
+    path = str(tmpdir.join('index.db'))
+    select = ['--compute --vmId']
+    where = [('--compute --vmSize', 'Standard_D*')]
+    expected = list(azuremetadatafleet.FleetQuery(
+        select, where, processes=1
+    ).run([fleet]))
+
+    with azuremetadatafleet.FleetIndex(path) as index:
+        assert index.update(
+            [fleet], ['--compute --vmId', '--compute --vmSize'], processes=1
+        ) == {'evaluated': 3, 'unchanged': 0, 'removed': 0}
+        assert list(index.search(select, where)) == expected
+
+        # values without wildcards are looked up in the index
+        records = list(index.search(
+            select, [('--compute --vmSize', 'Standard_B1s')]
+        ))
+        assert names(records) == [
+            'fleet.ndjson:2', 'fleet.ndjson:5', 'fleet.ndjson:8', 'vm1.json'
+        ]
+
+        with pytest.raises(ValueError):
+            list(index.search(['--compute --location']))
+
+    os.remove(os.path.join(fleet, 'vm0.json'))
+    with open(os.path.join(fleet, 'vm1.json'), 'w') as fh:
+        json.dump(snapshot('file-1', 'Standard_D8_v3'), fh)
+
+    with azuremetadatafleet.FleetIndex(path) as index:
+        assert index.update([fleet], processes=1) == {
+            'evaluated': 1, 'unchanged': 1, 'removed': 1
+        }
+        assert names(index.search(select, where))[-1] == 'vm1.json'
+
+        # a new query needs all snapshots again
+        assert index.update(
+            [fleet], ['--compute --location'], processes=1
+        ) == {'evaluated': 2, 'unchanged': 0, 'removed': 0}
+        assert index.queries == [
+            '--compute --location', '--compute --vmId', '--compute --vmSize'
+        ]
+        assert next(index.search(['--compute --location']))['results'] == {
+            '--compute --location': 'westeurope'
+        }
+
+        with pytest.raises(ValueError):
+            index.update(['-'])
+
+
+def test_unreadable_sources(tmpdir):
+    with open(str(tmpdir.join('vm0.json')), 'w') as fh:
+        json.dump(snapshot('file-0', SIZES[0]), fh)
+    # UTF-16 rather than UTF-8
+    with open(str(tmpdir.join('vm1.json')), 'wb') as fh:
+        fh.write(b'\xff\xfe{\x00}\x00')
+    with open(str(tmpdir.join('fleet.ndjson')), 'wb') as fh:
+        fh.write(json.dumps(snapshot('line-0', SIZES[1])).encode('utf-8'))
+        fh.write(b'\n\xff\n')
+    missing = str(tmpdir.join('missing.json'))
+
+    select = ['--compute --vmId']
+    records = list(azuremetadatafleet.FleetQuery(
+        select, processes=1
+    ).run([str(tmpdir), missing]))
+
+    # the sources that can be read are still evaluated
+    assert names(records) == [
+        'fleet.ndjson:1', 'fleet.ndjson:2', 'vm0.json', 'vm1.json',
+        'missing.json'
+    ]
+    assert records[0]['results'] == {'--compute --vmId': 'line-0'}
+    assert 'codec can\'t decode' in records[1]['error']
+    assert records[2]['results'] == {'--compute --vmId': 'file-0'}
+    assert 'codec can\'t decode' in records[3]['error']
+    assert 'No such file' in records[4]['error']
+
+    path = str(tmpdir.join('index.db'))
+    with azuremetadatafleet.FleetIndex(path) as index:
+        assert index.update(
+            [str(tmpdir), missing], select, processes=1
+        ) == {'evaluated': 4, 'unchanged': 0, 'removed': 0}
+        assert sorted(names(index.search(select))) == sorted(names(records))
+
+        # the missing source is looked for again
+        assert index.update(
+            [str(tmpdir), missing], processes=1
+        ) == {'evaluated': 1, 'unchanged': 3, 'removed': 0}
+        assert len(list(index.search(select))) == len(records)
@@ -0,0 +1,105 @@
+# Copyright (c) 2020 SUSE LLC
+#
+# This file is part of azuremetadata.
+#
+# azuremetadata is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# azuremetadata is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with azuremetadata.  If not, see <http://www.gnu.org/licenses/>.
+
+from azuremetadata import azuremetadata, azuremetadatakvp
+from mock import patch
+
+VM_ID = 'E01FCD50-213B-4559-8FDF-D98C0086CDE4'
+
+
+def record(key, value):
+    return key.encode('utf-8').ljust(azuremetadatakvp.KEY_SIZE, b'\x00') + \
+        value.encode('utf-8').ljust(azuremetadatakvp.VALUE_SIZE, b'\x00')
+
+
+def write_pools(path, pools):
+    for number, content in pools.items():
+        path.joinpath('.kvp_pool_{}'.format(number)).write_bytes(content)
+
+
+def test_kvp_pool(tmp_path):
+    write_pools(tmp_path, {
+        0: b'',
+        3: record('HostName', 'host-1') +
+        record('', '') +
+        record('VirtualMachineId', VM_ID) +
+        # a key and a value using the whole record
+        record('k' * 512, 'v' * 2048) +
+        # a record being written
+        record('Partial', 'foo')[:600],
+    })
+    tmp_path.joinpath('.kvp_pool_x').write_bytes(record('foo', 'bar'))
+
+    pool = azuremetadatakvp.KvpPool(str(tmp_path))
+    assert pool.pools == {
+        0: {},
+        3: {
+            'HostName': 'host-1',
+            'VirtualMachineId': VM_ID,
+            'k' * 512: 'v' * 2048,
+        },
+    }
+    assert pool.get('HostName') == 'host-1'
+    assert pool.get('HostName', pool=0) is None
+    assert pool.get_metadata()['VirtualMachineId'] == VM_ID
+
+    # the pools are read once
+    tmp_path.joinpath('.kvp_pool_3').unlink()
+    assert pool.get('HostName') == 'host-1'
+
+
+def test_kvp_pool_missing(tmp_path):
+    pool = azuremetadatakvp.KvpPool(str(tmp_path.joinpath('missing')))
+    assert pool.pools == {}
+    assert pool.get_metadata() == {}
+
+
+def test_get_all_kvp(tmp_path):
+    write_pools(tmp_path, {3: record('HostName', 'host-1')})
+    metadata = azuremetadata.AzureMetadata(
+        api_version='2017-04-02',
+        kvp_pool=azuremetadatakvp.KvpPool(str(tmp_path))
+    )
+
+    with patch.object(metadata, 'get_instance_data') as instance_mock:
+        instance_mock.return_value = {'compute': {}}
+        assert metadata.get_all() == {'compute': {}}
+        assert metadata.get_all(kvp=True) == {
+            'compute': {}, 'kvp': {'HostName': 'host-1'}
+        }
+
+        # the KVP data does not depend on the metadata server
+        instance_mock.return_value = {}
+        assert metadata.get_all(kvp=True) == {'kvp': {'HostName': 'host-1'}}
+
+
+def test_get_document_classic_kvp(tmp_path):
+    write_pools(tmp_path, {3: record('VirtualMachineId', VM_ID)})
+    metadata = azuremetadata.AzureMetadata(
+        api_version='2020-02-02',
+        kvp_pool=azuremetadatakvp.KvpPool(str(tmp_path))
+    )
+
+    with patch.object(metadata, 'get_instance_data') as instance_mock, \
+            patch.object(metadata, 'get_attested_data'), \
+            patch.object(metadata, 'is_classic') as classic_mock:
+        instance_mock.return_value = {'compute': {}}
+        classic_mock.return_value = True
+
+        data = metadata.get_document()
+
+    assert data['subscriptionId'] == 'classic-' + VM_ID.lower()
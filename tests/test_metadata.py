@@ -18,8 +18,19 @@
 from azuremetadata import azuremetadata
 from mock import patch, Mock
 import pytest
+import errno
+import http.client
 import json
-import urllib
+import os
+import socket
+
+
+def mock_response(connection_mock, body, status=200, reason='OK'):
+    response = connection_mock.return_value.getresponse.return_value
+    response.status = status
+    response.reason = reason
+    response.read.return_value = body
+    response.will_close = False
 
 
 def test_get_disk_tag():
@@ -29,105 +40,205 @@ def test_get_disk_tag():
     assert disk_tag == '00112233-4455-6677-8899-aabbccddeeff'
 
 
-@patch('urllib.request.urlopen')
-@patch('urllib.request.Request')
-def test_get_instance_data_default_api_version(request_mock, urlopen_mock):
+@patch('http.client.HTTPConnection')
+def test_get_instance_data_default_api_version(connection_mock):
     expected_data = {"foo": "bar"}
-    urlopen_mock.return_value.read.return_value = json.dumps(expected_data).encode('utf-8')
+    mock_response(connection_mock, json.dumps(expected_data).encode('utf-8'))
 
     metadata = azuremetadata.AzureMetadata()
     data = metadata.get_instance_data()
 
-    request_mock.assert_called_with(
-        'http://169.254.169.254/metadata/instance?api-version=2017-04-02',
+    connection_mock.assert_called_with('169.254.169.254', None, timeout=2)
+    connection_mock.return_value.request.assert_called_with(
+        'GET', '/metadata/instance?api-version=2017-04-02',
         headers={'Metadata': 'true'}
     )
     assert data == expected_data
 
 
-@patch('urllib.request.urlopen')
-@patch('urllib.request.Request')
-def test_get_instance_data(request_mock, urlopen_mock):
+@patch('http.client.HTTPConnection')
+def test_get_instance_data(connection_mock):
     expected_data = {"foo": "bar"}
-    urlopen_mock.return_value.read.return_value = json.dumps(expected_data)
+    mock_response(connection_mock, json.dumps(expected_data))
 
     metadata = azuremetadata.AzureMetadata(api_version='2020-02-02')
     data = metadata.get_instance_data()
 
-    request_mock.assert_called_with(
-        'http://169.254.169.254/metadata/instance?api-version=2020-02-02',
+    connection_mock.return_value.request.assert_called_with(
+        'GET', '/metadata/instance?api-version=2020-02-02',
         headers={'Metadata': 'true'}
     )
     assert data == expected_data
 
 
 @patch('sys.stderr')
-@patch('urllib.request.Request')
-def test_valid_request_http_error(request_mock, stderr_mock):
-    http_err = urllib.error.HTTPError(
-        'fake', 400, 'Bad Request', {'error': 'foo'}, stderr_mock
-    )
-    request_mock.side_effect = http_err
+@patch('http.client.HTTPConnection')
+def test_valid_request_http_error(connection_mock, stderr_mock):
+    mock_response(connection_mock, b'{"error": "foo"}', 400, 'Bad Request')
     metadata = azuremetadata.AzureMetadata(api_version='2020-02-02')
     result = metadata._make_request(
         'http://169.254.169.254/metadata/instance?api-version=2020-02-02'
     )
 
-    request_mock.assert_called_with(
-        'http://169.254.169.254/metadata/instance?api-version=2020-02-02',
+    connection_mock.return_value.request.assert_called_with(
+        'GET', '/metadata/instance?api-version=2020-02-02',
         headers={'Metadata': 'true'}
     )
+    assert connection_mock.return_value.request.call_count == 1
     assert result == {}
 
 
-@patch('urllib.request.Request')
-def test_valid_request_os_error(request_mock):
-    os_err = OSError
-    request_mock.side_effect = os_err
+@patch('azuremetadata.azuremetadata.sleep')
+@patch('http.client.HTTPConnection')
+def test_valid_request_os_error(connection_mock, sleep_mock):
+    connection_mock.return_value.request.side_effect = OSError
     metadata = azuremetadata.AzureMetadata(api_version='2020-02-02')
     metadata._make_request(
         'http://169.254.169.254/metadata/instance?api-version=2020-02-02'
     )
 
-    request_mock.assert_called_with(
-        'http://169.254.169.254/metadata/instance?api-version=2020-02-02',
+    connection_mock.return_value.request.assert_called_with(
+        'GET', '/metadata/instance?api-version=2020-02-02',
         headers={'Metadata': 'true'}
     )
-    assert request_mock.call_count == 5
+    assert connection_mock.return_value.request.call_count == 5
+    assert connection_mock.return_value.close.call_count == 5
+    assert sleep_mock.call_count == 4
+
+
+@patch('sys.stderr')
+@patch('azuremetadata.azuremetadata.sleep')
+@patch('http.client.HTTPConnection')
+def test_valid_request_connection_refused(connection_mock, sleep_mock,
+                                          stderr_mock):
+    connection_mock.return_value.request.side_effect = ConnectionRefusedError(
+        errno.ECONNREFUSED, 'Connection refused'
+    )
+    metadata = azuremetadata.AzureMetadata(api_version='2020-02-02')
+    result = metadata._make_request(
+        'http://169.254.169.254/metadata/instance?api-version=2020-02-02'
+    )
 
+    assert result == {}
+    assert connection_mock.return_value.request.call_count == 1
+    assert not sleep_mock.called
+
+
+@patch('azuremetadata.azuremetadata.sleep')
+@patch('http.client.HTTPConnection')
+def test_valid_request_retry_status(connection_mock, sleep_mock):
+    throttled = Mock(status=429, reason='Too Many Requests', will_close=False)
+    throttled.read.return_value = b''
+    throttled.headers = {'Retry-After': '1'}
+    unavailable = Mock(status=503, reason='Unavailable', will_close=False)
+    unavailable.read.return_value = b''
+    unavailable.headers = {}
+    ok = Mock(status=200, reason='OK', will_close=False)
+    ok.read.return_value = b'{"foo": "bar"}'
+    connection_mock.return_value.getresponse.side_effect = [
+        throttled, unavailable, ok
+    ]
+
+    metadata = azuremetadata.AzureMetadata(api_version='2020-02-02')
+    result = metadata._make_request(
+        'http://169.254.169.254/metadata/instance?api-version=2020-02-02'
+    )
+
+    assert result == {'foo': 'bar'}
+    assert sleep_mock.call_count == 2
+    # Retry-After is honored, the backoff is used otherwise
+    assert sleep_mock.call_args_list[0][0][0] == 1
+    assert 0 < sleep_mock.call_args_list[1][0][0] <= 0.5
+
+
+@patch('azuremetadata.azuremetadata.sleep')
+@patch('http.client.HTTPConnection')
+def test_request_rate_limited(connection_mock, sleep_mock):
+    throttled = Mock(status=429, reason='Too Many Requests', will_close=False)
+    throttled.read.return_value = b''
+    throttled.headers = {}
+    ok = Mock(status=200, reason='OK', will_close=False)
+    ok.read.return_value = b'{"foo": "bar"}'
+    connection_mock.return_value.getresponse.side_effect = [throttled, ok]
+    rate_limiter = Mock()
+
+    metadata = azuremetadata.AzureMetadata(
+        api_version='2020-02-02', rate_limiter=rate_limiter,
+        retry_policy=azuremetadata.RetryPolicy(deadline=10)
+    )
+    result = metadata._make_request(
+        'http://169.254.169.254/metadata/instance?api-version=2020-02-02'
+    )
 
-@patch('urllib.request.urlopen')
-@patch('urllib.request.Request')
-def test_get_attested_data_default_api_version(request_mock, urlopen_mock):
+    assert result == {'foo': 'bar'}
+    # every attempt takes a token within the deadline
+    assert rate_limiter.acquire.call_count == 2
+    assert 0 < rate_limiter.acquire.call_args[1]['max_wait'] <= 10
+    rate_limiter.throttled.assert_called_once_with()
+
+
+@patch('sys.stderr')
+@patch('azuremetadata.azuremetadata.sleep')
+@patch('azuremetadata.azuremetadata.monotonic')
+@patch('http.client.HTTPConnection')
+def test_valid_request_deadline(connection_mock, monotonic_mock, sleep_mock,
+                                stderr_mock):
+    monotonic_mock.return_value = 100
+    policy = azuremetadata.RetryPolicy(deadline=3)
+    metadata = azuremetadata.AzureMetadata(
+        api_version='2020-02-02', retry_policy=policy
+    )
+
+    # a request timing out takes the whole timeout
+    def timeout(*args, **kwargs):
+        monotonic_mock.return_value += 2
+        raise TimeoutError('timed out')
+
+    connection_mock.return_value.request.side_effect = timeout
+    assert metadata.get_instance_data() == {}
+    # the second attempt only gets the remaining second
+    assert connection_mock.return_value.timeout == 1
+
+    # the budget is shared by all requests
+    connection_mock.return_value.request.reset_mock()
+    assert metadata.get_attested_data() == {}
+    assert not connection_mock.return_value.request.called
+
+
+@patch('http.client.HTTPConnection')
+def test_get_attested_data_default_api_version(connection_mock):
     expected_data = {"foo": "bar"}
-    urlopen_mock.return_value.read.return_value = json.dumps(expected_data)
+    mock_response(connection_mock, json.dumps(expected_data))
 
     metadata = azuremetadata.AzureMetadata()
     data = metadata.get_attested_data()
 
-    request_mock.assert_called_with(
-        'http://169.254.169.254/metadata/attested/document?api-version=2017-04-02',
+    connection_mock.return_value.request.assert_called_with(
+        'GET', '/metadata/attested/document?api-version=2017-04-02',
         headers={'Metadata': 'true'}
     )
     assert data == expected_data
 
 
-@patch('urllib.request.urlopen')
-@patch('urllib.request.Request')
-def test_get_attested_data(request_mock, urlopen_mock):
+@patch('http.client.HTTPConnection')
+def test_get_attested_data(connection_mock):
     expected_data = {"foo": "bar"}
-    urlopen_mock.return_value.read.return_value = json.dumps(expected_data)
+    mock_response(connection_mock, json.dumps(expected_data))
 
     metadata = azuremetadata.AzureMetadata(api_version='2020-02-02')
     data = metadata.get_attested_data()
 
-    request_mock.assert_called_with(
-        'http://169.254.169.254/metadata/attested/document?api-version=2020-02-02',
+    connection_mock.return_value.request.assert_called_with(
+        'GET', '/metadata/attested/document?api-version=2020-02-02',
         headers={'Metadata': 'true'}
     )
     assert data == expected_data
 
 
+@patch(
+    'azuremetadata.azuremetadata.AzureMetadata._find_block_device_sysfs',
+    new=Mock(return_value=None)
+)
 @patch('azuremetadata.azuremetadata.AzureMetadata._get_lsblk_output')
 @pytest.mark.parametrize(
     "fixture_file_name,mountpoint,expected_device_name",
@@ -150,32 +261,30 @@ def test_find_block_device(
 
 
 @patch('sys.stderr')
-@patch('urllib.request.urlopen')
-@patch('urllib.request.Request')
-def test_get_latest_api_version(request_mock, urlopen_mock,
-                                stderr_mock):
+@patch('http.client.HTTPConnection')
+def test_get_latest_api_version(connection_mock, stderr_mock):
     output = {"newest-versions": ["foo"]}
-    stderr_mock.read.return_value = json.dumps(output).encode('utf-8')
-    http_err = urllib.error.HTTPError(
-        None, 400, 'Bad Request', 'error', stderr_mock
+    mock_response(
+        connection_mock, json.dumps(output).encode('utf-8'),
+        400, 'Bad Request'
     )
-    request_mock.side_effect = http_err
 
-    assert azuremetadata.AzureMetadata._get_api('latest') == 'foo'
-    request_mock.assert_called_with(
-        'http://169.254.169.254/metadata/instance',
+    metadata = azuremetadata.AzureMetadata()
+    assert metadata._get_api('latest') == 'foo'
+    connection_mock.return_value.request.assert_called_with(
+        'GET', '/metadata/instance',
         headers={'Metadata': 'true'}
     )
 
-    stderr_mock.read.return_value = b'{"error": "foo"}'
-    http_err = urllib.error.HTTPError(
-        None, 400, 'Bad Request', 'error', stderr_mock
-    )
-    request_mock.side_effect = http_err
-    assert azuremetadata.AzureMetadata._get_api('latest') == '2017-03-01'
+    mock_response(connection_mock, b'{"error": "foo"}', 400, 'Bad Request')
+    assert metadata._get_api('latest') == '2017-03-01'
 
 
 @patch('json.loads')
+@patch(
+    'azuremetadata.azuremetadata.AzureMetadata._find_block_device_sysfs',
+    new=Mock(return_value=None)
+)
 @patch('azuremetadata.azuremetadata.AzureMetadata._get_lsblk_output')
 def test_find_block_device_json_error(lsblk_mock, json_loads_mock):
     lsblk_mock.return_value = (b'foo', None)
@@ -186,6 +295,10 @@ def test_find_block_device_json_error(lsblk_mock, json_loads_mock):
 
 
 @patch('json.loads')
+@patch(
+    'azuremetadata.azuremetadata.AzureMetadata._find_block_device_sysfs',
+    new=Mock(return_value=None)
+)
 @patch('azuremetadata.azuremetadata.AzureMetadata._get_lsblk_output')
 def test_find_block_device_empty_lsblk(lsblk_mock, json_loads_mock):
     lsblk_mock.return_value = (b"{'foo':'ar'}", None)
@@ -195,6 +308,10 @@ def test_find_block_device_empty_lsblk(lsblk_mock, json_loads_mock):
     assert device is None
 
 
+@patch(
+    'azuremetadata.azuremetadata.AzureMetadata._find_block_device_sysfs',
+    new=Mock(return_value=None)
+)
 @patch('azuremetadata.azuremetadata.AzureMetadata._get_lsblk_output')
 def test_find_block_device_no_blocks(lsblk_mock):
     lsblk_mock.return_value = (None, None)
@@ -233,27 +350,179 @@ def test_get_disk_tag_os_error(find_block_device_mock, print_mock):
     assert disk_tag == ''
 
 
-@patch('urllib.request.urlopen')
-@patch('urllib.request.Request')
-def test_get_all(request_mock, urlopen_mock):
+@patch('http.client.HTTPConnection')
+def test_get_all(connection_mock):
     expected_data = {"foo": "bar"}
-    urlopen_mock.return_value.read.return_value = json.dumps(expected_data)
+    mock_response(connection_mock, json.dumps(expected_data))
 
     metadata = azuremetadata.AzureMetadata(api_version='2020-02-02')
     data = metadata.get_all()
 
-    request_mock.assert_called_with(
-        'http://169.254.169.254/metadata/attested/document?api-version=2020-02-02',
+    # both documents are fetched concurrently, the order is not defined
+    connection_mock.return_value.request.assert_any_call(
+        'GET', '/metadata/instance?api-version=2020-02-02',
+        headers={'Metadata': 'true'}
+    )
+    connection_mock.return_value.request.assert_any_call(
+        'GET', '/metadata/attested/document?api-version=2020-02-02',
         headers={'Metadata': 'true'}
     )
     assert data['attestedData'] == expected_data
     assert data['foo'] == 'bar'
 
+
+@patch('http.client.HTTPConnection')
+def test_get_all_no_attested_data(connection_mock):
+    mock_response(connection_mock, '{"foo": "bar"}')
+
+    metadata = azuremetadata.AzureMetadata(api_version='2017-04-02')
+
+    assert metadata.get_all() == {'foo': 'bar'}
+    connection_mock.return_value.request.assert_called_once_with(
+        'GET', '/metadata/instance?api-version=2017-04-02',
+        headers={'Metadata': 'true'}
+    )
+
+
+def test_fetch_plan():
+    plan = azuremetadata.FetchPlan()
+    plan.add('foo', lambda: 1).add('bar', lambda x: x * 2, 21)
+
+    assert len(plan) == 2
+    assert list(plan.run().items()) == [('foo', 1), ('bar', 42)]
+
+
+def test_fetch_plan_exception():
+    def fail():
+        raise ValueError('oh no')
+
+    plan = azuremetadata.FetchPlan()
+    plan.add('foo', lambda: 1).add('bar', fail)
+
+    with pytest.raises(ValueError):
+        plan.run()
+
+
+def test_fetch_plan_merge_results():
+    metadata = azuremetadata.AzureMetadata(api_version='2020-02-02')
+
+    with patch.object(metadata, 'get_instance_data') as instance_mock, \
+            patch.object(metadata, 'get_attested_data') as attested_mock:
+        instance_mock.return_value = {'compute': {}}
+        attested_mock.return_value = {'signature': 'foo'}
+        plan = metadata.fetch_plan().add('billingTag', lambda: 'tag')
+        data = metadata.merge_results(plan.run())
+
+    assert data == {
+        'compute': {},
+        'attestedData': {'signature': 'foo'},
+        'billingTag': 'tag'
+    }
+
+
+@patch('azuremetadata.azuremetadata.sleep')
+@patch('http.client.HTTPConnection')
+def test_is_classic(connection_mock, sleep_mock):
+    mock_response(connection_mock, b'{}')
+    metadata = azuremetadata.AzureMetadata()
+    assert not metadata.is_classic()
+    connection_mock.return_value.request.assert_called_with(
+        'GET', '/metadata/instance/compute?api-version=2019-11-01',
+        headers={'Metadata': 'true'}
+    )
+
+    mock_response(connection_mock, b'Not found', 404, 'Not Found')
+    assert metadata.is_classic()
+
+    mock_response(connection_mock, b'Error', 500, 'Internal Server Error')
+    assert not metadata.is_classic()
+
+    connection_mock.return_value.request.side_effect = OSError
+    assert not metadata.is_classic()
+
+
+@patch('http.client.HTTPConnection')
+def test_connection_reuse(connection_mock):
+    mock_response(connection_mock, b'{}')
+    metadata = azuremetadata.AzureMetadata()
+    metadata.is_classic()
+    metadata.get_instance_data()
+    metadata.list_api_versions()
+
+    assert connection_mock.call_count == 1
+    assert connection_mock.return_value.request.call_count == 3
+
+    metadata.close()
+    connection_mock.return_value.close.assert_called_once_with()
+
+
+@patch('http.client.HTTPConnection')
+def test_connection_will_close(connection_mock):
+    mock_response(connection_mock, b'{}')
+    connection_mock.return_value.getresponse.return_value.will_close = True
+    metadata = azuremetadata.AzureMetadata()
+    metadata.get_instance_data()
+    metadata.get_instance_data()
+
+    assert connection_mock.call_count == 2
+    assert connection_mock.return_value.close.call_count == 2
+
+
+@patch('http.client.HTTPConnection')
+def test_connection_stale(connection_mock):
+    stale = Mock()
+    stale.request.side_effect = http.client.RemoteDisconnected
+    fresh = Mock()
+    fresh.getresponse.return_value.status = 200
+    fresh.getresponse.return_value.read.return_value = b'{"foo": "bar"}'
+    fresh.getresponse.return_value.will_close = False
+    connection_mock.return_value = fresh
+
+    pool = azuremetadata.ConnectionPool()
+    pool._release('169.254.169.254', None, stale)
+    metadata = azuremetadata.AzureMetadata(pool=pool)
+
+    assert metadata.get_instance_data() == {'foo': 'bar'}
+    stale.close.assert_called_once_with()
+    assert connection_mock.call_count == 1
+
+
+def test_connection_timeout_not_retried():
+    # the server accepts connections but never answers
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(4)
+    host, port = server.getsockname()
+
+    pool = azuremetadata.ConnectionPool()
+    idle = http.client.HTTPConnection(host, port)
+    idle.connect()
+    pool._release(host, port, idle)
+
+    accepted = []
+    try:
+        with pytest.raises(socket.timeout):
+            pool.request(
+                'http://{}:{}/metadata'.format(host, port), timeout=0.2
+            )
+
+        # no second connection was opened
+        server.setblocking(False)
+        while True:
+            try:
+                accepted.append(server.accept()[0])
+            except BlockingIOError:
+                break
+        assert len(accepted) == 1
+    finally:
+        for conn in accepted:
+            conn.close()
+        pool.close()
+        server.close()
+
 @patch('sys.stderr')
-@patch('urllib.request.urlopen')
-@patch('urllib.request.Request')
-def test_show_api_versions(mock_request, urlopen_mock,
-                           stderr_mock):
+@patch('http.client.HTTPConnection')
+def test_show_api_versions(connection_mock, stderr_mock):
     api_output = {
         'apiVersions':[
             '2017-03-01',
@@ -273,22 +542,395 @@ def test_show_api_versions(mock_request, urlopen_mock,
         '2017-03-01'
     ]
 
-    urlopen_mock.return_value.read.return_value = json.dumps(api_output)
+    mock_response(connection_mock, json.dumps(api_output))
     metadata = azuremetadata.AzureMetadata()
     assert metadata.list_api_versions() == expected_versions
-    mock_request.assert_called_with(
-        'http://169.254.169.254/metadata/versions',
+    connection_mock.return_value.request.assert_called_with(
+        'GET', '/metadata/versions',
         headers={'Metadata': 'true'}
     )
 
-    mock_request.assert_called_with(
-        'http://169.254.169.254/metadata/versions',
+    mock_response(connection_mock, b'{"error": "foo"}', 400, 'Bad Request')
+    assert metadata.list_api_versions() == ['2017-03-01']
+
+
+def test_retry_policy_delay():
+    policy = azuremetadata.RetryPolicy(
+        attempts=10, backoff=1, max_backoff=4, jitter=0
+    )
+
+    assert [policy.delay(attempt) for attempt in range(1, 6)] == \
+        [1, 2, 4, 4, 4]
+    assert policy.delay(10) is None
+    assert policy.delay(1, retry_after=3) == 3
+    assert policy.delay(1, retry_after=7) == 4
+
+    # a Retry-After of an hour does not hold up the request for an hour
+    policy = azuremetadata.RetryPolicy()
+    retry_after = policy.parse_retry_after('3600')
+    assert policy.delay(1, retry_after) == policy.max_backoff
+    assert policy.max_duration() < 3600
+
+    policy = azuremetadata.RetryPolicy(backoff=1, jitter=0.5)
+    for _ in range(20):
+        assert 0.5 <= policy.delay(1) <= 1
+
+
+@patch('azuremetadata.azuremetadata.monotonic')
+def test_retry_policy_deadline(monotonic_mock):
+    monotonic_mock.return_value = 10
+    policy = azuremetadata.RetryPolicy(timeout=2, deadline=5, jitter=0)
+    assert policy.remaining() == 5
+    assert policy.attempt_timeout() == 2
+
+    monotonic_mock.return_value = 14
+    assert policy.attempt_timeout() == 1
+    # the backoff would outlast the deadline
+    assert policy.delay(1, retry_after=2) is None
+
+    monotonic_mock.return_value = 16
+    assert policy.attempt_timeout() == 0
+
+    assert azuremetadata.RetryPolicy().remaining() is None
+
+
+@patch('azuremetadata.azuremetadata.monotonic')
+def test_retry_policy_max_duration(monotonic_mock):
+    monotonic_mock.return_value = 10
+    policy = azuremetadata.RetryPolicy(attempts=3, timeout=2, max_backoff=1)
+    assert policy.max_duration() == 9
+
+    policy = azuremetadata.RetryPolicy(
+        attempts=3, timeout=2, max_backoff=1, deadline=5
+    )
+    assert policy.max_duration() == 5
+    monotonic_mock.return_value = 14
+    assert policy.max_duration() == 1
+
+
+def test_retry_policy_parse_retry_after():
+    parse = azuremetadata.RetryPolicy.parse_retry_after
+
+    assert parse('5') == 5
+    assert parse('-1') == 0
+    assert parse('Wed, 21 Oct 2015 07:28:00 GMT') == 0
+    assert parse('foo') is None
+    assert parse(None) is None
+
+
+@patch('http.client.HTTPConnection')
+def test_get_instance_path(connection_mock):
+    mock_response(connection_mock, b'{"ipv4": {}}')
+    metadata = azuremetadata.AzureMetadata(api_version='2020-02-02')
+
+    assert metadata.get_instance_path(('network', 'interface', 0)) == \
+        {'ipv4': {}}
+    connection_mock.return_value.request.assert_called_with(
+        'GET', '/metadata/instance/network/interface/0'
+        '?api-version=2020-02-02',
         headers={'Metadata': 'true'}
     )
 
-    stderr_mock.read.return_value = b'{"error": "foo"}'
-    http_err = urllib.error.HTTPError(
-        None, 400, 'Bad Request', 'error', stderr_mock
+
+@pytest.mark.parametrize(
+    "query,expected_path,path_data,expected_data",
+    [
+        (
+            [('compute', True), ('vmId', True)],
+            ['compute'],
+            {'vmId': 'foo'},
+            {'compute': {'vmId': 'foo'}}
+        ),
+        (
+            [('network', True), ('interface', 1), ('ipv4', True),
+             ('ipAddress', 0), ('privateIpAddress', True)],
+            ['network', 'interface', 1, 'ipv4'],
+            {'ipAddress': [{'privateIpAddress': '10.0.0.4'}]},
+            {'network': {'interface': [{}, {'ipv4': {
+                'ipAddress': [{'privateIpAddress': '10.0.0.4'}]
+            }}]}}
+        ),
+    ]
+)
+def test_get_query_data(query, expected_path, path_data, expected_data):
+    metadata = azuremetadata.AzureMetadata(api_version='2020-02-02')
+
+    with patch.object(metadata, 'get_instance_path') as path_mock:
+        path_mock.return_value = path_data
+        assert metadata.get_query_data(query) == expected_data
+
+    path_mock.assert_called_once_with(expected_path, quiet=True)
+
+
+@pytest.mark.parametrize(
+    "query",
+    [
+        [],
+        [('vmId', True)],
+        [('compute', True)],
+        [('billingTag', True)],
+    ]
+)
+def test_get_query_data_not_narrowed(query):
+    metadata = azuremetadata.AzureMetadata(api_version='2020-02-02')
+
+    with patch.object(metadata, 'get_instance_path') as path_mock:
+        assert metadata.get_query_data(query) is None
+
+    assert not path_mock.called
+
+
+@pytest.mark.parametrize(
+    "query",
+    [
+        # the second 'name' is ambiguous in the full document
+        [('compute', True), ('storageProfile', True), ('osDisk', True),
+         ('name', True), ('name', True)],
+        [('compute', True), ('storageProfile', True), ('osDisk', True)],
+        [('compute', True), ('storageProfile', True), ('foo', True)],
+        [('compute', True), ('storageProfile', True), ('osDisk', True),
+         ('name', True), ('foo', True)],
+    ]
+)
+def test_get_query_data_not_single_value(query):
+    metadata = azuremetadata.AzureMetadata(api_version='2020-02-02')
+
+    with patch.object(metadata, 'get_instance_path') as path_mock:
+        path_mock.return_value = {'osDisk': {'name': 'disk'}}
+        assert metadata.get_query_data(query) is None
+
+
+def test_get_query_data_attested():
+    metadata = azuremetadata.AzureMetadata(api_version='2020-02-02')
+    query = [('attestedData', True), ('signature', True)]
+
+    with patch.object(metadata, '_get_document') as document_mock, \
+            patch.object(metadata, 'get_instance_path') as path_mock:
+        document_mock.return_value = {'signature': 'foo'}
+        assert metadata.get_query_data(query) == \
+            {'attestedData': {'signature': 'foo'}}
+        document_mock.assert_called_once_with(
+            'attested', 'http://169.254.169.254/metadata/attested/document'
+            '?api-version=2020-02-02', quiet=True
+        )
+
+        document_mock.return_value = None
+        assert metadata.get_query_data(query) is None
+
+    assert not path_mock.called
+
+    metadata.set_api_version('2017-04-02')
+    assert metadata.get_query_data(query) is None
+
+
+@patch('sys.stderr')
+@patch('http.client.HTTPConnection')
+def test_get_query_data_not_found(connection_mock, stderr_mock):
+    mock_response(connection_mock, b'Not found', 404, 'Not Found')
+    metadata = azuremetadata.AzureMetadata(api_version='2020-02-02')
+
+    assert metadata.get_query_data(
+        [('compute', True), ('vmId', True), ('location', True)]
+    ) is None
+    # a path the server does not know is not an error, the full document
+    # tells what is wrong with the query
+    assert not stderr_mock.write.called
+
+
+@patch('azuremetadata.azuremetadata.sleep')
+@patch('sys.stderr')
+@patch('http.client.HTTPConnection')
+def test_get_query_data_error(connection_mock, stderr_mock, sleep_mock):
+    query = [('compute', True), ('vmId', True)]
+    mock_response(connection_mock, b'Unavailable', 503, 'Service Unavailable')
+    metadata = azuremetadata.AzureMetadata(
+        api_version='2020-02-02',
+        retry_policy=azuremetadata.RetryPolicy(attempts=2)
     )
-    mock_request.side_effect = http_err
-    assert metadata.list_api_versions() == ['2017-03-01']
+
+    # the full document would fail the same way, the caller reports it
+    with pytest.raises(azuremetadata.RequestError) as error:
+        metadata.get_query_data(query)
+    assert str(error.value) == 'HTTP Error 503: Service Unavailable'
+    assert connection_mock.return_value.request.call_count == 2
+
+    connection_mock.return_value.request.side_effect = \
+        ConnectionRefusedError(errno.ECONNREFUSED, 'Connection refused')
+    with pytest.raises(azuremetadata.RequestError):
+        metadata.get_query_data(query)
+
+    assert not stderr_mock.write.called
+
+
+def make_sysfs(path, fixture_file_name):
+    """Create mountinfo and a sysfs tree mirroring an lsblk fixture."""
+    with open(str.format('./fixtures/{}', fixture_file_name)) as file:
+        blockdevices = json.load(file)['blockdevices']
+
+    dev_block = path / 'dev' / 'block'
+    dev_block.mkdir(parents=True)
+    virtual = path / 'devices' / 'virtual' / 'block'
+    virtual.mkdir(parents=True)
+    mountinfo = []
+
+    def add(device, parent_path):
+        if device['type'] in ('disk', 'rom'):
+            device_path = path / 'devices' / device['name']
+        elif device['type'] == 'part':
+            device_path = parent_path / device['name']
+        else:
+            device_path = virtual / device['name']
+        device_path.mkdir(parents=True, exist_ok=True)
+        if device['type'] == 'part':
+            (device_path / 'partition').write_text('1')
+        elif parent_path:
+            (device_path / 'slaves').mkdir(exist_ok=True)
+            os.symlink(
+                str(parent_path),
+                str(device_path / 'slaves' / parent_path.name)
+            )
+        os.symlink(str(device_path), str(dev_block / device['maj:min']))
+
+        mounts = device.get('mountpoints') or [device.get('mountpoint')]
+        for mount in mounts:
+            if mount and mount.startswith('/'):
+                mountinfo.append(
+                    '1 2 {} / {} rw - ext4 /dev/{} rw'.format(
+                        device['maj:min'], mount.replace(' ', '\\040'),
+                        device['name']
+                    )
+                )
+
+        for child in device.get('children', []):
+            add(child, device_path)
+
+    for blockdevice in blockdevices:
+        add(blockdevice, None)
+
+    (path / 'mountinfo').write_text('\n'.join(mountinfo) + '\n')
+
+
+@patch('azuremetadata.azuremetadata.AzureMetadata._get_lsblk_output')
+@pytest.mark.parametrize(
+    "fixture_file_name,mountpoint,expected_device_name",
+    [
+        ('lsblk.json', '/', '/dev/sda'),
+        ('lsblk.json', '/mnt', '/dev/sdb'),
+        ('lsblk-lvm.json', '/', '/dev/sda'),
+        ('lsblk-lvm.json', '/home', '/dev/sda'),
+        ('lsblk-nvme.json', '/', '/dev/nvme0n1'),
+        ('lsblk-2.37.2.json', '/', '/dev/xvda')
+    ]
+)
+def test_find_block_device_sysfs(
+        lsblk_mock, fixture_file_name, mountpoint, expected_device_name,
+        tmp_path):
+    make_sysfs(tmp_path, fixture_file_name)
+
+    with patch.object(azuremetadata.AzureMetadata, '_MOUNTINFO',
+                      str(tmp_path / 'mountinfo')), \
+            patch.object(azuremetadata.AzureMetadata, '_SYS_DEV_BLOCK',
+                         str(tmp_path / 'dev' / 'block')):
+        device = azuremetadata.AzureMetadata._find_block_device(mountpoint)
+
+    assert device == expected_device_name
+    assert not lsblk_mock.called
+
+
+@patch('azuremetadata.azuremetadata.AzureMetadata._get_lsblk_output')
+def test_find_block_device_sysfs_fallback(lsblk_mock, tmp_path):
+    (tmp_path / 'mountinfo').write_text(
+        '1 2 0:42 / / rw - overlay overlay rw\n'
+    )
+    with open('./fixtures/lsblk.json', 'rb') as file:
+        lsblk_mock.return_value = (file.read(), None)
+
+    with patch.object(azuremetadata.AzureMetadata, '_MOUNTINFO',
+                      str(tmp_path / 'mountinfo')):
+        device = azuremetadata.AzureMetadata._find_block_device('/')
+
+    assert device == '/dev/sda'
+    assert lsblk_mock.called
+
+
+def test_get_mount_devnum(tmp_path):
+    (tmp_path / 'mountinfo').write_text(
+        '1 2 8:1 / /mnt/my\\040disk rw shared:1 - ext4 /dev/sda1 rw\n'
+        '3 1 8:2 / / rw - ext4 /dev/sda2 rw\n'
+        '4 1 8:3 / / rw - ext4 /dev/sda3 rw\n'
+    )
+
+    with patch.object(azuremetadata.AzureMetadata, '_MOUNTINFO',
+                      str(tmp_path / 'mountinfo')):
+        get_mount_devnum = azuremetadata.AzureMetadata._get_mount_devnum
+        assert get_mount_devnum('/mnt/my disk') == '8:1'
+        # the last mount wins
+        assert get_mount_devnum('/') == '8:3'
+        assert get_mount_devnum('/foo') is None
+
+
+def test_get_document():
+    metadata = azuremetadata.AzureMetadata(api_version='2020-02-02')
+
+    with patch.object(metadata, 'get_instance_data') as instance_mock, \
+            patch.object(metadata, 'get_attested_data') as attested_mock, \
+            patch.object(metadata, 'get_disk_tag') as disk_tag_mock, \
+            patch.object(metadata, 'is_classic') as classic_mock:
+        instance_mock.return_value = {'compute': {}}
+        attested_mock.return_value = {'signature': 'foo'}
+        disk_tag_mock.return_value = 'tag'
+        classic_mock.return_value = False
+
+        assert metadata.get_document() == {
+            'compute': {},
+            'attestedData': {'signature': 'foo'},
+        }
+        assert list(metadata.get_document(disk_tag=True).keys()) == \
+            ['billingTag', 'compute', 'attestedData']
+
+        classic_mock.reset_mock()
+        metadata.get_document(classic=False)
+        assert not classic_mock.called
+
+
+@patch('os.path.exists')
+def test_get_document_classic(exists_mock):
+    exists_mock.return_value = False
+    metadata = azuremetadata.AzureMetadata(api_version='2020-02-02')
+
+    with patch.object(metadata, 'get_instance_data') as instance_mock, \
+            patch.object(metadata, 'get_attested_data') as attested_mock, \
+            patch.object(metadata, 'is_classic') as classic_mock:
+        instance_mock.return_value = {'compute': {}}
+        classic_mock.return_value = True
+
+        data = metadata.get_document()
+
+    assert metadata._api_version == '2017-04-02'
+    assert data['subscriptionId'].startswith('classic-')
+    assert data['attestedData'] == {'signature': ''}
+    assert data['signature'] == ''
+    assert data['compute'] == {}
+    # attested data is not available in ASM, it is not requested before
+    # the probe has answered
+    assert not attested_mock.called
+
+
+def test_get_document_classic_known():
+    metadata = azuremetadata.AzureMetadata(api_version='2020-02-02')
+
+    with patch.object(metadata, 'get_instance_data') as instance_mock, \
+            patch.object(metadata, 'get_attested_data') as attested_mock, \
+            patch.object(metadata, 'is_classic') as classic_mock, \
+            patch.object(metadata, '_boot_lookup') as lookup_mock:
+        instance_mock.return_value = {'compute': {}}
+        lookup_mock.return_value = True
+
+        data = metadata.get_document()
+
+        # the probe of this boot is used, ASM is not probed again
+        assert not classic_mock.called
+        assert instance_mock.call_count == 1
+        assert not attested_mock.called
+        assert data['subscriptionId'].startswith('classic-')
+        assert metadata._api_version == '2017-04-02'
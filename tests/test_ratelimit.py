@@ -0,0 +1,172 @@
+# Copyright (c) 2020 SUSE LLC
+#
+# This file is part of azuremetadata.
+#
+# azuremetadata is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# azuremetadata is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with azuremetadata.  If not, see <http://www.gnu.org/licenses/>.
+
+import errno
+import os
+import stat
+
+import pytest
+
+from azuremetadata import azuremetadataratelimit
+from mock import patch
+
+
+@patch('azuremetadata.azuremetadataratelimit.sleep')
+@patch('azuremetadata.azuremetadataratelimit.monotonic')
+def test_rate_limiter(monotonic_mock, sleep_mock, tmp_path):
+    monotonic_mock.return_value = 100
+    limiter = azuremetadataratelimit.RateLimiter(
+        str(tmp_path / 'ratelimit'), rate=2, burst=3
+    )
+
+    # the burst is available right away
+    assert [limiter.acquire() for _ in range(3)] == [0, 0, 0]
+    assert not sleep_mock.called
+
+    # then requests queue up, one every 0.5 seconds
+    assert limiter.acquire() == 0.5
+    assert limiter.acquire() == 1
+    assert sleep_mock.call_count == 2
+
+    # the bucket refills over time
+    monotonic_mock.return_value = 103
+    assert limiter.acquire() == 0
+    assert limiter.stats() == {'waits': 2, 'wait_time': 1.5}
+
+
+@patch('azuremetadata.azuremetadataratelimit.sleep')
+@patch('azuremetadata.azuremetadataratelimit.monotonic')
+def test_rate_limiter_shared(monotonic_mock, sleep_mock, tmp_path):
+    monotonic_mock.return_value = 100
+    path = str(tmp_path / 'ratelimit')
+    first = azuremetadataratelimit.RateLimiter(path, rate=1, burst=1)
+    second = azuremetadataratelimit.RateLimiter(path, rate=1, burst=1)
+
+    assert first.acquire() == 0
+    assert second.acquire() == 1
+    assert first.acquire() == 2
+
+
+@patch('azuremetadata.azuremetadataratelimit.sleep')
+@patch('azuremetadata.azuremetadataratelimit.monotonic')
+def test_rate_limiter_max_wait(monotonic_mock, sleep_mock):
+    monotonic_mock.return_value = 100
+    limiter = azuremetadataratelimit.RateLimiter(rate=1, burst=1)
+
+    assert limiter.acquire(max_wait=0) == 0
+    with pytest.raises(TimeoutError):
+        limiter.acquire(max_wait=0.5)
+    # the failed attempt did not take a token
+    assert limiter.acquire(max_wait=1) == 1
+
+
+@patch('azuremetadata.azuremetadataratelimit.sleep')
+@patch('azuremetadata.azuremetadataratelimit.monotonic')
+def test_rate_limiter_throttled(monotonic_mock, sleep_mock):
+    monotonic_mock.return_value = 100
+    limiter = azuremetadataratelimit.RateLimiter(rate=4, burst=4)
+
+    limiter.throttled()
+    assert limiter.acquire() == 0.25
+
+
+@patch('azuremetadata.azuremetadataratelimit.sleep')
+@patch('azuremetadata.azuremetadataratelimit.monotonic')
+def test_rate_limiter_invalid_state(monotonic_mock, sleep_mock, tmp_path):
+    path = str(tmp_path / 'ratelimit')
+    with open(path, 'wb') as fh:
+        fh.write(b'garbage')
+
+    monotonic_mock.return_value = 100
+    limiter = azuremetadataratelimit.RateLimiter(path, rate=1, burst=1)
+    assert limiter.acquire() == 0
+
+    # state from a time in the future is reset
+    monotonic_mock.return_value = 50
+    assert limiter.acquire() == 0
+
+
+def test_rate_limiter_unusable_path(tmp_path):
+    blocker = tmp_path / 'file'
+    blocker.write_text('')
+    limiter = azuremetadataratelimit.RateLimiter(
+        str(blocker / 'ratelimit'), rate=10
+    )
+
+    # falls back to a bucket of the process
+    assert limiter.acquire() == 0
+    assert not os.path.exists(str(blocker / 'ratelimit'))
+
+
+def test_rate_limiter_state_permissions(tmp_path):
+    path = tmp_path / 'shared' / 'state'
+    limiter = azuremetadataratelimit.RateLimiter(str(path), rate=10)
+
+    old_umask = os.umask(0o077)
+    try:
+        assert limiter.acquire() == 0
+    finally:
+        os.umask(old_umask)
+
+    # other users share the state
+    assert stat.S_IMODE(os.stat(str(path.parent)).st_mode) == 0o1777
+    assert stat.S_IMODE(os.stat(str(path)).st_mode) == 0o666
+
+
+def test_rate_limiter_no_symlink(tmp_path):
+    target = tmp_path / 'target'
+    target.write_bytes(b'')
+    path = tmp_path / 'ratelimit'
+    path.symlink_to(target)
+
+    limiter = azuremetadataratelimit.RateLimiter(str(path), rate=10)
+    assert limiter.acquire() == 0
+    assert target.read_bytes() == b''
+
+
+@patch('os.pwrite')
+@patch('azuremetadata.azuremetadataratelimit.sleep')
+@patch('azuremetadata.azuremetadataratelimit.monotonic')
+def test_rate_limiter_write_error(
+        monotonic_mock, sleep_mock, pwrite_mock, tmp_path
+):
+    monotonic_mock.return_value = 100
+    pwrite_mock.side_effect = OSError(errno.ENOSPC, 'No space left on device')
+    limiter = azuremetadataratelimit.RateLimiter(
+        str(tmp_path / 'ratelimit'), rate=1, burst=1
+    )
+
+    # falls back to a bucket of the process
+    assert limiter.acquire() == 0
+    assert limiter.acquire() == 1
+
+
+@patch('azuremetadata.azuremetadataratelimit.sleep')
+@patch('azuremetadata.azuremetadataratelimit.monotonic')
+def test_rate_limiter_queue_bound(monotonic_mock, sleep_mock, tmp_path):
+    path = str(tmp_path / 'ratelimit')
+    with open(path, 'wb') as fh:
+        fh.write(azuremetadataratelimit.RateLimiter._STATE.pack(-1e9, 100))
+
+    monotonic_mock.return_value = 100
+    limiter = azuremetadataratelimit.RateLimiter(path, rate=1, burst=1)
+    assert limiter.acquire() == 61
+
+
+def test_default_state_path():
+    assert azuremetadataratelimit.default_state_path() == \
+        '/run/azuremetadata-ratelimit/state'
@@ -0,0 +1,89 @@
+# Copyright (c) 2020 SUSE LLC
+#
+# This file is part of azuremetadata.
+#
+# azuremetadata is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# azuremetadata is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with azuremetadata.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+
+from azuremetadata import azuremetadataschema
+from azuremetadata.azuremetadatautils import AzureMetadataUtils
+
+
+def test_make_schema():
+    document = {
+        'compute': {'vmId': 'foo', 'publicKeys': [
+            {'keyData': 'a', 'path': 'b'}, {'keyData': 'c', 'path': 'd'}
+        ]},
+        'network': {'interface': []},
+    }
+
+    assert azuremetadataschema.make_schema(document) == {
+        'compute': {'vmId': '', 'publicKeys': [{'keyData': '', 'path': ''}]},
+        'network': {'interface': []},
+    }
+
+
+def test_bundled_schemas_match_fixtures():
+    for version, attested in (
+            ('2017-04-02', None),
+            ('2019-08-15', 'fixtures/attested-data-v2019-08-15.json')
+    ):
+        with open('fixtures/metadata-v{}.json'.format(version)) as fh:
+            document = json.load(fh)
+        if attested:
+            with open(attested) as fh:
+                document['attestedData'] = json.load(fh)
+
+        schema = azuremetadataschema.load_schema(version)
+        assert schema == azuremetadataschema.make_schema(document)
+        # every key of the fixture can be queried with the schema
+        assert AzureMetadataUtils(schema).available_params.keys() == \
+            AzureMetadataUtils(document).available_params.keys()
+
+
+def test_load_schema_version(tmp_path):
+    for version in ('2017-04-02', '2019-08-15'):
+        with open(str(tmp_path / (version + '.json')), 'w') as fh:
+            json.dump({'version': version}, fh)
+    path = str(tmp_path)
+
+    assert azuremetadataschema.available_versions(path) == [
+        '2017-04-02', '2019-08-15'
+    ]
+    assert azuremetadataschema.load_schema(path=path) == {
+        'version': '2017-04-02'
+    }
+    assert azuremetadataschema.load_schema('latest', path) == {
+        'version': '2019-08-15'
+    }
+    assert azuremetadataschema.load_schema('2019-03-11', path) == {
+        'version': '2017-04-02'
+    }
+    assert azuremetadataschema.load_schema('2021-02-01', path) == {
+        'version': '2019-08-15'
+    }
+    # older than anything bundled
+    assert azuremetadataschema.load_schema('2017-03-01', path) == {
+        'version': '2017-04-02'
+    }
+
+
+def test_load_schema_missing(tmp_path):
+    assert azuremetadataschema.available_versions(
+        str(tmp_path / 'missing')
+    ) == []
+    assert azuremetadataschema.load_schema(
+        path=str(tmp_path / 'missing')
+    ) is None
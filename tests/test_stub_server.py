@@ -0,0 +1,211 @@
+# Copyright (c) 2020 SUSE LLC
+#
+# This file is part of azuremetadata.
+#
+# azuremetadata is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# azuremetadata is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with azuremetadata.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import importlib.util
+import json
+import os
+import random
+import threading
+
+import pytest
+
+from azuremetadata import azuremetadata
+from mock import patch
+
+# stub_server.py is a script in the top directory, not a module
+_spec = importlib.util.spec_from_file_location(
+    'stub_server',
+    os.path.join(os.path.dirname(__file__), '..', 'stub_server.py')
+)
+stub_server = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(stub_server)
+
+HEADERS = {'metadata': 'true'}
+
+
+def make_simulator(**kwargs):
+    return stub_server.Simulator(
+        stub_server.load_fixtures(stub_server.FIXTURES), **kwargs
+    )
+
+
+def body(response):
+    return json.loads(response[3])
+
+
+@pytest.fixture
+def server():
+    """Run a simulator in a thread, yield a function starting it."""
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever)
+    thread.start()
+    servers = []
+
+    def start(simulator):
+        server = asyncio.run_coroutine_threadsafe(asyncio.start_server(
+            simulator.handle, '127.0.0.1', 0
+        ), loop).result()
+        servers.append((server, simulator))
+        return server.sockets[0].getsockname()[1]
+
+    yield start
+
+    for server, simulator in servers:
+        server.close()
+        asyncio.run_coroutine_threadsafe(simulator.close(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
+
+
+def redirected_pool(port):
+    class Pool(azuremetadata.ConnectionPool):
+        def _acquire(self, *args, **kwargs):
+            conn, reused = super()._acquire(*args, **kwargs)
+            conn.host, conn.port = '127.0.0.1', port
+            return conn, reused
+    return Pool()
+
+
+def test_documents():
+    simulator = make_simulator()
+    response = simulator.respond(
+        'GET', '/metadata/instance?api-version=2019-08-15', HEADERS
+    )
+    assert response[0] == 200
+    assert body(response)['compute']['vmId'] == \
+        'e01fcd50-213b-4559-8fdf-d98c0086cde4'
+
+    response = simulator.respond(
+        'GET', '/metadata/instance/network/interface/1/macAddress'
+               '?api-version=2019-08-15', HEADERS
+    )
+    assert body(response) == '000D3AADD853'
+
+    response = simulator.respond(
+        'GET', '/metadata/instance/network/interface/0'
+               '?api-version=2019-08-15&format=text', HEADERS
+    )
+    assert response[3] == b'ipv4/\nipv6/\nmacAddress'
+
+    response = simulator.respond(
+        'GET', '/metadata/instance/network/interface/5'
+               '?api-version=2019-08-15', HEADERS
+    )
+    assert response[0] == 404
+
+    # versions without a fixture get the one of an older version
+    response = simulator.respond(
+        'GET', '/metadata/instance/compute/vmId?api-version=2020-06-01',
+        HEADERS
+    )
+    assert body(response) == 'e01fcd50-213b-4559-8fdf-d98c0086cde4'
+
+    response = simulator.respond(
+        'GET', '/metadata/attested/document?api-version=2018-04-02', HEADERS
+    )
+    assert response[0] == 404
+
+    response = simulator.respond('GET', '/metadata/versions', HEADERS)
+    assert body(response)['apiVersions'][:2] == ['2020-10-01', '2020-09-01']
+
+    response = simulator.respond('GET', '/metadata/versions', {})
+    assert response[0] == 400
+
+
+def test_unversioned_request():
+    simulator = make_simulator()
+    response = simulator.respond('GET', '/metadata/instance', HEADERS)
+    assert response[0] == 400
+
+    # the client finds the newest versions in the error
+    parsed = azuremetadata.AzureMetadata._parse_response(
+        (400, 'Bad Request', response[3], {}), no_api=True
+    )
+    assert azuremetadata.AzureMetadata._parse_unlisted_versions(parsed) == [
+        '2020-10-01', '2020-09-01', '2020-07-15'
+    ]
+
+
+def test_asm(server):
+    simulator = make_simulator(asm=True)
+    assert simulator.respond(
+        'GET', '/metadata/instance/compute?api-version=2019-11-01', HEADERS
+    )[0] == 404
+    assert simulator.respond(
+        'GET', '/metadata/instance/compute?api-version=2019-08-15', HEADERS
+    )[0] == 200
+
+    pool = redirected_pool(server(simulator))
+    assert azuremetadata.AzureMetadata(
+        api_version='2019-08-15', pool=pool
+    ).is_classic()
+    pool.close()
+
+    pool = redirected_pool(server(make_simulator()))
+    assert not azuremetadata.AzureMetadata(
+        api_version='2019-08-15', pool=pool
+    ).is_classic()
+    pool.close()
+
+
+def test_fault_options():
+    faults = stub_server.Faults('429:0.25,reset:0.5')
+    random.seed(1)
+    samples = [faults.sample() for _ in range(1000)]
+    assert set(samples) == {429, 'reset', None}
+
+    with pytest.raises(ValueError):
+        stub_server.Faults('200:0.5')
+    with pytest.raises(ValueError):
+        stub_server.Faults('500:0.6,reset:0.6')
+    with pytest.raises(ValueError):
+        stub_server.Latency('normal:5')
+
+    table = stub_server.PrefixTable()
+    table.add('/', 'all')
+    table.add('/metadata/instance', 'instance')
+    assert table.lookup('/metadata/instance/compute') == 'instance'
+    assert table.lookup('/metadata/instanceX') == 'all'
+
+
+@patch('azuremetadata.azuremetadata.sleep')
+def test_client_retries(sleep_mock, server):
+    faults = stub_server.PrefixTable()
+    faults.add('/metadata/instance', stub_server.Faults('503:0.4,reset:0.2'))
+    simulator = make_simulator(faults=faults)
+    pool = redirected_pool(server(simulator))
+
+    random.seed(3)
+    metadata = azuremetadata.AzureMetadata(
+        api_version='2019-08-15', pool=pool,
+        retry_policy=azuremetadata.RetryPolicy(attempts=20)
+    )
+    for _ in range(10):
+        assert metadata.get_instance_path(['compute', 'vmId']) == \
+            'e01fcd50-213b-4559-8fdf-d98c0086cde4'
+    pool.close()
+
+    counters = simulator.snapshot()
+    assert counters['status 200'] == 10
+    # connections are kept alive until they are reset
+    assert counters['connections'] == counters['fault reset'] + 1
+    assert counters['fault 503'] and counters['fault reset']
+    # a reset of a reused connection is retried on a new one at once
+    assert counters['fault 503'] <= sleep_mock.call_count <= \
+        counters['fault 503'] + counters['fault reset']
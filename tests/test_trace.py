@@ -0,0 +1,113 @@
+# Copyright (c) 2020 SUSE LLC
+#
+# This file is part of azuremetadata.
+#
+# azuremetadata is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# azuremetadata is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with azuremetadata.  If not, see <http://www.gnu.org/licenses/>.
+
+import pytest
+
+from azuremetadata import azuremetadata, azuremetadatatrace
+from mock import patch, Mock
+
+
+@pytest.fixture
+def tracer():
+    tracer = azuremetadatatrace.Tracer()
+    previous = azuremetadatatrace.set_tracer(tracer)
+    yield tracer
+    azuremetadatatrace.set_tracer(previous)
+
+
+def test_span_disabled():
+    assert azuremetadatatrace.get_tracer() is None
+    with azuremetadatatrace.span('foo', bar=1) as span:
+        span.set(baz=2)
+    assert span is azuremetadatatrace.span('other')
+
+
+@patch('azuremetadata.azuremetadatatrace.monotonic')
+def test_tracer(monotonic_mock):
+    monotonic_mock.return_value = 10
+    tracer = azuremetadatatrace.Tracer()
+    azuremetadatatrace.set_tracer(tracer)
+    try:
+        monotonic_mock.return_value = 11
+        with azuremetadatatrace.span('outer', foo='bar') as outer:
+            with azuremetadatatrace.span('inner'):
+                monotonic_mock.return_value = 12.5
+            outer.set(baz=1)
+        with pytest.raises(ValueError):
+            with azuremetadatatrace.span('failed'):
+                raise ValueError('foo')
+        monotonic_mock.return_value = 13
+    finally:
+        azuremetadatatrace.set_tracer(None)
+
+    assert tracer.trace() == {'total': 3, 'spans': [
+        {'name': 'inner', 'start': 1, 'duration': 1.5,
+         'thread': 'MainThread', 'parent': 'outer'},
+        {'name': 'outer', 'start': 1, 'duration': 1.5,
+         'thread': 'MainThread', 'parent': None, 'foo': 'bar', 'baz': 1},
+        {'name': 'failed', 'start': 2.5, 'duration': 0,
+         'thread': 'MainThread', 'parent': None, 'error': 'ValueError'},
+    ]}
+
+
+def test_tracer_callback():
+    callback = Mock()
+    tracer = azuremetadatatrace.Tracer(callback=callback)
+    with tracer.span('foo'):
+        pass
+
+    assert callback.call_args[0][0]['name'] == 'foo'
+    # exported spans are not kept
+    assert tracer.trace()['spans'] == []
+
+
+@patch('azuremetadata.azuremetadata.sleep')
+@patch('http.client.HTTPConnection')
+def test_request_spans(connection_mock, sleep_mock, tracer):
+    error = Mock(status=503, reason='Service Unavailable', will_close=False)
+    error.read.return_value = b''
+    error.headers = {}
+    ok = Mock(status=200, reason='OK', will_close=False)
+    ok.read.return_value = b'{"foo": "bar"}'
+    connection_mock.return_value.getresponse.side_effect = [error, ok]
+
+    metadata = azuremetadata.AzureMetadata(api_version='2020-02-02')
+    assert metadata.get_instance_data() == {'foo': 'bar'}
+
+    spans = {span['name']: span for span in tracer.trace()['spans']}
+    assert spans['request']['attempts'] == 2
+    assert spans['request']['status'] == 200
+    assert spans['request']['parent'] == 'document'
+    assert spans['retry-sleep']['parent'] == 'request'
+    assert spans['retry-sleep']['delay'] == sleep_mock.call_args[0][0]
+    assert spans['document']['source'] == 'server'
+
+
+def test_fetch_plan_spans(tracer):
+    def request():
+        with azuremetadatatrace.span('request'):
+            pass
+
+    azuremetadata.FetchPlan().add('foo', request).add('bar', request).run()
+
+    spans = tracer.trace()['spans']
+    assert [span['parent'] for span in spans] == [
+        'fetch-plan', 'fetch-plan', None
+    ]
+    assert spans[2]['requests'] == ['foo', 'bar']
+    # the requests ran in threads of their own
+    assert spans[0]['thread'] != 'MainThread'
@@ -17,8 +17,9 @@
 
 import pytest
 from textwrap import dedent
+from xml.etree import ElementTree
 from azuremetadata import azuremetadatautils
-from mock import patch
+from mock import patch, Mock
 
 data = {
         'foo': {
@@ -93,6 +94,7 @@ def test_pretty_print(capsys):
         </bar>
     </baz>
     <baz index='2'>
+        <foobar/>
     </baz>
     <test>4</test>
     """).lstrip()
@@ -106,8 +108,27 @@ def test_pretty_print(capsys):
 
 
 def test_print_xml(capsys):
-    expected_output = '<document>{"foo": {"bar": 1}, "baz": [{"bar": {"foo": 2}}, ' \
-            '{"bar": {"foo": 3}}, {"foobar": []}], "test": 4}</document>\n'
+    expected_output = dedent("""
+    <document>
+        <foo>
+            <bar>1</bar>
+        </foo>
+        <baz index='0'>
+            <bar>
+                <foo>2</foo>
+            </bar>
+        </baz>
+        <baz index='1'>
+            <bar>
+                <foo>3</foo>
+            </bar>
+        </baz>
+        <baz index='2'>
+            <foobar/>
+        </baz>
+        <test>4</test>
+    </document>
+    """).lstrip()
 
     util = azuremetadatautils.AzureMetadataUtils(data)
     util.print_pretty(print_xml=True)
@@ -231,3 +252,218 @@ def test_invalid_data():
 
     assert str(w[0].message) == "Only list of dicts is supported"
     assert util.available_params == {'bar': 1, 'foo': {'bar': 1}}
+
+
+def test_index():
+    util = azuremetadatautils.AzureMetadataUtils(data)
+
+    assert util.index[('baz', 1, 'bar', 'foo')] == 3
+    assert util.index[('baz', 0)] == {'bar': {'foo': 2}}
+    assert util.index[('test',)] == 4
+    assert util.key_paths['bar'] == [
+        ('foo', 'bar'), ('baz', 0, 'bar'), ('baz', 1, 'bar')
+    ]
+    assert util.key_paths['foobar'] == [('baz', 2, 'foobar')]
+
+
+def test_query_negative_list_index():
+    util = azuremetadatautils.AzureMetadataUtils(data)
+    args = [('baz', -2), ('bar', True), ('foo', True)]
+
+    assert util.query(args) == {'baz': {'bar': {'foo': 3}}}
+
+
+def test_query_list_index_out_of_range():
+    util = azuremetadatautils.AzureMetadataUtils(data)
+    args = [('baz', 3)]
+
+    assert util.query(args) == {'baz': data['baz']}
+
+
+def test_query_args_not_consumed():
+    util = azuremetadatautils.AzureMetadataUtils(data)
+    args = [('foo', True), ('bar', True), ('test', True)]
+
+    assert util.query(args) == {'foo': {'bar': 1}, 'test': 4}
+    assert len(args) == 3
+
+
+def test_print_pretty_single_write():
+    util = azuremetadatautils.AzureMetadataUtils(data)
+    file = Mock()
+    util.print_pretty(file=file)
+
+    assert file.write.call_count == 1
+    assert file.write.call_args[0][0].startswith('foo:\n    bar: 1\n')
+
+
+def test_print_pretty_chunks():
+    util = azuremetadatautils.AzureMetadataUtils(data)
+    file = Mock()
+
+    with patch.object(azuremetadatautils.AzureMetadataUtils, 'CHUNK_SIZE',
+                      20):
+        util._pretty_print(util.PRINT_MODE_HELP, data, file=file)
+
+    chunks = [call[0][0] for call in file.write.call_args_list]
+    assert len(chunks) > 1
+    assert all(chunk.endswith('\n') for chunk in chunks)
+    assert ''.join(chunks).startswith('--foo\n    --bar\n--baz 0\n')
+
+
+def test_print_xml_escaping(capsys):
+    util = azuremetadatautils.AzureMetadataUtils(data)
+    util.print_pretty(print_xml=True, data={
+        'tags': 'a:<b>;c:&d', 'enabled': True, 'zone': None
+    })
+    captured = capsys.readouterr()
+
+    assert captured.out == (
+        '<document>\n'
+        '    <tags>a:&lt;b&gt;;c:&amp;d</tags>\n'
+        '    <enabled>true</enabled>\n'
+        '    <zone></zone>\n'
+        '</document>\n'
+    )
+    ElementTree.fromstring(captured.out)
+
+
+def test_print_xml_empty_list(capsys):
+    util = azuremetadatautils.AzureMetadataUtils(data)
+    util.print_pretty(print_xml=True, data={
+        'storageProfile': {'dataDisks': []}
+    })
+    captured = capsys.readouterr()
+
+    assert captured.out == (
+        '<document>\n'
+        '    <storageProfile>\n'
+        '        <dataDisks/>\n'
+        '    </storageProfile>\n'
+        '</document>\n'
+    )
+    document = ElementTree.fromstring(captured.out)
+    assert document.find('storageProfile/dataDisks') is not None
+
+
+def test_print_list_of_values(capsys):
+    util = azuremetadatautils.AzureMetadataUtils(data)
+    util.print_pretty(print_xml=True, data={'zones': ['1', '<2>']})
+    captured = capsys.readouterr()
+
+    assert captured.out == (
+        '<document>\n'
+        "    <zones index='0'>1</zones>\n"
+        "    <zones index='1'>&lt;2&gt;</zones>\n"
+        '</document>\n'
+    )
+    ElementTree.fromstring(captured.out)
+
+    util.print_pretty(data={'zones': ['1', '2']})
+    assert capsys.readouterr().out == 'zones[0]: 1\nzones[1]: 2\n'
+
+
+def test_result_value():
+    result_value = azuremetadatautils.AzureMetadataUtils.result_value
+
+    assert result_value({'compute': {'vmId': 'foo'}}) == 'foo'
+    assert result_value({'compute': {'zone': None}}) is None
+    for result in [
+            {'compute': {'tagsList': []}},
+            {'compute': {'vmId': 'foo', 'zone': '1'}},
+            {'vmId': 'foo', 'network': {'macAddress': '1'}},
+    ]:
+        assert result_value(result) is result
+
+
+def test_parse_query():
+    util = azuremetadatautils.AzureMetadataUtils(data)
+
+    assert util.parse_query([]) == []
+    assert util.parse_query(['--baz', '1', '--bar', '--foo']) == \
+        [('baz', 1), ('bar', True), ('foo', True)]
+    assert util.parse_query(['--baz=-1', '--foob', '--te']) == \
+        [('baz', -1), ('foobar', True), ('test', True)]
+    assert util.parse_query(['--baz', '-1']) == [('baz', -1)]
+
+
+@pytest.mark.parametrize(
+    "args,error",
+    [
+        (['--fo'], "ambiguous option: --fo could match --foo, --foobar"),
+        (['--test', '--fo=1'],
+         "ambiguous option: --fo=1 could match --foo, --foobar"),
+        (['--baz', 'x'], "argument --baz: invalid int value: 'x'"),
+        (['--baz='], "argument --baz: invalid int value: ''"),
+        (['--qux', '--test', '1', '2', '-x'],
+         "unrecognized arguments: --qux 2 -x"),
+        (['--test', '--', '--foo'], "unrecognized arguments: -- --foo"),
+    ]
+)
+def test_parse_query_errors(args, error):
+    util = azuremetadatautils.AzureMetadataUtils(data)
+
+    with pytest.raises(azuremetadatautils.QueryArgumentError) as e:
+        util.parse_query(args)
+
+    assert str(e.value) == error
+
+
+def test_parse_query_without_keys():
+    parser = azuremetadatautils.QueryParser()
+
+    # any key is taken as it is
+    assert parser.parse(['--fo', '--qux=2', '--bar', '-3']) == \
+        [('fo', True), ('qux', 2), ('bar', -3)]
+    with pytest.raises(azuremetadatautils.QueryArgumentError):
+        parser.parse(['--foo', 'bar'])
+
+
+def test_query_batch():
+    util = azuremetadatautils.AzureMetadataUtils(data)
+
+    assert util.query_batch([
+        '--foo --bar',
+        '--baz 1 --bar --foo',
+        '--qux',
+        "--baz 'x",
+        '--te',
+    ]) == [
+        ({'foo': {'bar': 1}}, None),
+        ({'baz': {'bar': {'foo': 3}}}, None),
+        (None, 'unrecognized arguments: --qux'),
+        (None, 'No closing quotation'),
+        ({'test': 4}, None),
+    ]
+
+
+def test_print_shell(capsys):
+    expected_output = dedent("""
+        FOO_BAR=1
+        BAZ_0_BAR_FOO=2
+        BAZ_1_BAR_FOO=3
+        TEST=4
+        QUOTED_VALUE='it'"'"'s $HOME'
+        QUOTED_EMPTY=''
+        QUOTED_FLAG=true
+    """).lstrip()
+
+    util = azuremetadatautils.AzureMetadataUtils(dict(data, **{
+        'quoted': {'value': "it's $HOME", 'empty': None, 'flag': True}
+    }))
+    util.print_pretty(print_shell=True)
+    captured = capsys.readouterr()
+
+    assert captured.out == expected_output
+    assert captured.err == ''
+
+
+def test_select():
+    util = azuremetadatautils.AzureMetadataUtils(data)
+
+    assert util.select([('baz', 1), ('bar', True), ('foo', True)]) == \
+        {'baz': [{}, {'bar': {'foo': 3}}]}
+    assert util.select([('test', True), ('foo', True), ('bar', True)]) \
+        == {'test': 4, 'foo': {'bar': 1}}
+    with pytest.raises(azuremetadatautils.QueryException):
+        util.select([('baz', 1)])
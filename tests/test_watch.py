@@ -0,0 +1,151 @@
+# Copyright (c) 2020 SUSE LLC
+#
+# This file is part of azuremetadata.
+#
+# azuremetadata is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# azuremetadata is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with azuremetadata.  If not, see <http://www.gnu.org/licenses/>.
+
+import copy
+import threading
+
+import pytest
+
+from azuremetadata import azuremetadatautils, azuremetadatawatch
+from mock import Mock
+
+data = {
+    'compute': {'vmId': 'foo', 'tags': '', 'publicKeys': [{'path': 'a'}]},
+    'network': {'interface': [{'macAddress': '1'}, {'macAddress': '2'}]},
+}
+
+
+def test_hash_tree():
+    tree = azuremetadatawatch.hash_tree(data)
+    other = copy.deepcopy(data)
+
+    assert azuremetadatawatch.hash_tree(other).digest == tree.digest
+    # key order does not matter, types do
+    assert azuremetadatawatch.hash_tree(
+        dict(reversed(list(data.items())))
+    ).digest == tree.digest
+    assert azuremetadatawatch.hash_tree({'a': '1'}).digest != \
+        azuremetadatawatch.hash_tree({'a': 1}).digest
+
+    other['network']['interface'][1]['macAddress'] = '3'
+    other_tree = azuremetadatawatch.hash_tree(other)
+    assert other_tree.digest != tree.digest
+    assert other_tree.children['compute'].digest == \
+        tree.children['compute'].digest
+
+
+def test_diff_trees():
+    new = copy.deepcopy(data)
+    new['compute']['tags'] = 'env:prod'
+    new['compute']['publicKeys'] = ''
+    new['compute']['zone'] = '1'
+    del new['compute']['vmId']
+    new['network']['interface'].pop()
+
+    changes = list(azuremetadatawatch.diff_trees(
+        azuremetadatawatch.hash_tree(data), azuremetadatawatch.hash_tree(new)
+    ))
+
+    assert changes == [
+        {'type': 'removed', 'path': ['compute', 'vmId'], 'old': 'foo'},
+        {'type': 'changed', 'path': ['compute', 'tags'],
+         'old': '', 'new': 'env:prod'},
+        {'type': 'changed', 'path': ['compute', 'publicKeys'],
+         'old': [{'path': 'a'}], 'new': ''},
+        {'type': 'added', 'path': ['compute', 'zone'], 'new': '1'},
+        {'type': 'removed', 'path': ['network', 'interface', 1],
+         'old': {'macAddress': '2'}},
+    ]
+
+
+def test_diff_trees_unchanged_subtree_skipped():
+    tree = azuremetadatawatch.hash_tree(data)
+    compute = tree.children['compute']
+    # children of a subtree with the same digest are never looked at
+    new_tree = tree._replace(
+        digest=b'other',
+        children=dict(tree.children, compute=compute._replace(children=None))
+    )
+
+    assert list(azuremetadatawatch.diff_trees(tree, new_tree)) == []
+
+
+def test_watcher_poll():
+    new = copy.deepcopy(data)
+    new['compute']['tags'] = 'env:prod'
+    fetch = Mock(side_effect=[data, None, data, new])
+    watcher = azuremetadatawatch.MetadataWatcher(fetch)
+
+    assert watcher.poll() == []
+    # failed fetches do not count as changes
+    assert watcher.poll() == []
+    assert watcher.poll() == []
+    assert watcher.poll() == [{
+        'type': 'changed', 'path': ['compute', 'tags'],
+        'old': '', 'new': 'env:prod'
+    }]
+
+
+def test_watcher_watch():
+    new = copy.deepcopy(data)
+    new['compute']['vmId'] = 'bar'
+    stop = threading.Event()
+
+    def fetch():
+        if fetch.calls == 3:
+            stop.set()
+        fetch.calls += 1
+        return new if fetch.calls > 2 else data
+    fetch.calls = 0
+
+    watcher = azuremetadatawatch.MetadataWatcher(fetch)
+    assert list(watcher.watch(0, stop)) == [[{
+        'type': 'changed', 'path': ['compute', 'vmId'],
+        'old': 'foo', 'new': 'bar'
+    }]]
+    assert fetch.calls == 4
+
+
+def test_query_fetch():
+    removed = copy.deepcopy(data)
+    del removed['compute']['publicKeys']
+    fetch = Mock(side_effect=[data, None, removed, data])
+    watcher = azuremetadatawatch.MetadataWatcher(
+        azuremetadatawatch.query_fetch(
+            fetch, ['--compute', '--publicKeys', '0', '--path']
+        )
+    )
+
+    assert watcher.poll() == []
+    assert watcher.poll() == []
+    # the watched value is gone
+    assert watcher.poll() == [{
+        'type': 'removed', 'path': ['compute'],
+        'old': {'publicKeys': [{'path': 'a'}]}
+    }]
+    assert watcher.poll() == [{
+        'type': 'added', 'path': ['compute'],
+        'new': {'publicKeys': [{'path': 'a'}]}
+    }]
+
+
+def test_query_fetch_error():
+    fetch = azuremetadatawatch.query_fetch(lambda: data, ['--foo'])
+
+    # the query never selected anything
+    with pytest.raises(azuremetadatautils.QueryException):
+        fetch()